@@ -37,249 +37,1072 @@
 #  Response:   SMS:Working...
 #  Response:   JNTS: 10 20 30 40 50 60
 #
+# Without a robot, run the controller simulator first (python mitsubishi_sim.py) and connect to 127.0.0.1 10001
+#
 #---------------------------------------------------------------------------------
 
+import os
+import re
+import json
 import sys
+import tempfile
+import operator
 import time
+import mmap
+import array
+import struct
 import socket
 import threading
+import collections
+import bisect
+import hashlib
+import inspect
+import contextvars
+import asyncio
+import atexit
+import http.server
 
 try:
-   import queue
+    import numpy
 except ImportError:
-    # Python2
-   import Queue as queue
+    # Only needed to analyse the joint telemetry (TelemetryBuffer.arrays, read_telemetry)
+    numpy = None
 
-global MOV_LAST_J
-MOV_LAST_J = None
+try:
+    import mitsubishi_kinematics
+except ImportError:
+    # Requires NumPy. Only needed for Cartesian linear moves and local poses (KINEMATICS, CPOS)
+    mitsubishi_kinematics = None
    
+# Largest difference between two sets of joints (deg)
 def joints_error(j1, j2):
     if j1 is None or j2 is None:
         return 1e6
-        
-    if type(j2) is list and type(j2[0]) is str:
-        j2 = [float(x) for x in j2]
+    return max(map(abs, map(operator.sub, j1, j2)), default=-1)
 
-    error = -1
-    nj = min(len(j1), len(j2))
-    for i in range(nj):
-        error = max(error, abs(j1[i]-j2[i]))
+# Joint values (tuple of floats) of a JPOSF reply: QoKJ1;<j1>;J2;<j2>;... (axes reported as **** are skipped)
+def parse_joints(robot_msg, naxes):
+    return tuple(float(j) for j in robot_msg.split(';')[1:(naxes*2):2] if "*" not in j)
 
-    return error
+# STATE word of the robot (5th field of the STATE reply, hex digits). Padding and the characters after the hex digits
+# are ignored, a field without hex digits gives 0 (unknown)
+def parse_state_word(field):
+    digits = re.match('[0-9A-Fa-f]*', field.strip()).group()
+    return int(digits, 16) if digits else 0
    
-#----------- communication class for the Mitsubishi robot -------------
-# This class handles communication between this driver (PC) and the Mitsubishi robot
-class RobotCom:
-    """Robot class for programming Mitsubishi robots"""
+#----------- controller protocol -------------
+# The exchanges with the controller (commands, program uploads, error reports, monitor polls) are written once for both
+# driver engines, as generators: each operation that waits for the robot is an engine call that is yielded, and the
+# result of the call is sent back to the generator.
+#   replies = yield self.exchange(cmds)
+# The threaded engine (RobotCom) makes the call right away and the result is sent back as is (run_sync). The asyncio
+# engine (AsyncRobotCom) returns an awaitable that is awaited first (run_async). Generators call each other with yield from.
+
+# Run a generator of controller operations with the threaded engine. Returns the value returned by the generator
+# (anything that is not a generator is returned as is)
+def run_sync(ops):
+    if not inspect.isgenerator(ops):
+        return ops
+    result = None
+    while True:
+        try:
+            result = ops.send(result)
+        except StopIteration as e:
+            return e.value
+
+# Run a generator of controller operations with the asyncio engine. Exceptions of the awaited calls (and cancellation)
+# are raised inside the generator
+async def run_async(ops):
+    if not inspect.isgenerator(ops):
+        return ops
+    resume = ops.send
+    result = None
+    while True:
+        try:
+            op = resume(result)
+        except StopIteration as e:
+            return e.value
+        try:
+            result = (await op) if inspect.isawaitable(op) else op
+            resume = ops.send
+        except BaseException as e:
+            result = e
+            resume = ops.throw
+
+# Commands of the Mitsubishi controller, shared by the engines. The engine provides the connection:
+#   connect, disconnect, drop, alive    open and close the connections and the monitor
+#   exchange(cmds)                      write the commands and read one reply per command (None if the connection is broken)
+#   monitor_exchange(cmds)              the same through the monitoring connection (raises OSError if it is broken)
+#   sleep, monitor_sleep                waits of the commands and of the monitor
+#   wait_for(cond, predicate, timeout)  wait for a condition of the session (state, inputs or motion queue)
+#   wake                                wake up the waits after a change (the asyncio engine does not use the conditions)
+#   spawn(ops, name)                    run a generator of operations in the background (monitor, motion queue)
+class RobotProtocol:
     LAST_MSG = ""       # Keep a copy of the last message received
     CONNECTED = False   # Connection status is known at all times
     rounding = -1
     speed_mms = 50
+    jovrd = 100 # Joint override (%)
     accel_percent_joints = 100
     accel_percent_linear = 100
-    
+
+    def __init__(self, session):
+        self.session = session # Robot session this connection belongs to (state and status)
+        self.PIPELINE = True # Send program uploads as one batch and match the acknowledges afterwards
+        self.MONITOR_TIMEOUT = 2 # seconds
+        self.POLL_MIN = 0.01 # Fastest polling while moving, near the end of a move (seconds)
+        self.POLL_MAX = 0.1 # Slowest polling while moving (seconds)
+        self.detect_latency = collections.deque(maxlen=100) # Measured end of move detection latency (seconds)
+        self.LAST_FAILED = None # Command that failed in the last batch
+        self.LAST_ERROR = None # Last error reported by the robot (ControllerError)
+        self.model = 'default' # Controller model (key of the error catalog)
+        self.LAST_REPLIES = [] # Replies of the last batch
+        self.LOADED_PROG = None # Program currently loaded in the task slot
+        self.RESIDENT = False # Use the resident motion program (only the targets are written for each move)
+        self.RESIDENT_PROG = 'RDKMOV'
+        self.resident_installed = False
+        self.resident_vars = {} # Last values written to the resident program variables
+        # Connection management
+        self.CONNECT_TIMEOUT = 4 # seconds, for each connection attempt and for the replies of the robot
+        self.CONNECT_RETRY_TIME = 10 # Keep trying to connect during this time (seconds), with an exponential backoff
+        self.KEEPALIVE = (5, 1, 3) # TCP keepalive: idle time, probe interval (seconds) and probes before the link is considered dead
+        self.AUTO_RECONNECT = True # Reconnect at the next command if the connection was lost
+        self.target = None # (ip, port, monitor_port) of the last connection
+        self.lost = False # The connection was lost (not closed by a disconnect)
+        self.connecting = False # connect is running: no automatic reconnection
+        self.RECONNECT_ATTEMPTS = 3 # Connections tried by an automatic reconnection
+
+    # Connect again to the last robot after the connection was lost (RECONNECT_ATTEMPTS times at most)
+    # Commands run while connecting don't reconnect, even if the link breaks again
+    def reconnect(self):
+        if self.target is None or self.connecting:
+            return False
+        for attempt in range(self.RECONNECT_ATTEMPTS):
+            print_message("Connection lost, reconnecting (%i/%i)" % (attempt + 1, self.RECONNECT_ATTEMPTS))
+            if (yield self.connect(*self.target)):
+                return True
+        return False
+
+    # Run a specific command. Returns True if the robot acknowledged it (the reply is kept in LAST_MSG)
+    def run(self, cmd):
+        if self.lost and self.AUTO_RECONNECT and not self.connecting and not (yield from self.reconnect()):
+            self.lost = False
+
+        # Skip the command if the robot is not connected
+        if (not self.CONNECTED) or (ok2SendCmd() == False):
+            UpdateStatus(ROBOTCOM_NOT_CONNECTED)
+            return False
+
+        replies = yield self.exchange([cmd])
+        if replies is None:
+            return False
+
+        robot_msg = replies[0]
+        if 'Qer' in robot_msg:
+            print_message(robot_msg)
+            yield from self.report_error(cmd, robot_msg)
+            return False
+
+        if "JPOSF" in cmd:
+            # robot response after a GetJoints request (SCARA robots report fewer axes)
+            joints = parse_joints(robot_msg, self.session.axis_count)
+            self.session.feed.publish(joints)
+            print_joints(joints)
+            return True
+
+        # Any other acknowledge message (assumed to be successful)
+        # Save the Ready status to send later and notify RoboDK that the instruction was completed
+        self.session.state.set_status(ROBOTCOM_READY)
+        return True
+
+    # Run a list of commands (for example, a program upload) as a single batch
+    # All commands are written at once, then the acknowledges are matched to the commands in order.
+    # The batch stops at the first command that fails (Qer) and the failing line is reported.
+    # The replies are kept in LAST_REPLIES
+    def run_batch(self, cmds):
+        if not self.PIPELINE:
+            # One round trip per command
+            self.LAST_REPLIES = []
+            for cmd in cmds:
+                if not (yield from self.run(cmd)):
+                    self.LAST_FAILED = cmd
+                    return False
+                self.LAST_REPLIES.append(self.LAST_MSG)
+            return True
+
+        if self.lost and self.AUTO_RECONNECT and not self.connecting and not (yield from self.reconnect()):
+            self.lost = False
+
+        if (not self.CONNECTED) or (ok2SendCmd() == False):
+            UpdateStatus(ROBOTCOM_NOT_CONNECTED)
+            return False
+
+        self.LAST_FAILED = None
+        replies = yield self.exchange(cmds)
+        if replies is None:
+            return False
+
+        # All the acknowledges are read after a failure so the remaining ones don't get mixed with the next command
+        self.LAST_REPLIES = replies
+        for i in range(len(cmds)):
+            if 'Qer' in replies[i]:
+                self.LAST_FAILED = cmds[i]
+                print_message(replies[i])
+                print_message("Batch failed at line %i: %s" % (i + 1, self.LAST_FAILED))
+                yield from self.report_error(self.LAST_FAILED, replies[i], i + 1)
+                return False
+
+        self.session.state.set_status(ROBOTCOM_READY)
+        return True
+
+    # Report the error of a failed command (reply Qer...) and keep it in LAST_ERROR (ControllerError)
+    # The error number and message are only requested from the robot if they are unknown (see ErrorCatalog)
+    def report_error(self, cmd, reply, step=1):
+        try:
+            errno = reply_errno(reply)
+            if errno is None:
+                replies = yield self.exchange(["1;1;ERROR"])
+                if replies is None:
+                    return
+                errno = int(replies[0][3:7])
+            message = ERRORS.get(self.model, errno)
+            METRICS.count('mitsubishi_error_catalog_total', robot=self.session.id, result='miss' if message is None else 'hit')
+            if message is None:
+                replies = yield self.exchange(["1;1;ERRORMES" + str(errno)])
+                if replies is None:
+                    return
+                message = replies[0][3:]
+                ERRORS.put(self.model, errno, message)
+            self.LAST_ERROR = ControllerError(self.session.id, self.model, errno, message, cmd, step, reply)
+            print_error(str(self.LAST_ERROR))
+        except Exception as e:
+            print_error(str(e))
+
+    # First digit of the STATE word (STATE_BIT_...), or None if it is not available
+    def query_state(self):
+        if not (yield from self.run('1;1;STATE')):
+            return None
+        try:
+            return int(self.LAST_MSG.split(';')[4][0], 16)
+        except (IndexError, ValueError):
+            return None
+
+    # Start the session once connected: welcome message, then the control and servos are only turned on if they are off
+    # (for example after a network problem)
+    def open_session(self):
+        print_message('Waiting for welcome message...')
+        UpdateStatus(ROBOTCOM_WORKING)
+        # receive welcome message and output to the log
+        if (yield from self.run('1;1;OPEN=ROBODK')):
+            self.model = controller_model(self.LAST_MSG)
+        # notify status that the robot is still working
+        UpdateStatus(ROBOTCOM_WORKING)
+
+        # send activate robot and read confirmation
+        yield from self.run('1;1;RSTALRM')
+        state = yield from self.query_state()
+        if state is None or not state & STATE_BIT_ENABLED:
+            yield from self.run('1;1;CNTLON')
+        if state is None or not state & STATE_BIT_SERVO:
+            yield from self.run('1;1;SRVON')
+        self.LOADED_PROG = None
+        self.resident_installed = False
+        if self.RESIDENT:
+            yield from self.install_resident()
+
+    # Write a program to the robot and load it for execution
+    # With load=False the program is only written, the program currently loaded (and maybe running) is not affected
+    def upload_program(self, prog_lines, prog_name='MRL', load=True):
+        if not (yield from self.run_batch(mrl_upload_cmds(prog_lines, prog_name, load))):
+            if load:
+                self.LOADED_PROG = None
+            return False
+        if load:
+            self.LOADED_PROG = prog_name
+        return True
+
+    # Load a program that was already written (if required) and run it
+    def start_program(self, prog_name):
+        if self.LOADED_PROG != prog_name:
+            if not (yield from self.run_batch(["1;1;RSTPRG", "1;1;PRGLOAD=" + prog_name])):
+                self.LOADED_PROG = None
+                return False
+            self.LOADED_PROG = prog_name
+        return (yield from self.run("1;1;RUN" + prog_name + ";1"))
+
+    # Delete a program from the robot (unloaded first if it is loaded). A program already deleted is not an error
+    def delete_program(self, prog_name):
+        if self.LOADED_PROG == prog_name:
+            yield from self.run("1;1;RSTPRG")
+            self.LOADED_PROG = None
+        if not (yield from self.run("1;1;FDEL" + prog_name)):
+            # Already deleted from the controller (the error left the status unknown)
+            UpdateStatus(ROBOTCOM_WORKING)
+
+    # Run a program of the program library (see ProgramLibrary): it is only written if it is not on the controller yet
+    def run_library_program(self, name, prog_lines):
+        controller = "%s:%i" % (self.session.ip, self.session.port)
+        slot = program_slot(prog_lines)
+        if PROGRAMS.lookup(controller, slot) is not None:
+            if (yield from self.start_program(slot)):
+                PROGRAMS.touch(controller, slot)
+                return True
+            # The slot was deleted from the controller: write it again (the error left the status unknown)
+            print_message("Program %s not found in slot %s, writing it again" % (name, slot))
+            PROGRAMS.remove(controller, slot)
+            UpdateStatus(ROBOTCOM_WORKING)
+            self.LOADED_PROG = None
+
+        for old in PROGRAMS.evictions(controller, len(prog_lines)):
+            yield from self.delete_program(old)
+            PROGRAMS.remove(controller, old)
+        if not (yield from self.upload_program(prog_lines, slot, False)):
+            return False
+        PROGRAMS.add(controller, slot, name, len(prog_lines))
+        return (yield from self.start_program(slot))
+
+    # Install the resident motion program. It reads the targets, speed and acceleration from program external variables
+    # so that a move only needs to write these variables and start the program
+    def install_resident(self):
+        self.resident_vars = {}
+        self.resident_installed = yield from self.upload_program(RESIDENT_PROG_LINES, self.RESIDENT_PROG)
+        return self.resident_installed
+
+    # Execute a move with the resident motion program
+    # targets holds the joint targets: [end] for joint and linear moves, [end, via, start] for circular moves
+    def move_resident(self, move_type, targets):
+        if not self.resident_installed and not (yield from self.install_resident()):
+            return False
+
+        cmds = []
+        for i in range(len(targets)):
+            cmds.append("1;1;VALJ_%02i=(%s)" % (i + 1, ','.join(format(vi, ".6f") for vi in targets[i])))
+
+        # Only write the settings that changed since the last move
+        for var, value in (('M_01', self.speed_mms), ('M_02', self.accel_percent_joints), ('M_03', move_type)):
+            if self.resident_vars.get(var) != value:
+                cmds.append("1;1;VAL%s=%.3f" % (var, value))
+
+        if self.LOADED_PROG != self.RESIDENT_PROG:
+            cmds.append("1;1;PRGLOAD=" + self.RESIDENT_PROG)
+
+        if not (yield from self.run_batch(cmds)):
+            self.resident_vars = {}
+            return False
+
+        self.resident_vars['M_01'] = self.speed_mms
+        self.resident_vars['M_02'] = self.accel_percent_joints
+        self.resident_vars['M_03'] = move_type
+        self.LOADED_PROG = self.RESIDENT_PROG
+        return (yield from self.run("1;1;RUN" + self.RESIDENT_PROG + ";1"))
+
+    # Read count inputs starting at start in one exchange (16 signals per IN command). Returns the value or None
+    def read_inputs(self, start, count=16):
+        words = io_words(start, count)
+        if not (yield from self.run_batch(["1;1;IN%i" % first for first in words])):
+            return None
+        values = dict(zip(words, (int(reply[3:7], 16) for reply in self.LAST_REPLIES)))
+        self.session.io.update(values)
+        self.wake()
+        return io_join(values, start, count)
+
+    # Write count outputs starting at start in one exchange (16 signals per OUT command)
+    # Each OUT command writes a whole word: count must be a multiple of 16, otherwise the other outputs of the last
+    # word would be cleared (the controller does not report the outputs to merge them)
+    def write_outputs(self, start, value, count=16):
+        if count <= 0 or count % IO_WORD != 0:
+            print_message("Outputs are written by words of %i signals (%i outputs requested)" % (IO_WORD, count))
+            return False
+        return (yield from self.run_batch(["1;1;OUT=%i;%04X" % (first, (value >> (first - start)) & 0xFFFF) for first in io_words(start, count)]))
+
+    # Wait for the end of the current move (see monitor_loop)
+    def wait_motion_done(self):
+        return self.wait_for(self.session.state.cond, lambda: not self.session.moving)
+
+#----------- communication class for the Mitsubishi robot -------------
+# This class handles communication between this driver (PC) and the Mitsubishi robot
+# The commands are sent by the thread that runs them (command line or motion queue), the monitor runs in its own thread
+class RobotCom(RobotProtocol):
+    """Robot class for programming Mitsubishi robots"""
+
     # This is executed when the object is created
-    def __init__(self):
-        self.BUFFER_SIZE = 512 # bytes
+    def __init__(self, session):
+        RobotProtocol.__init__(self, session)
+        self.BUFFER_SIZE = 4096 # bytes
         self.TIMEOUT = 60 # seconds # No robot movement should take more than 60 seconds
         #self.TIMEOUT = 10 # seconds
         self.sock = None
-        self.sockjnts = None       
-        
+        self.sockjnts = None
+        self.reader = None # Framed reader of the command connection
+        self.lock = threading.RLock() # Held during a command exchange
+        # Monitoring connection (position and state polling), tuned independently from the command connection
+        self.MONITOR_BUFFER_SIZE = 1024 # bytes
+        self.monreader = None
+        self.monlock = self.lock
+        self.monitor_stop = threading.Event()
+        self.POLL_IDLE = 0.02 # Check for a new move (no communication with the robot)
+        self.monitor_thread = None
+
     # Disconnect from robot
     def disconnect(self):
         self.CONNECTED = False
+        self.lost = False
+        self.stop_monitor()
+        self.wake()
+        self.session.telemetry.flush()
         try:
+            if self.monreader is not None and self.monreader is not self.reader:
+                send_line(self.sockjnts, '1;1;CLOSE')
             self.sockjnts.close()
         except:
             pass
         try:
             if self.sock is not None:
-                self.Run('1;1;CLOSE')
+                send_line(self.sock, '1;1;CLOSE')
                 self.sock.close()
         except:
-            pass    
+            pass
         UpdateStatus(ROBOTCOM_DISCONNECTED)
         return True
-    
+
+    # Close the connections without notifying the robot (the link is broken)
+    def drop(self):
+        self.CONNECTED = False
+        for sock in (self.sockjnts, self.sock):
+            try:
+                if sock is not None:
+                    sock.shutdown(socket.SHUT_RDWR) # wakes up the monitor if it is waiting for a reply
+            except OSError:
+                pass
+        self.stop_monitor()
+        for sock in (self.sockjnts, self.sock):
+            try:
+                if sock is not None:
+                    sock.close()
+            except OSError:
+                pass
+
     # Connect to robot
-    def connect(self, ip, port=10001):
-        global ROBOT_MOVING
-        self.disconnect()
+    # The monitoring session uses monitor_port (port+1 by default). Set monitor_port to 0 to share the command connection
+    # Connecting again to the same robot keeps the current connection if it still works. Otherwise the connection is
+    # opened again (retrying with a backoff) and the control and servos are only turned on if they are off.
+    def connect(self, ip, port=10001, monitor_port=None):
+        self.connecting = True
+        try:
+            return self.open(ip, port, monitor_port)
+        finally:
+            self.connecting = False
+
+    # Open the connection (see connect). Returns False if the robot could not be reached or the link broke meanwhile
+    def open(self, ip, port, monitor_port):
+        target = (ip, port, monitor_port)
+        if self.CONNECTED and target == self.target and self.alive():
+            print_message('Connected to robot %s:%i' % (ip, port))
+            self.start_monitor()
+            UpdateStatus(ROBOTCOM_READY)
+            return True
+
+        if self.CONNECTED and target != self.target:
+            self.disconnect()
+        else:
+            self.drop()
         print_message('Connecting to robot %s:%i' % (ip, port))
-        # Create new socket connection
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.settimeout(4)
-        self.sockjnts = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sockjnts.settimeout(4)        
         UpdateStatus(ROBOTCOM_WORKING)
         try:
-            self.sock.connect((ip, port))
-            
-        except ConnectionRefusedError as e:
-            print(str(e))
+            self.sock = connect_backoff((ip, port), self.CONNECT_TIMEOUT, self.CONNECT_RETRY_TIME, self.KEEPALIVE)
+
+        except OSError as e:
+            print_message(str(e))
             print_message("Connection refused")
             return False
-        
+
+        self.reader = FramedReader(self.sock, self.BUFFER_SIZE)
+        self.sockjnts = None
         self.CONNECTED = True
-        ROBOT_MOVING = False
-        print_message('Waiting for welcome message...')
-        UpdateStatus(ROBOTCOM_WORKING)
-        #time.sleep(2)
-        
-        # receive welcome message and output to the log
-        self.Run('1;1;OPEN=ROBODK',False)
-        #print(self.recv_str())
-        # notify status that the robot is still working
-        UpdateStatus(ROBOTCOM_WORKING)
-        
-        # send activate robot and read confirmation
-        self.Run('1;1;RSTALRM',False)
-        self.Run('1;1;CNTLON',False)
-        self.Run('1;1;SRVON')
+        self.lost = False
+        self.target = target
+        self.session.state.motion_done()
+        run_sync(self.open_session())
+        if not self.CONNECTED:
+            # The connection broke while the session was started
+            return False
         # RoboDK provides xyzwpr data for the TCP with respect to the robot reference frame for linear movements
         #self.Run('SetWRF', [0, 0, 0, 0, 0, 0])
-        #self.sock.settimeout(self.TIMEOUT)        
-        #self.sockjnts.connect((ip, 10002))
-        
-        q = queue.Queue()
-        t = threading.Thread(target=robot_monitor, args=(q, self.sock))
-        t.daemon = True
-        t.start()
+        #self.sock.settimeout(self.TIMEOUT)
+        self.connect_monitor(ip, port + 1 if monitor_port is None else monitor_port)
+        self.start_monitor()
         UpdateStatus(ROBOTCOM_READY)
         return True
 
-    # Send a line to the robot through the communication port (TCP/IP)
-    def send_str(self, msg):
+    # Check that the command connection still works (STATE round trip)
+    def alive(self):
         try:
-            sent = self.sock.send(bytes(msg+'\0','ascii'))
-            if sent == 0:
-                return False
-            return True
-        except ConnectionAbortedError as e:
-            self.CONNECTED = False
-            print(str(e))
+            with self.lock:
+                send_line(self.sock, '1;1;STATE')
+                return self.reader.read() is not None
+        except OSError:
             return False
-    
+
+    # Start the monitor thread of the session (there is only one: a monitor still running is stopped first)
+    def start_monitor(self):
+        self.stop_monitor()
+        self.monitor_stop = threading.Event()
+        self.monitor_thread = self.spawn(monitor_loop(self, self.monitor_stop), "monitor" + self.session.prefix.rstrip())
+
+    def stop_monitor(self):
+        self.monitor_stop.set()
+        self.session.state.wake()
+        t = self.monitor_thread
+        self.monitor_thread = None
+        if t is not None and t is not threading.current_thread():
+            t.join(self.MONITOR_TIMEOUT)
+
+    # Open a second session with the robot for position and state polling
+    # If it is not available, the monitor shares the command connection (polls are then serialized with the commands)
+    def connect_monitor(self, ip, port):
+        self.monreader = self.reader
+        self.monlock = self.lock
+        if not port:
+            return False
+
+        try:
+            self.sockjnts = open_connection((ip, port), self.MONITOR_TIMEOUT, self.KEEPALIVE)
+            reader = FramedReader(self.sockjnts, self.MONITOR_BUFFER_SIZE)
+            send_line(self.sockjnts, '1;1;OPEN=ROBODKMON')
+            read_line(reader)
+        except (OSError, ConnectionAbortedError) as e:
+            print_message("Monitoring connection %s:%i not available (%s), using the command connection" % (ip, port, str(e)))
+            try:
+                self.sockjnts.close()
+            except:
+                pass
+            self.sockjnts = None
+            return False
+
+        self.monreader = reader
+        self.monlock = threading.RLock()
+        return True
+
     # Receive a line from the robot through the communication port (TCP/IP)
+    # Messages are NUL terminated. When commands are pipelined several replies can arrive in the same packet
     def recv_str(self):
-        bdata = b''
         try:
-            bdata = self.sock.recv(self.BUFFER_SIZE)
-            
-        except ConnectionAbortedError as e:
+            msg = self.reader.read()
+
+        except OSError as e:
             self.CONNECTED = False
-            print(str(e))
-            return
-            
-        if bdata == b'':
+            self.lost = True
+            print_message(str(e))
             return None
-        
-        try:
-            self.LAST_MSG = bdata.decode('ascii')
-        except Exception as e:
-            pass
-            
+
+        if msg is None:
+            self.CONNECTED = False
+            self.lost = True
+            return None
+
+        self.LAST_MSG = msg
         return self.LAST_MSG
-    
-    # Run a specific command and provide required parameters   
+
+    # Write the commands at once and read one reply per command. Returns the replies, or None if the connection is broken
+    # Keep the exchange atomic (the motion queue and the monitor share the connection)
+    def exchange(self, cmds):
+        with self.lock:
+            t_send = time.perf_counter()
+            try:
+                self.sock.sendall(b''.join(bytes(cmd + '\0', 'ascii') for cmd in cmds))
+            except OSError as e:
+                self.CONNECTED = False
+                self.lost = True
+                print_message(str(e))
+                print_message("Robot connection broken")
+                UpdateStatus(ROBOTCOM_NOT_CONNECTED_BRS)
+                return None
+
+            try:
+                replies, t_replies = read_lines(self.reader, len(cmds))
+            except OSError as e:
+                self.CONNECTED = False
+                self.lost = True
+                print_message(str(e))
+                print_message("Robot connection broken")
+                UpdateStatus(ROBOTCOM_NOT_CONNECTED_BRR)
+                return None
+            self.LAST_MSG = replies[-1]
+            METRICS.exchange(self.session.id, cmds, replies, t_send, t_replies)
+            trace_exchange(cmds, t_send, t_replies)
+            return replies
+
+    # Same as exchange through the monitoring connection. Raises OSError if the connection is broken
+    def monitor_exchange(self, cmds):
+        with self.monlock:
+            self.monreader.sock.sendall(b''.join(bytes(cmd + '\0', 'ascii') for cmd in cmds))
+            return read_lines(self.monreader, len(cmds))[0]
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    # Sleep between two polls of the monitor (a disconnection sets stop)
+    def monitor_sleep(self, seconds, stop):
+        stop.wait(seconds)
+
+    # Wait until predicate() is True (checked with cond held, each time cond is notified). Returns the last value of predicate()
+    def wait_for(self, cond, predicate, timeout=None):
+        with cond:
+            return cond.wait_for(predicate, timeout)
+
+    # Wake up the threads waiting for the state or the inputs so that they check their condition again
+    def wake(self):
+        self.session.state.wake()
+        self.session.io.wake()
+
+    # Run a generator of operations in a daemon thread
+    def spawn(self, ops, name):
+        thread = threading.Thread(target=run_sync, args=(ops,), name=name)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    # Blocking versions of the controller operations (see RobotProtocol)
     def Run(self, cmd, send_ready=True):
-        # Skip the command if the robot is not connected
-        global STATUS
-        if (not self.CONNECTED) or (ok2SendCmd() == False):
-            UpdateStatus(ROBOTCOM_NOT_CONNECTED)
-            return False
-            
-        #---------- Send robot command -------
-        # notify RoboDK
-        #print('sending: %s' % cmd)
-        #if not ("JPOSF" in cmd):
-        #    UpdateStatus(ROBOTCOM_WORKING)
-
-        # Try to send the command
-        if self.send_str(cmd) is False:
-            print_message("Robot connection broken")
-            UpdateStatus(ROBOTCOM_NOT_CONNECTED_BRS)
-            return False
+        return run_sync(self.run(cmd))
+
+    def RunBatch(self, cmds):
+        return run_sync(self.run_batch(cmds))
+
+    def UploadProgram(self, prog_lines, prog_name='MRL', load=True):
+        return run_sync(self.upload_program(prog_lines, prog_name, load))
+
+    def StartProgram(self, prog_name):
+        return run_sync(self.start_program(prog_name))
 
-        # Try to receive a response
-        robot_msg = self.recv_str()
-        if self.LAST_MSG is None:
-            print_message("Robot connection broken")
-            UpdateStatus(ROBOTCOM_NOT_CONNECTED_BRR)
+    def RunLibraryProgram(self, name, prog_lines):
+        return run_sync(self.run_library_program(name, prog_lines))
+
+    def InstallResident(self):
+        return run_sync(self.install_resident())
+
+    def MoveResident(self, move_type, targets):
+        return run_sync(self.move_resident(move_type, targets))
+
+    def ReadInputs(self, start, count=16):
+        return run_sync(self.read_inputs(start, count))
+
+    def WriteOutputs(self, start, value, count=16):
+        return run_sync(self.write_outputs(start, value, count))
+
+# Buffered reader that splits the data received through TCP/IP into NUL terminated messages
+# A single recv can return several messages (all of them are kept) or only a part of a message (the rest is awaited)
+class FramedReader:
+    def __init__(self, sock, bufsize=4096, terminator=b'\0'):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.terminator = terminator
+        self.buffer = bytearray()   # Data received after the last complete message
+        self.scanned = 0            # Part of the buffer known not to contain the terminator
+        self.messages = collections.deque()
+
+    # Receive once from the socket and queue the complete messages. Returns False if the connection was closed
+    def fill(self):
+        data = self.sock.recv(self.bufsize)
+        if data == b'':
             return False
-                    
-        try: #This throws an exception on emergency stop
-            if 'Qer' in robot_msg:
-                print("SMS:" + robot_msg)
-                self.send_str("1;1;ERROR")
-                errno = self.recv_str()[3:7]
-                self.send_str("1;1;ERRORMES" + str(errno))
-                print_error(self.recv_str()[3:])
-                return False
-                
-        except Exception as e:
-            pass
-        
-        if "JPOSF" in cmd:
-            # robot response after a GetJoints request
-            jointList = robot_msg.split(";")[1:12:2]
-            for joint in jointList:
-                if "*" in str(joint):
-                    jointList.remove(joint)
-            #For handling scara
-            print_joints(jointList)
-            return True
-        
-        # Any other acknowledge message (assumed to be successful)
-        # By default, we will send the command Ready at every instruction (one Run per instruction in general)
-        #print(robot_msg)
-        #if send_ready:
-            #UpdateStatus(ROBOTCOM_READY)
-        else:
-            # Save the Ready status to send later and notify RoboDK that the instruction was completed
-            global STATUS
-            STATUS = ROBOTCOM_READY
 
+        self.buffer += data
+        start = 0
+        end = self.buffer.find(self.terminator, self.scanned)
+        while end >= 0:
+            if end > start:
+                self.messages.append(self.buffer[start:end].decode('ascii', 'replace'))
+            start = end + len(self.terminator)
+            end = self.buffer.find(self.terminator, start)
+
+        del self.buffer[:start]
+        self.scanned = max(0, len(self.buffer) - len(self.terminator) + 1)
         return True
 
+    # Return the next message (None if the connection was closed)
+    def read(self):
+        while len(self.messages) == 0:
+            if not self.fill():
+                return None
+        return self.messages.popleft()
+
+    # Return the messages available (at most limit), receiving at most once if none are queued
+    # The replies of pipelined commands often arrive in the same packet: they are all returned by one recv
+    def drain(self, limit=None):
+        if len(self.messages) == 0 and not self.fill():
+            return []
+        count = len(self.messages) if limit is None else min(limit, len(self.messages))
+        return [self.messages.popleft() for i in range(count)]
+
+# Receive count messages, as many per recv as available. Returns the messages and the time each one was received
+def read_lines(reader, count):
+    messages = []
+    t_messages = []
+    while len(messages) < count:
+        received = reader.drain(count - len(messages))
+        if len(received) == 0:
+            raise ConnectionAbortedError("Connection closed")
+        messages += received
+        t_messages += [time.perf_counter()] * len(received)
+    return messages, t_messages
+
 # Receives a string through TCP/IP. It reads until if finds NULL character
-def read_line(socket):
-    data = socket.recv(512)
-    s = data.decode("ascii")
+def read_line(reader):
+    s = reader.read()
+    if s is None:
+        raise ConnectionAbortedError("Monitoring connection closed")
     return s
 
 
 def send_line(socket, msg):
-    data = msg.encode("ascii")
+    data = (msg + '\0').encode("ascii")
     socket.sendall(data)
+
+# Bits of the first digit of the STATE word (5th field of the STATE reply)
+STATE_BIT_TEACH     = 0b0001
+STATE_BIT_SERVO     = 0b0010
+STATE_BIT_RUN       = 0b0100
+STATE_BIT_ENABLED   = 0b1000
+
+# Open a TCP connection with keepalive probes, so that a dead link is detected even when no command is sent
+# keepalive is (idle time, interval between probes, number of probes), in seconds
+def open_connection(address, timeout, keepalive=(5, 1, 3)):
+    sock = socket.create_connection(address, timeout)
+    set_keepalive(sock, keepalive)
+    return sock
+
+# Enable the keepalive probes of a connected socket
+def set_keepalive(sock, keepalive):
+    idle, interval, count = keepalive
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+    elif hasattr(socket, 'SIO_KEEPALIVE_VALS') and hasattr(sock, 'ioctl'):
+        # Windows
+        sock.ioctl(socket.SIO_KEEPALIVE_VALS, (1, int(idle*1000), int(interval*1000)))
+
+# Open a TCP connection, retrying with an exponential backoff (from delay_min to delay_max seconds) for up to retry_time seconds
+def connect_backoff(address, timeout, retry_time, keepalive=(5, 1, 3), delay_min=0.05, delay_max=2.0):
+    deadline = time.monotonic() + retry_time
+    delay = delay_min
+    while True:
+        try:
+            return open_connection(address, timeout, keepalive)
+        except OSError:
+            if time.monotonic() + delay > deadline:
+                raise
+        time.sleep(delay)
+        delay = min(2 * delay, delay_max)
     
-def calc_turns_flag(jnts):
-    arrRotationBits = [0] * 14
-    for i in range(0, len(jnts)):
-      arrRotationBits[i] = int(round((jnts[i]+180) // 360))
+# Build the list of commands that (re)writes a robot program and loads it for execution
+# prog_lines is the list of program lines (without the line number)
+def mrl_upload_cmds(prog_lines, prog_name='MRL', load=True):
+    cmds = []
+    cmds.append("1;1;FDEL" + prog_name)
+    cmds.append("1;1;NEW")
+    cmds.append("1;1;LOAD=" + prog_name)
+    for i in range(len(prog_lines)):
+        cmds.append("1;1;EDATA %i %s" % (i + 1, prog_lines[i]))
+    cmds.append("1;1;SAVE")
+    if load:
+        cmds.append("1;1;RSTPRG")
+        cmds.append("1;1;PRGLOAD=" + prog_name)
+        cmds.append("1;1;RSTPRG")
+    return cmds
+
+# Program lines of a joint move
+def mrl_movj_lines(joints, speed, accel):
+    prog = []
+    prog.append("J1=(" + (','.join(format(vi, ".6f") for vi in joints)) + ")")
+    #prog.append("Cnt 1")
+    prog.append('SPD %.3f' % speed)
+    prog.append('ACCEL %.3f' % accel)
+    prog.append('MOV J1')
+    #prog.append('END')
+    return prog
+
+# Program lines of a linear move
+# With a Cartesian target (pose X,Y,Z,A,B,C of the tool and its (config, turns) flags) the move goes to the pose,
+# otherwise to the joint target
+def mrl_movl_lines(joints, speed, accel, tool_str, pose=None, flags=None):
+    prog = []
+    prog.append("Base (0.000,0.000,0.000,0.000,0.000,0.000)")
+    prog.append("Tool (" + tool_str + ")")
+    prog.append('ACCEL %.3f' % accel)
+    prog.append('SPD %.3f' % speed)
+    if pose is not None:
+        prog.append("P1=(" + (','.join(format(vi, ".3f") for vi in pose[0:6])) + ")" + "(%i,%i)" % flags)
+        prog.append('Mvs P1')
+        return prog
+    prog.append("J1=(" + (','.join(format(vi, ".6f") for vi in joints)) + ")")
+    prog.append('Mvs J1')
+    return prog
+
+# Largest differences (mm, deg) between the pose of a linear move given by RoboDK and the pose of the arm model
+# to send the move as a Cartesian target
+KINEMATICS_TOLERANCE = (1.0, 0.5)
 
+# Pose and (config, turns) flags of a linear move to the joints, or (None, None) to move to the joint target
+# The pose is only used if the arm model (KINEMATICS) gives the same pose for the joints with the tool of the session:
+# otherwise the model, the tool or the base of RoboDK don't match the robot
+def cartesian_target(session, joints, pose):
+    model = session.kinematics
+    if model is None or len(pose) < 6:
+        return None, None
+    distance, angle = model.check_pose(joints, pose[:6], session.tool)
+    if distance[0] > KINEMATICS_TOLERANCE[0] or angle[0] > KINEMATICS_TOLERANCE[1]:
+        print_message("Warning: pose differs from the %s model by %.2f mm, %.2f deg, moving to the joint target" % (model.name, distance[0], angle[0]))
+        return None, None
+    return pose[:6], (int(model.config_flags(joints)[0]), int(model.turns_flags(joints)[0]))
+
+# Program lines of a circular move from wayPoint0 through wayPoint1 to wayPoint2
+def mrl_movc_lines(wayPoint0, wayPoint1, wayPoint2, speed, accel, tool_str):
+    prog = []
+    prog.append("Base (0.000,0.000,0.000,0.000,0.000,0.000)")
+    prog.append("Tool (" + tool_str + ")")
+    prog.append('ACCEL %.3f' % accel)
+    prog.append('SPD %.3f' % speed)
+    prog.append("J1=(" + (','.join(format(vi, ".6f") for vi in wayPoint0)) + ")")
+    prog.append("J2=(" + (','.join(format(vi, ".6f") for vi in wayPoint1)) + ")")
+    prog.append("J3=(" + (','.join(format(vi, ".6f") for vi in wayPoint2)) + ")")
+    prog.append('Mvr J1, J2, J3')
+    return prog
+
+# Build the program lines of a window of blended moves
+# steps is a list of (move_type, targets, speed, accel, rounding). Circular moves start at the previous target (start_joints for the first move)
+def mrl_blend_lines(steps, start_joints, tool_str):
+    prog = []
+    if any(step[0] != MOVE_JOINT for step in steps):
+        prog.append("Base (0.000,0.000,0.000,0.000,0.000,0.000)")
+        prog.append("Tool (" + tool_str + ")")
+
+    speed = accel = rounding = None
+    last = start_joints
+    jn = 0
+    for move_type, targets, step_speed, step_accel, step_rounding in steps:
+        if step_accel != accel:
+            accel = step_accel
+            prog.append('ACCEL %.3f' % accel)
+        if step_speed != speed:
+            speed = step_speed
+            prog.append('SPD %.3f' % speed)
+        if step_rounding != rounding:
+            rounding = step_rounding
+            if rounding > 0:
+                prog.append('Cnt 1,%.3f,%.3f' % (rounding, rounding))
+            else:
+                prog.append('Cnt 0')
+
+        points = targets
+        if move_type == MOVE_CIRCULAR:
+            points = [last if last is not None else targets[0]] + targets
+
+        names = []
+        for point in points:
+            jn += 1
+            prog.append("J%i=(" % jn + (','.join(format(vi, ".6f") for vi in point)) + ")")
+            names.append("J%i" % jn)
+
+        if move_type == MOVE_LINEAR:
+            prog.append('Mvs ' + names[0])
+        elif move_type == MOVE_CIRCULAR:
+            prog.append('Mvr ' + ', '.join(names))
+        else:
+            prog.append('MOV ' + names[0])
+        last = targets[-1]
+
+    if rounding > 0:
+        prog.append('Cnt 0')
+    return prog
+
+# Move types understood by the resident motion program (variable M_03)
+MOVE_JOINT    = 0
+MOVE_LINEAR   = 1
+MOVE_CIRCULAR = 2
+
+# Resident motion program: J_01 is the target, J_02 and J_03 are the via and start points of circular moves
+RESIDENT_PROG_LINES = [
+    "Base (0.000,0.000,0.000,0.000,0.000,0.000)",
+    "Spd M_01",
+    "Accel M_02,M_02",
+    "If M_03=0 Then Mov J_01",
+    "If M_03=1 Then Mvs J_01",
+    "If M_03=2 Then Mvr J_03,J_02,J_01",
+]
+
+# Multiple rotation flag (FL2): 4 bits per joint with the number of turns of the joint (-180 < angle <= 180 is turn 0),
+# negative turns in two's complement. The flag is computed by mitsubishi_kinematics.turns_flags when it is available
+def calc_turns_flag(jnts):
+    if mitsubishi_kinematics is not None:
+        return int(mitsubishi_kinematics.turns_flags(jnts)[0])
     finalNumber = 0
     for i in range(0, len(jnts)):
-      finalNumber += arrRotationBits[i] << (4*i)
-    #print("Final number" + str(finalNumber))
+      # ceil((j - 180)/360)
+      finalNumber += (-int((180.0 - jnts[i]) // 360) & 0xF) << (4*i)
     return finalNumber
 
-# Specific thread to monitor robot communication
+# Time to wait before the next position/state poll (seconds)
+# remaining is the distance to the target and speed the current joint speed (deg and deg/s).
+# Polls are sparse at the start of a long move and dense near the predicted end of the move.
+def poll_interval(remaining, speed, poll_min, poll_max):
+    if speed <= 1e-3:
+        # Starting or about to stop
+        return poll_min if remaining < 1.0 else poll_max
+    return min(poll_max, max(poll_min, 0.5 * remaining / speed))
+
+#----------- move duration -------------
+# The duration of a move is predicted from the length of its path, its acceleration (%) and its speed
+#   duration = c0*100/accel + c1*distance/speed
+# Joint moves are measured in joint space: largest joint displacement (deg) against the joint override (JOVRD, %).
+# Linear and circular moves are measured along the TCP path (mm) against the linear speed (mm/s) when the arm model
+# is set (KINEMATICS), otherwise in joint space against the joint override as the joint moves.
+# c0 (acceleration time) and c1 (time per unit of distance/speed) are fitted for each move type and kind of distance with the
+# durations measured by the monitor (recursive least squares, older moves are slowly forgotten).
+# Once a move type is calibrated the monitor polls at POLL_MAX until the predicted end of the move and then at POLL_MIN.
+# The ETA of each move is shown to RoboDK.
+ESTIMATE_PRIORS = {
+    (MOVE_JOINT, False):        (0.05, 1.0 / 180.0),
+    (MOVE_LINEAR, False):       (0.05, 1.0 / 180.0),
+    (MOVE_CIRCULAR, False):     (0.05, 1.0 / 180.0),
+    (MOVE_LINEAR, True):        (0.05, 1.0),
+    (MOVE_CIRCULAR, True):      (0.05, 1.0),
+}
+
+# Predicted duration of a move (seconds) and the values it was computed from
+# cartesian is True if the move was measured along the TCP path
+class MovePlan:
+    __slots__ = ('move_type', 'cartesian', 'features', 'duration')
+
+    def __init__(self, move_type, cartesian, features, duration):
+        self.move_type = move_type
+        self.cartesian = cartesian
+        self.features = features
+        self.duration = duration
+
+# Length (mm) of the TCP path of a linear or circular move through the joint targets path (start, [via,] end)
+# model is the arm model (mitsubishi_kinematics) and tool the tool pose. A circular move follows the circle through the
+# three points: its length is R*(2*pi - 2*b), b being the angle at the via point (R = chord/(2*sin b))
+def tcp_path_length(model, move_type, path, tool=None):
+    points = model.pose(path, tool)[:, :3]
+    if move_type == MOVE_CIRCULAR and len(points) == 3:
+        u = points[0] - points[1]
+        v = points[2] - points[1]
+        nu, nv = numpy.linalg.norm(u), numpy.linalg.norm(v)
+        sin_b = numpy.linalg.norm(numpy.cross(u, v)) / max(nu*nv, 1e-12)
+        if sin_b > 1e-6:
+            b = numpy.arccos(numpy.clip(numpy.dot(u, v) / (nu*nv), -1.0, 1.0))
+            radius = numpy.linalg.norm(points[2] - points[0]) / (2.0*sin_b)
+            return float(radius*(2.0*numpy.pi - 2.0*b))
+        # Aligned points: straight line
+    return float(numpy.linalg.norm(numpy.diff(points, axis=0), axis=1).sum())
+
+class DurationModel:
+    def __init__(self, prior):
+        self.c = list(prior)
+        self.p = [[1.0, 0.0], [0.0, 1.0]] # covariance of c
+        self.moves = 0                  # moves measured
+        self.error = 0.0                # average prediction error (seconds)
+
+    def predict(self, x):
+        return max(0.0, self.c[0]*x[0] + self.c[1]*x[1])
+
+    def update(self, x, duration, forget):
+        p = self.p
+        px = [p[0][0]*x[0] + p[0][1]*x[1], p[1][0]*x[0] + p[1][1]*x[1]]
+        gain = forget + x[0]*px[0] + x[1]*px[1]
+        k = [px[0]/gain, px[1]/gain]
+        e = duration - (self.c[0]*x[0] + self.c[1]*x[1])
+        self.c = [self.c[0] + k[0]*e, self.c[1] + k[1]*e]
+        self.p = [[(p[i][j] - k[i]*px[j])/forget for j in range(2)] for i in range(2)]
+        self.error = abs(e) if self.moves == 0 else 0.8*self.error + 0.2*abs(e)
+        self.moves += 1
+
+class MoveEstimator:
+    FORGET = 0.98       # weight of the previous moves at each new measure
+    MIN_MOVES = 3       # moves measured before the prediction is used to schedule the polls
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = dict((key, DurationModel(prior)) for key, prior in ESTIMATE_PRIORS.items())
+
+    # Plan of a move along path (joint targets, starting at the current target), or None if the start is unknown
+    # kinematics is the arm model of the robot (None if it is not set) and tool the tool pose
+    def plan(self, move_type, path, speed_mms, jovrd, accel, kinematics=None, tool=None):
+        if path[0] is None:
+            return None
+        cartesian = move_type != MOVE_JOINT and kinematics is not None
+        if cartesian:
+            distance = tcp_path_length(kinematics, move_type, path, tool)
+            speed = speed_mms
+        else:
+            distance = sum(joints_error(path[i], path[i + 1]) for i in range(len(path) - 1))
+            speed = jovrd / 100.0
+        x = (100.0 / max(accel, 1.0), distance / max(speed, 1e-3))
+        with self.lock:
+            return MovePlan(move_type, cartesian, x, self.models[(move_type, cartesian)].predict(x))
+
+    def model(self, plan):
+        return self.models[(plan.move_type, plan.cartesian)]
+
+    # Calibrate with the measured duration of a move
+    def update(self, plan, duration):
+        with self.lock:
+            self.model(plan).update(plan.features, duration, self.FORGET)
+
+    def ready(self, plan):
+        return self.model(plan).moves >= self.MIN_MOVES
+
+    # Time before the predicted end of the move when the polls get dense
+    def margin(self, plan, poll_min):
+        return 2.0*self.model(plan).error + poll_min
+
+    def summary(self):
+        lines = []
+        with self.lock:
+            for move_type, name in ((MOVE_JOINT, "joint"), (MOVE_LINEAR, "linear"), (MOVE_CIRCULAR, "circular")):
+                for cartesian in (False, True):
+                    model = self.models.get((move_type, cartesian))
+                    if model is not None and model.moves > 0:
+                        lines.append("%s moves%s: %i measured, error %.1f ms (%.3f s + %.4f s per distance/speed)" % (name, " (TCP path)" if cartesian else "", model.moves, 1000*model.error, model.c[0], model.c[1]))
+        return lines
+
+# Time to wait before the next poll when the end of the move is predicted (remaining: time to the predicted end minus the margin)
+def eta_poll_interval(remaining, poll_min, poll_max):
+    return min(poll_max, max(poll_min, remaining))
+
+# Specific thread to monitor robot communication (a task with the asyncio engine), until stop is set
 # This thread establishes a permanent link between the robot and the PC to retrieve the robot position at all times
 # The robot position is displayed only when the robot is executing a motion command
 # When the communication link is broken it will notify the user
-def robot_monitor(q, socket):
-    global ROBOT_MOVING
-    global ROBOT_AXIS_COUNT
+def monitor_loop(com, stop):
+    session = com.session
+    set_session(session)
+    moving = False          # ROBOT_MOVING seen at the previous iteration
+    j_prev = None           # Joints and time of the previous sample, to estimate the joint speed
+    t_prev = None
+    t_running = None        # Time of the last reply that reported the program running
     try:
-        while True:
-            if (ROBOT_MOVING == True):
-                send_line(socket, "1;1;JPOSF")
-                response = read_line(socket)
+        while not stop.is_set():
+            if (session.moving == True):
+                if not moving:
+                    # New move
+                    moving = True
+                    j_prev = None
+                    t_running = time.perf_counter()
+
+                # Request joints and state at once, the replies come back in order
+                t_poll = time.perf_counter()
+                response, reply = yield com.monitor_exchange(["1;1;JPOSF", "1;1;STATE"])
+                t_reply = time.perf_counter()
+                METRICS.observe('mitsubishi_monitor_poll_seconds', t_reply - t_poll, robot=session.id)
+                TRACE.complete('poll', 'monitor', t_poll, t_reply)
                 robot_msg = response.split(';')
                 #Check for empty message
                 if (len(robot_msg) < 4):
+                    yield com.monitor_sleep(com.POLL_MIN, stop)
                     continue
                 
                 #bdata = socket.recv(512)
@@ -287,19 +1110,16 @@ def robot_monitor(q, socket):
                 #    print_message("Invalid monitoring response")
                 #    return                
                 #robot_msg = bdata.decode('ascii')
-                joints_str = robot_msg[1:(ROBOT_AXIS_COUNT*2):2]
-                for joint in joints_str:
-                    if "*" in str(joint):
-                        joints_str.remove(joint)
-
-                print_joints(joints_str, True)
-                time.sleep(0.05) # Don't overload the poor robot
+                joints = parse_joints(response, session.axis_count)
+                print_joints(joints, True)
                 #Check if robot is done moving
-                send_line(socket, "1;1;STATE")
-                reply = read_line(socket)
-                
                 response = reply.split(";") # reply is the return string for the command
-                value = response[4]
+                value = response[4].strip()
+                state_word = parse_state_word(value)
+                session.telemetry.append(time.time(), joints, state_word, session.state.move_id)
+                session.feed.publish(joints, state_word)
+                if session.io.due():
+                    yield from refresh_io(com)
                  
                 #if int(value[0], 16) & 0b0001 == 0b0001:  # 1. bit is the teach mode bit
                     #status.teaching_mode = True
@@ -310,19 +1130,33 @@ def robot_monitor(q, socket):
                 #    print("SMS:" + str(i) + ":" +bin(int(value,16))[i])
 
 
-                if int(value[0], 16) & 0b0100 == 0b0100:  # 3. bit is the RUN/STOP bit #This only works if you want the robot to come to a full stop
+                if parse_state_word(value[:1]) & 0b0100 == 0b0100:  # 3. bit is the RUN/STOP bit #This only works if you want the robot to come to a full stop
                 #if (int(value[0], 16) & 0b0100 == 0b0100) or (bin(int(value,16))[8+7] == 0):  #Use Operation Disable/Enable instead 
-                    pass
+                    t_running = t_reply
+                    speed = 0.0
+                    if j_prev is not None and t_reply > t_prev:
+                        speed = joints_error(joints, j_prev) / (t_reply - t_prev)
+                    j_prev = joints
+                    t_prev = t_reply
+                    # Don't overload the poor robot: poll sparsely while far from the target (or from the predicted end)
+                    yield com.monitor_sleep(session.poll_interval(com, joints, speed, t_reply), stop)
                 else:
-                    global MOV_LAST_J
-                    if joints_error(MOV_LAST_J, joints_str) < 4.0:
-                        str_jnts = [str(x) for x in MOV_LAST_J]
-                        print_joints(str_jnts, True)
+                    if session.last_j is None:
+                        # Program run with RUNPROG: the target is where the program stopped
+                        session.last_j = session.last_j_nominal = joints
+                    if joints_error(session.last_j, joints) < 4.0:
+                        print_joints(session.last_j, True)
+                        session.move_finished(0.5*(t_running + t_reply))
                     else:
-                        print_message("SMS:Warning: Error moving robot: " + str(joints_str))   
-                        
-                    ROBOT_MOVING = False
-                    if (ok2SendCmd() == True):
+                        print_message("SMS:Warning: Error moving robot: " + str(list(joints)))   
+
+                    # The move ended between the last reply that reported it running and this one
+                    com.detect_latency.append(t_reply - t_running)
+                    METRICS.observe('mitsubishi_end_of_move_detection_seconds', t_reply - t_running, robot=session.id)
+                    TRACE.complete('end of move detection', 'monitor', t_running, t_reply)
+                    moving = False
+                    session.state.motion_done()
+                    if (ok2SendCmd() == True) and len(session.queue.items) == 0:
                         # Make sure we flush all monitoring            
                         UpdateStatus(ROBOTCOM_READY)
                     #print("Done")
@@ -349,8 +1183,21 @@ def robot_monitor(q, socket):
                 #    print(robot_msg)
                 #    print_message("Unknown monitoring response")
                 #    return
+
+            else:
+                # Sleep until the next move (or the end of the session), reading the watched inputs when they are due
+                moving = False
+                yield com.wait_for(session.state.cond, lambda: session.moving or stop.is_set() or session.io.due(), session.io.timeout())
+                if session.io.due() and not stop.is_set():
+                    yield from refresh_io(com)
                 
     except Exception as e:
+        if not stop.is_set():
+            # Errors after a disconnect are expected (the connection is closed)
+            if isinstance(e, OSError):
+                # Reconnect at the next command
+                com.CONNECTED = False
+                com.lost = True
             e_str = str(e)
             print_error(e_str)
         
@@ -361,37 +1208,1209 @@ def print_error(e_str):
         print_message("Do you have the program open?")
     
     UpdateStatus(ROBOTCOM_UNKNOWN)
-        
-#-----------------------------------------------------------------------------
-#-----------------------------------------------------------------------------
-# Generic RoboDK driver for a specific Robot class
-global ROBOT
-global ROBOT_IP
-global ROBOT_PORT
-global ROBOT_MOVING
-global ROBOT_TOOL_STR
 
+#----------- error catalog -------------
+# A failing command replies Qer<error number>. The text of the error (ERRORMES<n>) only depends on the controller model,
+# so it is requested from the controller the first time an error number is seen and then kept in a catalog
+# ({model: {error number: message}}) saved as JSON next to the driver. A known error costs no extra round trip.
+# ERROR is only requested when the reply does not hold the error number.
+ERRORS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mitsubishi_errors.json')
 
-ROBOT = RobotCom()
-ROBOT_IP = "127.0.0.1"      # IP of the robot
-ROBOT_PORT = 10000          # Communication port of the robot
-ROBOT_AXIS_COUNT = 6
-ROBOT_MOVING = False
-ROBOT_TOOL_STR = '0.000,0.000,0.000,0.000,0.000,0.000'
+# Data of a JSON file ({} if the file does not exist or can't be read)
+def read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
+# Write a JSON file (to a temporary file first, so that a crash does not leave a partial file)
+def write_json(path, data):
+    tmp = path + '.tmp'
+    try:
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except OSError as e:
+        print_message("Unable to save %s: %s" % (path, str(e)))
 
-#------------ robot connection -----------------
-# Establish connection with the robot
-def RobotConnect():
-    global ROBOT
-    global ROBOT_IP
-    global ROBOT_PORT
-    ROBOT.connect(ROBOT_IP, ROBOT_PORT)
-    
-# Disconnect from the robot
+# Error reported by the controller for a command
+# step is the position of the command in its batch (1 for a single command)
+class ControllerError:
+    __slots__ = ('robot', 'model', 'errno', 'message', 'cmd', 'step', 'reply')
+
+    def __init__(self, robot, model, errno, message, cmd, step, reply):
+        self.robot = robot
+        self.model = model
+        self.errno = errno
+        self.message = message
+        self.cmd = cmd
+        self.step = step
+        self.reply = reply
+
+    def __str__(self):
+        return "Error %s at step %i (%s): %s" % (self.errno, self.step, self.cmd, self.message)
+
+# Error number of a Qer reply, or None if the reply does not hold it
+def reply_errno(reply):
+    match = re.search(r'Qer(\d+)', reply or "")
+    return int(match.group(1)) if match else None
+
+# Model of the controller, from the reply to OPEN (QoK<model>)
+def controller_model(reply):
+    return (reply or "")[3:].strip() or 'default'
+
+class ErrorCatalog:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.messages = None # loaded on first use
+
+    def load(self):
+        self.messages = read_json(self.path)
+
+    # Message of an error, or None if the error was never seen on this model
+    def get(self, model, errno):
+        with self.lock:
+            if self.messages is None:
+                self.load()
+            return self.messages.get(model, {}).get(str(errno))
+
+    def put(self, model, errno, message):
+        with self.lock:
+            if self.messages is None:
+                self.load()
+            self.messages.setdefault(model, {})[str(errno)] = message
+            write_json(self.path, self.messages)
+
+ERRORS = ErrorCatalog(ERRORS_FILE)
+
+#----------- program library -------------
+# RUNPROG <program> <id> runs a MELFA BASIC program generated by RoboDK (a file, or a name in PROGRAM_DIR). The program
+# is written to the controller once, in a slot named after the hash of its content (H + 7 hexadecimal digits): running
+# it again only loads and starts the slot. The slots written to each controller are kept in an index saved as JSON
+# next to the driver ({controller: {slot: {name, lines, used}}}). When a new program does not fit in the library
+# (SLOTS programs, LINES lines in total) the least recently used slots are deleted from the controller first.
+# A name that is not a file runs the program of that name already stored on the controller.
+PROGRAMS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mitsubishi_programs.json')
+PROGRAM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'programs')
+PROGRAM_EXTENSIONS = ('', '.prg', '.txt')
+
+# Path of the program file of a RUNPROG command, or None if there is no such file
+def find_program_file(name):
+    for path in (name, os.path.join(PROGRAM_DIR, name)):
+        for ext in PROGRAM_EXTENSIONS:
+            if os.path.isfile(path + ext):
+                return path + ext
+    return None
+
+# Lines of a program file, without line numbers and blank lines
+def read_program_file(path):
+    prog = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = re.sub(r'^\s*\d+\s+', '', line.rstrip())
+            if line.strip():
+                prog.append(line)
+    return prog
+
+# Slot of a program in the library
+def program_slot(prog_lines):
+    return 'H' + hashlib.sha1('\n'.join(prog_lines).encode('utf-8')).hexdigest()[:7].upper()
+
+class ProgramLibrary:
+    SLOTS = 16      # programs kept on each controller
+    LINES = 5000    # lines kept on each controller
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.index = None # loaded on first use
+
+    def slots(self, controller):
+        if self.index is None:
+            self.index = read_json(self.path)
+        return self.index.setdefault(controller, {})
+
+    # Entry of a slot ({name, lines, used}) or None if the program is not on the controller
+    def lookup(self, controller, slot):
+        with self.lock:
+            return self.slots(controller).get(slot)
+
+    # Slots to delete (least recently used first) so that a program of nlines fits in the library
+    def evictions(self, controller, nlines):
+        with self.lock:
+            slots = self.slots(controller)
+            count = len(slots)
+            lines = sum(entry['lines'] for entry in slots.values())
+            evict = []
+            for slot in sorted(slots, key=lambda slot: slots[slot]['used']):
+                if count < self.SLOTS and lines + nlines <= self.LINES:
+                    break
+                evict.append(slot)
+                count -= 1
+                lines -= slots[slot]['lines']
+            return evict
+
+    def add(self, controller, slot, name, nlines):
+        with self.lock:
+            self.slots(controller)[slot] = {'name': name, 'lines': nlines, 'used': time.time()}
+            write_json(self.path, self.index)
+
+    def touch(self, controller, slot):
+        with self.lock:
+            entry = self.slots(controller).get(slot)
+            if entry is not None:
+                entry['used'] = time.time()
+                write_json(self.path, self.index)
+
+    def remove(self, controller, slot):
+        with self.lock:
+            if self.slots(controller).pop(slot, None) is not None:
+                write_json(self.path, self.index)
+
+    # Slots of a controller as (slot, entry), most recently used first
+    def entries(self, controller):
+        with self.lock:
+            slots = self.slots(controller)
+            return sorted(slots.items(), key=lambda item: -item[1]['used'])
+
+PROGRAMS = ProgramLibrary(PROGRAMS_FILE)
+
+#----------- digital I/O -------------
+# Signals are read and written by words of 16 signals: IN<n> and OUT=<n>;<hex> address the 16 signals starting at n.
+# Ranges of inputs can be watched (IOWATCH): the monitor reads them at a set interval, also when the robot is idle, into an
+# image of the inputs. Reads of watched inputs (GETDI) are served from the image without a round trip to the controller,
+# and the changes are passed to the callbacks of the image with (first signal of the word, old value, new value).
+# An input waited for (WAITDI) is read by the monitor the same way until the wait is over.
+IO_WORD = 16
+
+# First signal of the words that hold count signals from start
+def io_words(start, count):
+    return list(range(start, start + max(count, 1), IO_WORD))
+
+# Value of count signals from start, given the words read ({first signal: value})
+def io_join(values, start, count):
+    value = 0
+    for first, word in values.items():
+        value |= word << (first - start)
+    return value & ((1 << count) - 1)
+
+class IOImage:
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.words = {}         # value and time of the last read of each word, by first signal
+        self.watch = []         # first signal of the words watched (IOWATCH)
+        self.interval = 0.05    # time between reads of the watched words (seconds)
+        self.waits = collections.Counter() # inputs waited for (WAITDI)
+        self.wait_interval = 0.02 # time between reads of the inputs waited for (seconds)
+        self.read_words = []    # first signal of the words read by the monitor (watched or waited for)
+        self.period = None      # time between reads (None if no word is read)
+        self.t_refresh = 0.0
+        self.callbacks = []
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    # Read count inputs from start every interval seconds (count 0 to stop watching)
+    def set_watch(self, start, count, interval=None):
+        with self.cond:
+            self.watch = io_words(start, count) if count > 0 else []
+            if interval is not None:
+                self.interval = interval
+            self.t_refresh = 0.0
+            self.update_reads()
+
+    # Read the word that starts at signal until remove_wait
+    def add_wait(self, signal, interval=None):
+        with self.cond:
+            self.waits[signal] += 1
+            if interval is not None:
+                self.wait_interval = interval
+            self.update_reads()
+
+    def remove_wait(self, signal):
+        with self.cond:
+            self.waits[signal] -= 1
+            if self.waits[signal] <= 0:
+                del self.waits[signal]
+            self.update_reads()
+
+    def update_reads(self):
+        self.read_words = sorted(set(self.watch) | set(self.waits))
+        periods = ([self.interval] if self.watch else []) + ([self.wait_interval] if self.waits else [])
+        self.period = min(periods) if periods else None
+
+    # Values older than this are not used
+    def max_age(self):
+        return 2 * (self.period or self.interval)
+
+    def due(self):
+        return self.period is not None and time.perf_counter() - self.t_refresh >= self.period
+
+    # Time until the next read of the inputs (None if no input is read)
+    def timeout(self):
+        if self.period is None:
+            return None
+        return max(0.0, self.t_refresh + self.period - time.perf_counter())
+
+    # Wait until predicate() is True (checked after each read of the inputs and wake). Returns the last value of predicate()
+    def wait_for(self, predicate, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(predicate, timeout)
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    # Store the words read from the robot ({first signal: value})
+    def update(self, values):
+        t = time.perf_counter()
+        changed = []
+        with self.cond:
+            for first, value in values.items():
+                old = self.words.get(first)
+                if old is not None and old[0] != value:
+                    changed.append((first, old[0], value))
+                self.words[first] = (value, t)
+            if set(self.read_words) <= set(values):
+                self.t_refresh = t
+            self.cond.notify_all()
+        for change in changed:
+            for callback in self.callbacks:
+                callback(*change)
+
+    # Value of count signals from start if they are all read by the monitor and recent enough, otherwise None
+    def read(self, start, count=IO_WORD):
+        t_min = time.perf_counter() - self.max_age()
+        value = 0
+        with self.cond:
+            for i in range(count):
+                signal = start + i
+                for first in self.read_words:
+                    word, t = self.words.get(first, (0, 0.0))
+                    if first <= signal < first + IO_WORD and t >= t_min:
+                        value |= ((word >> (signal - first)) & 1) << i
+                        break
+                else:
+                    return None
+        return value
+
+# Read the watched inputs through the monitoring connection of com (all at once)
+def refresh_io(com):
+    session = com.session
+    watch = list(session.io.read_words)
+    t_send = time.perf_counter()
+    replies = yield com.monitor_exchange(["1;1;IN%i" % first for first in watch])
+    TRACE.complete('inputs', 'monitor', t_send, time.perf_counter())
+    session.io.update(dict((first, int(reply[3:7], 16)) for first, reply in zip(watch, replies) if reply.startswith('QoK')))
+    com.wake()
+
+#----------- joint telemetry -------------
+# Each sample of the monitor (time, joints and STATE word) is kept in a ring buffer of fixed size, made of arrays of numbers.
+# The samples can also be recorded to a binary file (append only) and read back with read_telemetry (NumPy).
+TELEMETRY_SIZE = 65536      # samples kept in memory
+TELEMETRY_AXES = 8          # joints per sample (missing joints are NaN)
+TELEMETRY_MAGIC = b'MTLM'
+TELEMETRY_HEADER = struct.Struct('<4sIII')  # magic, version, axes per sample, record size
+TELEMETRY_RECORD = struct.Struct('<d%idII' % TELEMETRY_AXES) # time (s since epoch), joints (deg), STATE word, move id
+
+class TelemetryBuffer:
+    def __init__(self, size=TELEMETRY_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.time = array.array('d', bytes(8 * size))
+        self.joints = array.array('d', bytes(8 * size * TELEMETRY_AXES))
+        self.state = array.array('I', bytes(array.array('I').itemsize * size))
+        self.move = array.array('I', bytes(array.array('I').itemsize * size))
+        self.count = 0              # samples added since the buffer was created
+        self.recording = None       # file the samples are recorded to
+
+    nan_joints = (float('nan'),) * TELEMETRY_AXES
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, t, joints, state, move_id):
+        joints = tuple(joints[:TELEMETRY_AXES]) + self.nan_joints[len(joints):]
+        with self.lock:
+            i = self.count % self.size
+            self.time[i] = t
+            self.joints[i*TELEMETRY_AXES:(i + 1)*TELEMETRY_AXES] = array.array('d', joints)
+            self.state[i] = state
+            self.move[i] = move_id
+            self.count += 1
+            if self.recording is not None:
+                self.recording.write(TELEMETRY_RECORD.pack(t, *(joints + (state, move_id))))
+
+    # Last sample as (time, joints, state, move id) or None
+    def latest(self):
+        with self.lock:
+            if self.count == 0:
+                return None
+            i = (self.count - 1) % self.size
+            return self.time[i], list(self.joints[i*TELEMETRY_AXES:(i + 1)*TELEMETRY_AXES]), self.state[i], self.move[i]
+
+    # Samples in memory as NumPy arrays, oldest first: time (n), joints (n x axes), state (n), move (n)
+    def arrays(self):
+        if numpy is None:
+            raise ImportError("NumPy is required to read the telemetry as arrays")
+        with self.lock:
+            n = len(self)
+            order = numpy.roll(numpy.arange(n), -(self.count % self.size)) if self.count > self.size else numpy.arange(n)
+            t = numpy.frombuffer(self.time, dtype=numpy.float64)[:n][order]
+            joints = numpy.frombuffer(self.joints, dtype=numpy.float64).reshape(self.size, TELEMETRY_AXES)[:n][order]
+            state = numpy.frombuffer(self.state, dtype=numpy.dtype('=u%i' % self.state.itemsize))[:n][order]
+            move = numpy.frombuffer(self.move, dtype=numpy.dtype('=u%i' % self.move.itemsize))[:n][order]
+        return t, joints, state, move
+
+    # Record the next samples at the end of a file (None to stop recording)
+    def record(self, path):
+        with self.lock:
+            if self.recording is not None:
+                self.recording.close()
+                self.recording = None
+            if path is None:
+                return
+            self.recording = open(path, 'ab')
+            if self.recording.tell() == 0:
+                self.recording.write(TELEMETRY_HEADER.pack(TELEMETRY_MAGIC, 1, TELEMETRY_AXES, TELEMETRY_RECORD.size))
+
+    def flush(self):
+        with self.lock:
+            if self.recording is not None:
+                self.recording.flush()
+
+# Read a telemetry recording without copying it (memory map). Returns a NumPy structured array with the fields
+# t (s since epoch), joints (deg, NaN for missing joints), state (STATE word) and move (move id)
+def read_telemetry(path):
+    if numpy is None:
+        raise ImportError("NumPy is required to read telemetry recordings")
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, axes, record_size = TELEMETRY_HEADER.unpack_from(data, 0)
+    if magic != TELEMETRY_MAGIC or version != 1:
+        raise ValueError("%s is not a telemetry recording" % path)
+    dtype = numpy.dtype([('t', '<f8'), ('joints', '<f8', (axes,)), ('state', '<u4'), ('move', '<u4')])
+    if dtype.itemsize != record_size:
+        raise ValueError("Unexpected record size in %s" % path)
+    count = (len(data) - TELEMETRY_HEADER.size) // record_size # a partly written last record is ignored
+    return numpy.frombuffer(data, dtype=dtype, count=count, offset=TELEMETRY_HEADER.size)
+
+#----------- live feed -------------
+# The last joints, STATE word, status and move id of a robot are published in a small shared memory segment (LIVEFEED command)
+# so that local programs (dashboards, read_live_feed) can follow the robot at any rate without sending requests to the controller.
+# On Windows the segment is a named shared memory (MemoryMappedFile.OpenExisting(name) in .NET), elsewhere a file in /dev/shm.
+#
+# Layout (little endian, fixed size):
+#   0   header: magic 'MLIV', version, axes per sample, record size
+#   16  sequence counter (uint64): odd while the record is being written
+#   24  record: time (s since epoch), joints (deg, NaN for missing joints), STATE word, move id, status (ROBOTCOM_...), state
+# Readers read the counter, the record, then the counter again, and retry if the counter was odd or changed.
+LIVE_MAGIC = b'MLIV'
+LIVE_HEADER = struct.Struct('<4sIII')   # magic, version, axes per sample, record size
+LIVE_SEQ = struct.Struct('<Q')
+LIVE_SEQ_OFFSET = 16
+LIVE_RECORD = struct.Struct('<d%idIIiI' % TELEMETRY_AXES) # time, joints, STATE word, move id, status, state (index in LIVE_STATES)
+LIVE_RECORD_OFFSET = 24
+LIVE_SIZE = LIVE_RECORD_OFFSET + LIVE_RECORD.size
+
+# Location of a live feed segment on this system
+def live_feed_path(name):
+    if sys.platform == 'win32' or os.path.dirname(name):
+        return name
+    if os.path.isdir('/dev/shm'):
+        return os.path.join('/dev/shm', name)
+    return os.path.join(tempfile.gettempdir(), name)
+
+class LiveFeed:
+    def __init__(self, session):
+        self.session = session
+        self.lock = threading.Lock()
+        self.name = None
+        self.map = None
+        self.seq = 0
+        self.joints = TelemetryBuffer.nan_joints
+        self.state_word = 0
+        session.state.add_callback(self.state_changed)
+
+    # Publish to the segment name (None to stop publishing)
+    def open(self, name):
+        with self.lock:
+            self.close_map()
+            if name is None:
+                return
+            if sys.platform == 'win32':
+                self.map = mmap.mmap(-1, LIVE_SIZE, tagname=name)
+            else:
+                with open(live_feed_path(name), 'w+b') as f:
+                    f.truncate(LIVE_SIZE)
+                    self.map = mmap.mmap(f.fileno(), LIVE_SIZE)
+            self.name = name
+            self.seq = 0
+            LIVE_HEADER.pack_into(self.map, 0, LIVE_MAGIC, 1, TELEMETRY_AXES, LIVE_RECORD.size)
+        self.publish()
+
+    def close(self):
+        with self.lock:
+            self.close_map()
+
+    def close_map(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+            if sys.platform != 'win32':
+                # Readers that still have the segment mapped keep the last record
+                try:
+                    os.remove(live_feed_path(self.name))
+                except OSError:
+                    pass
+            self.name = None
+
+    # Update the segment, with a new sample of the monitor if joints are provided
+    def publish(self, joints=None, state_word=None):
+        if self.map is None:
+            return
+        session = self.session
+        with self.lock:
+            if self.map is None:
+                return
+            if joints is not None:
+                self.joints = tuple(joints[:TELEMETRY_AXES]) + TelemetryBuffer.nan_joints[len(joints):]
+            if state_word is not None:
+                self.state_word = state_word
+            self.seq += 1
+            LIVE_SEQ.pack_into(self.map, LIVE_SEQ_OFFSET, self.seq)
+            LIVE_RECORD.pack_into(self.map, LIVE_RECORD_OFFSET, time.time(), *(self.joints + (self.state_word, session.state.move_id, session.status, LIVE_STATES.index(session.state.state))))
+            self.seq += 1
+            LIVE_SEQ.pack_into(self.map, LIVE_SEQ_OFFSET, self.seq)
+
+    def state_changed(self, old, new):
+        self.publish()
+
+# Read the last record of a live feed: dict with the keys seq, t, joints, state_word, move, status and state
+def read_live_feed(name, retries=100):
+    if sys.platform == 'win32':
+        data = mmap.mmap(-1, LIVE_SIZE, tagname=name, access=mmap.ACCESS_READ)
+    else:
+        with open(live_feed_path(name), 'rb') as f:
+            data = mmap.mmap(f.fileno(), LIVE_SIZE, access=mmap.ACCESS_READ)
+    try:
+        magic, version, axes, record_size = LIVE_HEADER.unpack_from(data, 0)
+        if magic != LIVE_MAGIC or version != 1 or record_size != LIVE_RECORD.size:
+            raise ValueError("%s is not a live feed" % name)
+        for i in range(retries):
+            seq = LIVE_SEQ.unpack_from(data, LIVE_SEQ_OFFSET)[0]
+            record = LIVE_RECORD.unpack_from(data, LIVE_RECORD_OFFSET)
+            if seq % 2 == 0 and LIVE_SEQ.unpack_from(data, LIVE_SEQ_OFFSET)[0] == seq:
+                break
+        else:
+            raise IOError("Live feed %s is not stable" % name)
+    finally:
+        data.close()
+    return {'seq': seq, 't': record[0], 'joints': list(record[1:1 + axes]), 'state_word': record[1 + axes],
+            'move': record[2 + axes], 'status': record[3 + axes], 'state': LIVE_STATES[record[4 + axes]]}
+
+#----------- metrics -------------
+# Counters and latency histograms of the driver, by robot and verb: commands sent to the controller, driver commands,
+# moves, monitor polls and end of move detection. STATS displays them and STATS <port> (or --metrics <port>)
+# serves them in the Prometheus text format on http://127.0.0.1:<port>/metrics
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0) # seconds
+
+METRICS_HELP = collections.OrderedDict([
+    ('mitsubishi_controller_command_seconds', ('histogram', 'Time to get the reply of a controller command')),
+    ('mitsubishi_controller_errors_total', ('counter', 'Controller commands that failed (Qer)')),
+    ('mitsubishi_error_catalog_total', ('counter', 'Errors reported, with the message found in the error catalog (hit) or requested from the controller (miss)')),
+    ('mitsubishi_driver_command_seconds', ('histogram', 'Time to execute a driver command (RoboDK protocol)')),
+    ('mitsubishi_move_seconds', ('histogram', 'Duration of the moves, from the start of the move to the end detected by the monitor')),
+    ('mitsubishi_move_eta_error_seconds', ('histogram', 'Difference between the predicted and the measured duration of the moves')),
+    ('mitsubishi_monitor_poll_seconds', ('histogram', 'Round trip of the monitor polls (JPOSF and STATE)')),
+    ('mitsubishi_end_of_move_detection_seconds', ('histogram', 'Time between the last poll that reported the robot running and the poll that found it stopped')),
+    ('mitsubishi_input_reads_total', ('counter', 'Input reads (GETDI), served from the input image (hit) or by the controller (miss)')),
+    ('mitsubishi_input_wait_seconds', ('histogram', 'Time spent waiting for an input (WAITDI), by result (ok, timeout or stopped)')),
+])
+
+# Controller commands are measured by verb (any other command is counted as OTHER)
+CONTROLLER_VERBS = ('OPEN', 'CLOSE', 'RSTALRM', 'CNTLON', 'CNTLOFF', 'SRVON', 'SRVOFF', 'STATE', 'JPOSF', 'JOVRD',
+                    'ERRORMES', 'ERROR', 'EXECTOOL', 'FDEL', 'NEW', 'LOAD', 'EDATA', 'SAVE', 'RSTPRG', 'PRGLOAD',
+                    'RUN', 'STOP', 'VAL', 'OUT', 'IN')
+
+def controller_verb(cmd):
+    body = cmd.split(';', 2)[-1].upper()
+    for verb in CONTROLLER_VERBS:
+        if body.startswith(verb):
+            return verb
+    return 'OTHER'
+
+class Histogram:
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last count is above the last bucket
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # Upper bound of the bucket that holds the quantile q
+    def quantile(self, q):
+        total = 0
+        for i in range(len(self.counts)):
+            total += self.counts[i]
+            if total >= q * self.count:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = collections.OrderedDict() # (name, labels) -> Histogram
+        self.counters = collections.OrderedDict()   # (name, labels) -> count
+        self.server = None
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, n=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    # Record the replies of controller commands sent at once (t_send) and received at the times t_replies
+    # Each command is measured from the previous reply: with pipelined commands this is the time the controller spent on it
+    def exchange(self, robot, cmds, replies, t_send, t_replies):
+        t_prev = t_send
+        for cmd, reply, t in zip(cmds, replies, t_replies):
+            verb = controller_verb(cmd)
+            self.observe('mitsubishi_controller_command_seconds', t - t_prev, robot=robot, verb=verb)
+            if 'Qer' in reply:
+                self.count('mitsubishi_controller_errors_total', robot=robot, verb=verb)
+            t_prev = t
+
+    def reset(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    # Summary of the metrics, one line per series
+    def summary(self):
+        lines = []
+        with self.lock:
+            for (name, labels), h in self.histograms.items():
+                lines.append("%s: %i, avg %.1f ms, p50 <= %.1f ms, p95 <= %.1f ms, max %.1f ms" % (series_name(name, labels),
+                             h.count, 1000*h.sum/h.count, 1000*h.quantile(0.5), 1000*h.quantile(0.95), 1000*h.max))
+            for (name, labels), n in self.counters.items():
+                lines.append("%s: %i" % (series_name(name, labels), n))
+            # Poll rate of the monitor while the robots move
+            for (name, labels), h in self.histograms.items():
+                moves = self.histograms.get(('mitsubishi_move_seconds', labels))
+                if name == 'mitsubishi_monitor_poll_seconds' and moves is not None and moves.sum > 0:
+                    lines.append("%s: %.1f polls/s while moving" % (series_name('mitsubishi_monitor_poll_rate', labels), h.count / moves.sum))
+        return lines
+
+    # Metrics in the Prometheus text format
+    def prometheus(self):
+        out = []
+        with self.lock:
+            for name, (kind, text) in METRICS_HELP.items():
+                out.append("# HELP %s %s" % (name, text))
+                out.append("# TYPE %s %s" % (name, kind))
+                for (series, labels), h in self.histograms.items():
+                    if series != name:
+                        continue
+                    total = 0
+                    for i in range(len(h.buckets)):
+                        total += h.counts[i]
+                        out.append('%s_bucket{%s} %i' % (name, prometheus_labels(labels + (('le', repr(h.buckets[i])),)), total))
+                    out.append('%s_bucket{%s} %i' % (name, prometheus_labels(labels + (('le', '+Inf'),)), h.count))
+                    out.append('%s_sum{%s} %r' % (name, prometheus_labels(labels), h.sum))
+                    out.append('%s_count{%s} %i' % (name, prometheus_labels(labels), h.count))
+                for (series, labels), n in self.counters.items():
+                    if series == name:
+                        out.append('%s{%s} %i' % (name, prometheus_labels(labels), n))
+        return '\n'.join(out) + '\n'
+
+    # Serve the metrics on http://127.0.0.1:port/metrics (port 0 stops the server)
+    def serve(self, port):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if not port:
+            return None
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self.server.server_address[1]
+
+def series_name(name, labels):
+    return ' '.join([name] + ['%s=%s' % kv for kv in labels if kv[1] != ''])
+
+def prometheus_labels(labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = METRICS.prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # STDOUT is reserved for RoboDK and STDERR would fill up with requests
+        pass
+
+METRICS = Metrics()
+
+#----------- tracing -------------
+# Timeline of the driver activity (driver commands, controller round trips, monitor polls, moves and state changes).
+# While tracing is on (TRACE <file> or --trace <file>) the events are kept in memory with their thread and monotonic time.
+# They are saved in the Chrome trace event format (chrome://tracing or https://ui.perfetto.dev) by TRACE SAVE, TRACE OFF or QUIT.
+# When tracing is off span() returns a shared object that does nothing.
+TRACE_SIZE = 200000 # events kept in memory (the oldest events are dropped)
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class TraceSpan:
+    __slots__ = ('tracer', 'name', 'cat', 'args', 't_start')
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.t_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.tracer.complete(self.name, self.cat, self.t_start, time.perf_counter(), self.args)
+        return False
+
+class Tracer:
+    def __init__(self, size=TRACE_SIZE):
+        self.enabled = False
+        self.path = None        # file the trace is saved to
+        self.events = collections.deque(maxlen=size)
+        self.threads = {}       # names of the threads, by id
+
+    def start(self, path):
+        self.path = path
+        self.events.clear()
+        self.enabled = True
+
+    def stop(self):
+        self.enabled = False
+
+    # Time the code in a with block
+    def span(self, name, cat, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return TraceSpan(self, name, cat, args)
+
+    # Event that lasted from t_start to t_end (time.perf_counter)
+    def complete(self, name, cat, t_start, t_end, args=None):
+        if self.enabled:
+            self.add('X', name, cat, t_start, args, t_end - t_start)
+
+    def instant(self, name, cat, **args):
+        if self.enabled:
+            self.add('i', name, cat, time.perf_counter(), args)
+
+    # Event that starts and ends in different places (or threads), identified by event_id
+    def begin(self, name, cat, event_id, **args):
+        if self.enabled:
+            self.add('b', name, cat, time.perf_counter(), args, event_id=event_id)
+
+    def end(self, name, cat, event_id):
+        if self.enabled:
+            self.add('e', name, cat, time.perf_counter(), event_id=event_id)
+
+    def add(self, ph, name, cat, t, args=None, duration=None, event_id=None):
+        thread = threading.current_thread()
+        if thread.ident not in self.threads:
+            self.threads[thread.ident] = thread.name
+        self.events.append((ph, name, cat, t, duration, thread.ident, event_id, args))
+
+    # Save the events to a file (Chrome trace event format). Returns the number of events saved
+    def save(self, path=None):
+        path = path or self.path
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}} for tid, name in list(self.threads.items())]
+        for ph, name, cat, t, duration, tid, event_id, args in list(self.events):
+            event = {'name': name, 'cat': cat, 'ph': ph, 'ts': t * 1e6, 'pid': pid, 'tid': tid}
+            if duration is not None:
+                event['dur'] = duration * 1e6
+            if event_id is not None:
+                event['id'] = event_id
+            if ph == 'i':
+                event['s'] = 't'
+            if args:
+                event['args'] = args
+            events.append(event)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        return len(events)
+
+TRACE = Tracer()
+
+# Trace the round trip of controller commands sent at once (see Metrics.exchange)
+def trace_exchange(cmds, t_send, t_replies):
+    if not TRACE.enabled or len(t_replies) == 0:
+        return
+    if len(cmds) > 1:
+        TRACE.complete('batch', 'controller', t_send, t_replies[-1], {'commands': len(cmds)})
+    t_prev = t_send
+    for cmd, t in zip(cmds, t_replies):
+        TRACE.complete(controller_verb(cmd), 'controller', t_prev, t, {'cmd': cmd})
+        t_prev = t
+
+#----------- motion queue -------------
+# When a rounding value is set (SETROUNDING), consecutive MOVJ/MOVL/MOVC commands are acknowledged right away and queued.
+# A window of queued moves is compiled into one program with Cnt blending so the robot does not stop at every waypoint.
+# The next window is written to the robot while the current one is running (two programs are used alternately).
+# Any other command received while the queue is busy is executed in order, once the motion before it is done.
+# Queuing never waits, so that STOP is handled right away: beyond 2*WINDOW pending moves, the acknowledge of a move is
+# sent when the move leaves the queue (RoboDK does not send the next move meanwhile). STOP (clear) drops the pending
+# commands and the window being prepared is not started.
+# The worker runs with the engine of the session: a thread, or an asyncio task with the asyncio driver.
+class MotionQueue:
+    WINDOW = 8          # Maximum number of moves in one program
+    GATHER_TIME = 0.05  # Time to wait for more moves before writing a window (seconds)
+    PROG_NAMES = ('MRLA', 'MRLB')
+
+    def __init__(self, session):
+        self.session = session
+        session.state.add_callback(self.state_changed)
+        self.items = collections.deque() # (linecmd, values, ack), values is None for commands that are not moves
+        self.cond = threading.Condition()
+        self.worker_task = None # Thread (or asyncio task) of the worker
+        self.working = False    # The worker is processing an item
+        self.running = False    # A window started by the queue is being executed
+        self.next_prog = 0
+        self.generation = 0     # Incremented by clear: the commands taken before are dropped
+
+    # True if commands must go through the queue to keep them in order
+    def busy(self):
+        return len(self.items) > 0 or self.working or self.running
+
+    # Number of moves waiting in the queue
+    def pending_moves(self):
+        return sum(1 for item in self.items if item[1] is not None)
+
+    # Add a command to the queue. Moves and settings are acknowledged right away, unless the queue is full (see above)
+    def put(self, linecmd, values=None):
+        ack = values is not None or tokenize(linecmd)[0] in SETTING_COMMANDS
+        with self.cond:
+            deferred = values is not None and self.pending_moves() >= 2*self.WINDOW
+            self.items.append((linecmd, values, deferred))
+            if self.worker_task is None:
+                self.worker_task = self.session.robot.spawn(self.worker(), "queue" + self.session.prefix.rstrip())
+            self.notify()
+
+        if ack and not deferred:
+            UpdateStatus(ROBOTCOM_READY)
+
+    # Take the next command (with cond held, the queue must not be empty). Returns (linecmd, values)
+    def take(self):
+        linecmd, values, deferred = self.items.popleft()
+        self.notify()
+        if deferred:
+            UpdateStatus(ROBOTCOM_READY)
+        return linecmd, values
+
+    # Drop all pending commands (STOP)
+    def clear(self):
+        with self.cond:
+            self.items.clear()
+            self.running = False
+            self.generation += 1
+            self.notify()
+
+    # True if the commands taken at generation must be dropped (STOP or disconnection)
+    def cancelled(self, generation):
+        return self.generation != generation or not self.session.robot.CONNECTED
+
+    # Wake up the worker (with cond held). The asyncio engine does not wait on cond: its waits are woken up as well
+    def notify(self):
+        self.cond.notify_all()
+        self.session.robot.wake()
+
+    # Called when the robot state changes (the robot stops moving)
+    def state_changed(self, old, new):
+        if old == STATE_MOVING:
+            with self.cond:
+                self.running = False
+                self.notify()
+
+    # Apply a queued setting to the following moves (it was acknowledged when it was queued)
+    def apply_setting(self, linecmd):
+        verb, words, values = tokenize(linecmd)
+        if not COMMANDS[verb].accepts(self.session, words, values):
+            OUTPUT.write("Unknown command: " + linecmd.rstrip())
+            return
+        yield from operations(SETTING_COMMANDS[verb](self.session.robot, values))
+
+    # Generator of operations run by the engine of the session (in a thread or in an asyncio task)
+    def worker(self):
+        set_session(self.session)
+        robot = self.session.robot
+        while True:
+            with self.cond:
+                if len(self.items) == 0:
+                    self.working = False
+            yield robot.wait_for(self.cond, lambda: len(self.items) > 0)
+            with self.cond:
+                if len(self.items) == 0:
+                    continue
+                self.working = True
+                generation = self.generation
+                linecmd, values = self.take()
+
+            try:
+                if values is not None:
+                    # Queued moves were acknowledged already: they run as a window, also without rounding
+                    yield from self.run_window(linecmd, values, generation)
+                    continue
+                yield robot.wait_motion_done()
+                if self.cancelled(generation):
+                    continue
+                if tokenize(linecmd)[0] in SETTING_COMMANDS:
+                    yield from self.apply_setting(linecmd)
+                else:
+                    yield from execute(self.session, linecmd)
+            except Exception as e:
+                print_error(str(e))
+
+    # Convert a queued move to a program step using the current settings
+    def make_step(self, linecmd, values):
+        robot = self.session.robot
+        naxes = self.session.axis_count
+        if linecmd.startswith("MOVC"):
+            return (MOVE_CIRCULAR, [values[:naxes], values[naxes:naxes*2]], robot.speed_mms, robot.accel_percent_joints, robot.rounding)
+        move_type = MOVE_LINEAR if linecmd.startswith("MOVL") else MOVE_JOINT
+        return (move_type, [values[:naxes]], robot.speed_mms, robot.accel_percent_joints, robot.rounding)
+
+    # Collect a window of moves, write it to the robot and start it as soon as the previous window is done
+    # generation is the generation of the queue when the first move was taken: the window is dropped after a STOP
+    def run_window(self, linecmd, values, generation):
+        session = self.session
+        robot = session.robot
+        steps = [self.make_step(linecmd, values)]
+        t_last = time.perf_counter()
+        while len(steps) < self.WINDOW:
+            with self.cond:
+                if self.cancelled(generation):
+                    return
+                next_cmd = None
+                if len(self.items) > 0:
+                    next_cmd, next_values = self.items[0][:2]
+                    if next_values is None and tokenize(next_cmd)[0] not in SETTING_COMMANDS:
+                        # Other commands end the window
+                        break
+                    next_cmd, next_values = self.take()
+
+            if next_cmd is None:
+                remaining = self.GATHER_TIME - (time.perf_counter() - t_last)
+                if remaining <= 0:
+                    break
+                yield robot.wait_for(self.cond, lambda: len(self.items) > 0 or self.cancelled(generation), remaining)
+                continue
+
+            t_last = time.perf_counter()
+            if next_values is None:
+                # Settings apply to the following moves
+                yield from self.apply_setting(next_cmd)
+            else:
+                steps.append(self.make_step(next_cmd, next_values))
+
+        prog_name = self.PROG_NAMES[self.next_prog]
+        self.next_prog = 1 - self.next_prog
+        prog = mrl_blend_lines(steps, session.last_j_nominal, session.tool_str)
+        ok = yield from robot.upload_program(prog, prog_name, False)
+        yield robot.wait_motion_done()
+        if self.cancelled(generation):
+            return
+        if ok:
+            ok = yield from robot.start_program(prog_name)
+
+        if self.cancelled(generation):
+            return
+        if not ok:
+            print_message("Blended moves failed, pending moves removed")
+            self.clear()
+            return
+
+        last_target = steps[-1][1][-1]
+        session.last_j = last_target[:session.axis_count]
+        session.last_j_nominal = last_target[:session.axis_count]
+        with self.cond:
+            self.running = True
+        session.state.start_motion()
+
+#-----------------------------------------------------------------------------
+#-----------------------------------------------------------------------------
+# Generic RoboDK driver for a specific Robot class
+
+# States of a robot
+STATE_DISCONNECTED  = 'disconnected'
+STATE_READY         = 'ready'
+STATE_WORKING       = 'working'
+STATE_MOVING        = 'moving'
+STATE_ERROR         = 'error'
+LIVE_STATES = (STATE_DISCONNECTED, STATE_READY, STATE_WORKING, STATE_MOVING, STATE_ERROR) # state codes of the live feed
+
+# State of a robot, shared by the threads that drive it (commands, monitor, motion queue)
+# The state follows the last status (ROBOTCOM_...) except while the robot moves: a move lasts until motion_done,
+# a disconnection or an error. Threads can wait for a state (wait_for, wait_motion_done) instead of polling it,
+# and callbacks are called with (old, new) after each state change.
+class RobotState:
+    def __init__(self):
+        self.cond = threading.Condition(threading.RLock())
+        self.state = STATE_DISCONNECTED
+        self.status = ROBOTCOM_DISCONNECTED # Last robot status is saved
+        self.move_id = 0                    # Number of moves started
+        self.callbacks = []
+
+    @property
+    def moving(self):
+        return self.state == STATE_MOVING
+
+    def add_callback(self, callback):
+        self.callbacks.append(callback)
+
+    # Change the state. Returns True if it changed
+    def transition(self, new):
+        with self.cond:
+            old = self.state
+            if new == old:
+                return False
+            self.state = new
+            self.cond.notify_all()
+        for callback in self.callbacks:
+            callback(old, new)
+        return True
+
+    # State of the robot when it is not moving, given its status
+    def status_state(self, status):
+        if status == ROBOTCOM_READY:
+            return STATE_READY
+        elif status in (ROBOTCOM_WORKING, ROBOTCOM_WAITING):
+            return STATE_WORKING
+        elif status in (ROBOTCOM_CONNECTION_PROBLEMS, ROBOTCOM_UNKNOWN):
+            return STATE_ERROR
+        return STATE_DISCONNECTED
+
+    # Set the robot status. Returns True if the status changed
+    def set_status(self, status):
+        with self.cond:
+            changed = status != self.status
+            self.status = status
+            new = self.status_state(status)
+            if self.state == STATE_MOVING and new in (STATE_READY, STATE_WORKING):
+                # Commands can run while the robot moves
+                new = STATE_MOVING
+        self.transition(new)
+        return changed
+
+    def start_motion(self):
+        with self.cond:
+            if self.state != STATE_MOVING:
+                self.move_id += 1
+        self.transition(STATE_MOVING)
+
+    # The robot stopped moving (or is no longer expected to move)
+    def motion_done(self):
+        with self.cond:
+            if self.state != STATE_MOVING:
+                return
+            new = self.status_state(self.status)
+        self.transition(new)
+
+    # Wait until predicate() is True (with the state locked). Returns the last value of predicate()
+    def wait_for(self, predicate, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(predicate, timeout)
+
+    def wait_motion_done(self, timeout=None):
+        return self.wait_for(lambda: self.state != STATE_MOVING, timeout)
+
+    # Wake up the waiting threads so that they check their condition again
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+# Each robot driven by this process has its own session: connection, monitor, motion queue and status.
+# Commands are sent to a robot with the prefix "@<id> " (for example "@2 MOVJ ..."), lines without prefix go to the default robot.
+# Messages of the other robots are displayed with the same prefix.
+class RobotSession:
+    def __init__(self, robot_id="", robot_class=None):
+        self.id = robot_id
+        self.prefix = "@%s " % robot_id if robot_id else ""
+        self.ip = "127.0.0.1"       # IP of the robot
+        self.port = 10000           # Communication port of the robot
+        self.monitor_port = None    # Port of the monitoring session (None: port+1, 0: use the command connection)
+        self.axis_count = 6
+        self.state = RobotState()   # Connection and motion state (the monitor provides the joints feedback while the robot is moving)
+        self.telemetry = TelemetryBuffer() # Joint samples of the monitor
+        self.feed = LiveFeed(self)  # Last joints and state for local programs (off until LIVEFEED)
+        self.io = IOImage()         # Inputs read by the monitor (IOWATCH)
+        self.io.add_callback(self.input_changed)
+        self.tool_str = '0.000,0.000,0.000,0.000,0.000,0.000'
+        self.tool = [0.0] * 6        # Tool pose (SETTOOL)
+        self.kinematics = None      # Arm model (mitsubishi_kinematics) for Cartesian linear moves and local poses (KINEMATICS)
+        self.last_j = None          # Target of the last move (to check the position at the end of the move)
+        self.last_j_nominal = None  # Target of the last move as provided by RoboDK (start of circular moves)
+        self.robot = (robot_class or RobotCom)(self) # Connection with the driver engine (RobotCom or AsyncRobotCom)
+        self.queue = MotionQueue(self)
+        self.t_move = None          # Start of the current move (metrics)
+        self.estimator = MoveEstimator() # Move durations of this robot
+        self.move_plan = None       # Predicted duration of the current move (MovePlan)
+        self.state.add_callback(self.state_changed)
+
+    @property
+    def moving(self):
+        return self.state.moving
+
+    @property
+    def status(self):
+        return self.state.status
+
+    def input_changed(self, first, old, new):
+        TRACE.instant('IN%i' % first, 'io', robot=self.id, value='%04X' % new)
+        OUTPUT.status(self.prefix + "SMS:IN%i=%04X (was %04X)" % (first, new, old), self)
+
+    def state_changed(self, old, new):
+        TRACE.instant(new, 'state', robot=self.id)
+        if new == STATE_MOVING:
+            self.t_move = time.perf_counter()
+            TRACE.begin('move', 'state', "%s/%i" % (self.id, self.state.move_id), robot=self.id)
+            if self.move_plan is not None:
+                OUTPUT.write(self.prefix + "SMS2:Moving, ETA %.2f s" % self.move_plan.duration)
+        elif old == STATE_MOVING and self.t_move is not None:
+            METRICS.observe('mitsubishi_move_seconds', time.perf_counter() - self.t_move, robot=self.id)
+            TRACE.end('move', 'state', "%s/%i" % (self.id, self.state.move_id))
+            self.t_move = None
+            self.move_plan = None
+
+    # Predict the duration of a move of robot (connection) from the last target through targets
+    # (call before updating last_j_nominal)
+    def plan_move(self, robot, move_type, targets):
+        self.move_plan = self.estimator.plan(move_type, [self.last_j_nominal] + list(targets), robot.speed_mms, robot.jovrd, robot.accel_percent_joints, self.kinematics, self.tool)
+
+    # The monitor found the end of the move at t_end (time.perf_counter): calibrate the prediction
+    def move_finished(self, t_end):
+        plan = self.move_plan
+        if plan is None or self.t_move is None:
+            return
+        duration = t_end - self.t_move
+        self.estimator.update(plan, duration)
+        METRICS.observe('mitsubishi_move_eta_error_seconds', abs(duration - plan.duration), robot=self.id)
+
+    # Time to wait before the next poll of the monitor of robot (connection) while the robot moves (t: time of the last poll)
+    def poll_interval(self, robot, joints, speed, t):
+        plan = self.move_plan
+        t_move = self.t_move
+        if plan is not None and t_move is not None and self.estimator.ready(plan):
+            return eta_poll_interval(t_move + plan.duration - self.estimator.margin(plan, robot.POLL_MIN) - t, robot.POLL_MIN, robot.POLL_MAX)
+        return poll_interval(joints_error(self.last_j, joints), speed, robot.POLL_MIN, robot.POLL_MAX)
+
+# Keeps the sessions of all the robots, by robot id
+class RobotManager:
+    def __init__(self):
+        self.sessions = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.engine = RobotCom # Connection class of the driver engine
+        self.default = self.get("")
+
+    # Drive the robots with another engine (connection class), before any robot is connected
+    def set_engine(self, robot_class):
+        with self.lock:
+            self.engine = robot_class
+            for session in self.sessions.values():
+                session.robot = robot_class(session)
+
+    # Get the session of a robot (created the first time)
+    def get(self, robot_id):
+        with self.lock:
+            session = self.sessions.get(robot_id)
+            if session is None:
+                session = RobotSession(robot_id, self.engine)
+                self.sessions[robot_id] = session
+            return session
+
+    # Split a command line into the session it is meant for and the command itself
+    def route(self, linecmd):
+        if linecmd.startswith("@"):
+            robot_id, _, linecmd = linecmd[1:].partition(' ')
+            return self.get(robot_id), linecmd
+        return self.default, linecmd
+
+    # Run a command line (RoboDK protocol, with an optional robot prefix)
+    def run(self, linecmd):
+        session, linecmd = self.route(linecmd)
+        previous = current_session()
+        set_session(session)
+        try:
+            RunCommand(linecmd, session)
+        finally:
+            set_session(previous)
+
+    def disconnect_all(self):
+        for session in list(self.sessions.values()):
+            if session.robot.CONNECTED:
+                set_session(session)
+                yield session.robot.disconnect()
+        set_session(self.default)
+
+    def close_feeds(self):
+        for session in list(self.sessions.values()):
+            session.feed.close()
+
+# Each thread (command line, monitor or motion queue) and each asyncio task works for one robot session at a time
+_current_session = contextvars.ContextVar('session', default=None)
+
+def set_session(session):
+    _current_session.set(session)
+
+def current_session():
+    session = _current_session.get()
+    if session is None:
+        return SESSIONS.default
+    return session
+
+#------------ robot connection -----------------
+# Establish connection with the robot (engine call: the asyncio engine returns an awaitable)
+def RobotConnect():
+    session = current_session()
+    return session.robot.connect(session.ip, session.port, session.monitor_port)
+    
+# Disconnect from the robot (engine call)
 def RobotDisconnect():
-    global ROBOT
-    ROBOT.disconnect()
+    return current_session().robot.disconnect()
     
         
 #-----------------------------------------------------------------------------
@@ -400,33 +2419,109 @@ def RobotDisconnect():
 # Note, a simple print() will flush information to the log window of the robot connection in RoboDK
 # Sending a print() might not flush the standard output unless the buffer reaches a certain size
 
-def print_message(message):
+# All the output to RoboDK goes through one writer thread, so lines written by different threads (commands, monitors,
+# motion queues) are never mixed. Lines are written by batches, at most LATENCY seconds after they were queued:
+#  - joint feedback (JNTS_MOVING) of a robot is coalesced, only the newest position is written
+#  - a status line identical to the previous status of the same robot is skipped (except when asked otherwise)
+class OutputWriter:
+    LATENCY = 0.002 # seconds
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.wlock = threading.Lock()   # keeps the batches in order
+        self.lines = []                 # lines waiting to be written
+        self.feedback = {}              # index of the feedback line of each robot in lines
+        self.last_status = {}           # last status line of each robot
+        self.t_first = None             # time the oldest waiting line was queued
+        self.thread = None
+        self.batches = 0                # number of writes (and flushes)
+        self.written = 0                # number of lines written
+
+    def queue(self, line):
+        self.lines.append(line)
+        if self.t_first is None:
+            self.t_first = time.perf_counter()
+            self.cond.notify()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.worker, daemon=True)
+            self.thread.start()
+
+    # Write a line
+    def write(self, line):
+        with self.cond:
+            self.queue(line)
+
+    # Write a status line of a robot (source), skipped if it repeats the previous one and collapse is set
+    def status(self, line, source, collapse=True):
+        with self.cond:
+            if collapse and self.last_status.get(source) == line:
+                return
+            self.last_status[source] = line
+            self.queue(line)
+
+    # Write the joint feedback of a robot (source), replacing the feedback not written yet
+    def joints(self, line, source):
+        with self.cond:
+            i = self.feedback.get(source)
+            if i is not None:
+                self.lines[i] = line
+                return
+            self.feedback[source] = len(self.lines)
+            self.queue(line)
+
+    # Take the waiting lines and write them at once
+    def write_batch(self):
+        with self.wlock:
+            with self.cond:
+                lines = self.lines
+                self.lines = []
+                self.feedback = {}
+                self.t_first = None
+            if lines:
+                sys.stdout.write('\n'.join(lines) + '\n')
+                sys.stdout.flush() # very useful to update RoboDK as fast as possible
+                self.batches += 1
+                self.written += len(lines)
+
+    # Write the waiting lines now (before exiting)
+    def flush(self):
+        self.write_batch()
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while self.t_first is None:
+                    self.cond.wait()
+                wait = self.t_first + self.LATENCY - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            self.write_batch()
+
+OUTPUT = OutputWriter()
+atexit.register(OUTPUT.flush)
+
+def print_message(message, collapse=False):
     """print_message will display a message in the log window (and the connexion status bar)"""
-    print("SMS:" + message)
-    sys.stdout.flush() # very useful to update RoboDK as fast as possible
+    session = current_session()
+    OUTPUT.status(session.prefix + "SMS:" + message, session, collapse)
 
 def set_driver_status(message):
     """print_message will display a message in the log window (and the connexion status bar)"""
-    print("RE:" + message)
-    sys.stdout.flush()  # very useful to update RoboDK as fast as possible
+    OUTPUT.write(current_session().prefix + "RE:" + message)
 
 def show_message(message):
     """show_message will display a message in the status bar of the main window"""
-    print("SMS2:" + message)
-    sys.stdout.flush() # very useful to update RoboDK as fast as possible
+    OUTPUT.write(current_session().prefix + "SMS2:" + message)
 
 def print_joints(joints, ismoving = False):
+    session = current_session()
     if ismoving:
         # Display the feedback of the joints when the robot is moving
-        if ROBOT_MOVING:
-            #print("CJNT_MOVING " + " ".join(format(x, ".5f") for x in joints)) # if joints is a list of float
-            print("JNTS_MOVING " + " ".join(joints))
+        if session.moving:
+            OUTPUT.joints(session.prefix + "JNTS_MOVING " + " ".join(format(x, ".3f") for x in joints), session)
             
     else:
-        #print("CJNT " + " ".join(format(x, ".5f") for x in joints)) # if joints is a list of float
-        print("JNTS " + " ".join(joints))
-    sys.stdout.flush() # very useful to update RoboDK as fast as possible
-    #print("Test")
+        OUTPUT.write(session.prefix + "JNTS " + " ".join(format(x, ".3f") for x in joints))
             
 # ---------------------------------------------------------------------------------
 # Constant values to display status using UpdateStatus()
@@ -440,429 +2535,1099 @@ ROBOTCOM_READY                  =  0
 ROBOTCOM_WORKING                =  1
 ROBOTCOM_WAITING                =  2
 
-# Last robot status is saved
-global STATUS
-STATUS = ROBOTCOM_DISCONNECTED
+# Robot sessions of this driver
+SESSIONS = RobotManager()
 
 def ok2SendCmd():
-    global STATUS
-    if (STATUS == ROBOTCOM_UNKNOWN):
+    if (current_session().status == ROBOTCOM_UNKNOWN):
         return False
     return True
 
 
 # UpdateStatus will send an appropriate message to RoboDK which will result in a specific coloring
 # for example, Ready will be displayed in green, Waiting... will be displayed in Yellow and other messages will be displayed in red
+# Ready acknowledges a command and is always sent, other statuses are only sent when they change (or without set_status)
 def UpdateStatus(set_status=None):
-    global STATUS
-    if set_status is not None:
-        STATUS = set_status
+    session = current_session()
+    if set_status is not None and not session.state.set_status(set_status) and set_status != ROBOTCOM_READY:
+        # Nothing changed
+        return
+    status = session.status
+    session.feed.publish()
         
-    if STATUS == ROBOTCOM_CONNECTION_PROBLEMS:
-        print_message("Connection problems")
-    elif STATUS == ROBOTCOM_DISCONNECTED:
-        print_message("Disconnected")
-    elif STATUS == ROBOTCOM_NOT_CONNECTED:
-        print_message("Not connected")
-    elif STATUS == ROBOTCOM_NOT_CONNECTED_BRS:
-        print_message("Not connected -- send")
-    elif STATUS == ROBOTCOM_NOT_CONNECTED_BRR:
-        print_message("Not connected -- recv")
-    elif STATUS == ROBOTCOM_READY:
+    if status == ROBOTCOM_CONNECTION_PROBLEMS:
+        print_message("Connection problems", True)
+    elif status == ROBOTCOM_DISCONNECTED:
+        print_message("Disconnected", True)
+    elif status == ROBOTCOM_NOT_CONNECTED:
+        print_message("Not connected", True)
+    elif status == ROBOTCOM_NOT_CONNECTED_BRS:
+        print_message("Not connected -- send", True)
+    elif status == ROBOTCOM_NOT_CONNECTED_BRR:
+        print_message("Not connected -- recv", True)
+    elif status == ROBOTCOM_READY:
         print_message("Ready")
-    elif STATUS == ROBOTCOM_WORKING:
-        print_message("Working...")
-    elif STATUS == ROBOTCOM_WAITING:
-        print_message("Waiting...")
+    elif status == ROBOTCOM_WORKING:
+        print_message("Working...", True)
+    elif status == ROBOTCOM_WAITING:
+        print_message("Waiting...", True)
     else:
-        print_message("Unknown status")
+        print_message("Unknown status", True)
         print_message("Connection problems")
 
 # Sample set of commands that can be provided by RoboDK of through the command line
 def TestDriver():    
-    RunCommand("CONNECT 127.0.0.1 10001")
+    session = current_session()
+    yield from execute(session, "CONNECT 127.0.0.1 10001")
     while True:
-        RunCommand("MOVJ -41.331827 37.725242 77.778252 -0.074857 64.571346 -41.303277 679.589111 -597.855225 499.146271 -179.998655 -0.100830 -179.996364")
-        RunCommand("MOVJ -21.219167 56.087544 102.869740 -0.104701 21.136253 -21.125115 678.851196 -263.638880 91.766626 -179.998655 -0.100830 -179.996364")
+        yield from execute(session, "MOVJ -41.331827 37.725242 77.778252 -0.074857 64.571346 -41.303277 679.589111 -597.855225 499.146271 -179.998655 -0.100830 -179.996364")
+        yield from execute(session, "MOVJ -21.219167 56.087544 102.869740 -0.104701 21.136253 -21.125115 678.851196 -263.638880 91.766626 -179.998655 -0.100830 -179.996364")
     #RunCommand("SETTOOL -0.025 -41.046 50.920 60.000 -0.000 90.000")
     #RunCommand("MOVJ -5.362010 46.323420 20.746290 74.878840 -50.101680 61.958500")
     #RunCommand("SPEED 250")
     #RunCommand("MOVL 0 0 0 0 0 0 -5.362010 50.323420 20.746290 74.878840 -50.101680 61.958500")
     #RunCommand("PAUSE 2000") # Pause 2 seconds
 
+# Compare the time spent per move when the program is uploaded for every move and with the resident program
+# The robot must be connected. Results are displayed in the log window
+def BenchmarkMoves(count=10):
+    session = current_session()
+    robot = session.robot
+    moves = ["MOVJ -41.331827 37.725242 77.778252 -0.074857 64.571346 -41.303277 679.589111 -597.855225 499.146271 -179.998655 -0.100830 -179.996364",
+             "MOVJ -21.219167 56.087544 102.869740 -0.104701 21.136253 -21.125115 678.851196 -263.638880 91.766626 -179.998655 -0.100830 -179.996364"]
+    resident = robot.RESIDENT
+    for mode in (False, True):
+        robot.RESIDENT = mode
+        t_start_total = 0.0
+        t_move_total = 0.0
+        for i in range(count):
+            t0 = time.perf_counter()
+            yield from execute(session, moves[i % 2])
+            t1 = time.perf_counter()
+            yield robot.wait_motion_done()
+            t2 = time.perf_counter()
+            t_start_total += t1 - t0
+            t_move_total += t2 - t0
+
+        print_message("Benchmark %s: %.1f ms to start, %.1f ms per move (%i moves)" % ("resident" if mode else "upload", 1000*t_start_total/count, 1000*t_move_total/count, count))
+
+    robot.RESIDENT = resident
+
 #-------------------------- Main driver loop -----------------------------
 # Read STDIN and process each command (infinite loop)
 # IMPORTANT: This must be run from RoboDK so that RoboDK can properly feed commands through STDIN
 # This driver can also be run in console mode providing the commands through the console input
 def RunDriver():
     for line in sys.stdin:
-        RunCommand(line)
+        SESSIONS.run(line)
         
-# Each line provided through command line or STDIN will be processed by RunCommand    
-def RunCommand(linecmd):
-    global ROBOT_IP
-    global ROBOT_PORT
-    global ROBOT_AXIS_COUNT
-    global ROBOT
-    global ROBOT_MOVING
-    global ROBOT_TOOL_STR
-    global MOV_LAST_J
-    global MOV_LAST_J_NOMINAL
-
-    # must contain 1 or more hex character and no '.'
-    def isHex(msg):
-        retVal = 0
-        for ch in msg:
-            if (ch == '.'):
-                return 0
-            if((ch >='A') and (ch<='F')):
-                retVal = 1
-            elif ((ch >='a') and (ch<='f')):
-                retVal = 1
-        return retVal
-
-    # strip a line of words into a list of numbers
-    def line_2_values(words):
-        values = []        
-        for word in words[1:]:
+# Words that contain hexadecimal letters (without '.') are read as hexadecimal numbers
+HEX_LETTERS = re.compile('[a-fA-F]')
+
+# must contain 1 or more hex character and no '.'
+def isHex(msg):
+    return 0 if '.' in msg or HEX_LETTERS.search(msg) is None else 1
+
+# strip a line of words into a list of numbers
+def line_2_values(words):
+    values = []
+    for word in words[1:]:
+        try:
+            number = float(word)
+        except ValueError:
+            continue
+        if '.' not in word and HEX_LETTERS.search(word) is not None:
+            # for example 1E5
             try:
-                number = float(word)
-                if(isHex(word)!=0):
-                    tmp = int(word, 16)
-                    values.append(float(tmp))
-                else:
-                    values.append(number)
-            except:
-                pass
-        return values
-    
-    linecmd = linecmd
+                number = float(int(word, 16))
+            except ValueError:
+                continue
+        values.append(number)
+    return values
+
+# Split a command line into its verb (first word), the words and the numeric values
+def tokenize(linecmd):
     words = linecmd.split(' ')
-    values = line_2_values(words)
-    nvalues = len(values)
+    return words[0].rstrip(), words, line_2_values(words)
+
+#-------------------------- Driver commands -----------------------------
+# Each command of the RoboDK protocol has a handler: handler(session, linecmd, words, values)
+# words holds the command itself (words[0]) and values the numbers found in the rest of the line.
+
+def cmd_connect(session, linecmd, words, values):
+    # Connect to robot provided the IP and the port
     nwords = len(words)
+    nvalues = len(values)
+    session.ip = words[1]
+    if nwords >= 3 and nvalues >= 1:# and int(values[0]) != 10000:
+        session.port = int(values[0])
+        #print("Using default port 10000, not %i" % session.port)
+
+    if nwords >= 4 and nvalues >= 1:# and int(values[0]) != 10000:
+        session.axis_count = int(values[1])
+        #print("Using default port 10000, not %i" % session.port)
+
+    if nwords >= 5 and nvalues >= 3:
+        # Port of the monitoring session
+        session.monitor_port = int(values[2])
+
+    yield RobotConnect()
+
+# Start the feedback of a move once the robot accepted it (ok), target holds the joints at the end of the move
+# A move that was not accepted is not followed by the monitor: its prediction is dropped and RoboDK gets an error status
+def move_started(session, ok, target):
+    if not ok:
+        session.move_plan = None
+        if session.status in (ROBOTCOM_READY, ROBOTCOM_WORKING):
+            UpdateStatus(ROBOTCOM_CONNECTION_PROBLEMS)
+        return False
+    session.last_j = target
+    session.last_j_nominal = target
+    #This will turn on the monitoring thread as such this needs to be after the command to make the robot move
+    session.state.start_motion()
+    return True
+
+def cmd_movj(session, linecmd, words, values):
+    robot = session.robot
+    session.plan_move(robot, MOVE_JOINT, [values[:session.axis_count]])
+    UpdateStatus(ROBOTCOM_WORKING)        
     
-    if (ROBOT_MOVING == True) and (not linecmd.startswith("STOP")):
-        # Don't take commands while busy, unless it's to kill the robot
-        return    
+    # Execute a joint move. RoboDK provides j1,j2,...,j6,x,y,z,w,p,r
+    if robot.RESIDENT:
+        ok = yield from robot.move_resident(MOVE_JOINT, [values[:6]])
+    else:
+        ok = (yield from robot.upload_program(mrl_movj_lines(values[:6], robot.speed_mms, robot.accel_percent_joints))) and (yield from robot.run("1;1;RUNMRL;1"))
+    # Activate the monitor feedback
+    move_started(session, ok, values[:session.axis_count])
+
+def cmd_movl(session, linecmd, words, values):
+    robot = session.robot
+    session.plan_move(robot, MOVE_LINEAR, [values[:session.axis_count]])
     
-    if linecmd == "":
-        # Skip if no command is provided
-        return
+    UpdateStatus(ROBOTCOM_WORKING)        
     
-    elif nwords >= 2 and linecmd.startswith("CONNECT"):
-        # Connect to robot provided the IP and the port
-        ROBOT_IP = words[1]
-        if nwords >= 3 and nvalues >= 1:# and int(values[0]) != 10000:
-            ROBOT_PORT = int(values[0])
-            #print("Using default port 10000, not %i" % ROBOT_PORT)
-
-        if nwords >= 4 and nvalues >= 1:# and int(values[0]) != 10000:
-            ROBOT_AXIS_COUNT = int(values[1])
-            #print("Using default port 10000, not %i" % ROBOT_PORT)
-
-        RobotConnect()
+    # Execute a linear move. RoboDK provides j1,j2,...,j6,x,y,z,w,p,r
+    #robot.Run('1;1;EXECMVS ' + '(' + (','.join(format(vi, ".6f") for vi in values[6:])) + ")(7,0)")
+    #Linear format for mitsubishi is xyz J4 J5 J6 and not xyzwpr
+    if session.axis_count == None:
+        session.axis_count = 6
+    LinearValues = values[session.axis_count:session.axis_count + 6]
     
-    elif nwords >= ROBOT_AXIS_COUNT and linecmd.startswith("MOVJ"):
-        # Activate the monitor feedback
-        MOV_LAST_J = values[:ROBOT_AXIS_COUNT]
-        MOV_LAST_J_NOMINAL = values[:ROBOT_AXIS_COUNT]
-        UpdateStatus(ROBOTCOM_WORKING)        
-        
-        # Execute a joint move. RoboDK provides j1,j2,...,j6,x,y,z,w,p,r
-        err_flag = False
-        #err_flag |= ROBOT.Run("1;1;1;1;SLOTINIT", False)
-        err_flag |= ROBOT.Run("1;1;FDELMRL", False)
-        err_flag |= ROBOT.Run("1;1;NEW", False)
-        err_flag |= ROBOT.Run("1;1;LOAD=MRL", False)
-        err_flag |= ROBOT.Run("1;1;EDATA 1 J1=(" + (','.join(format(vi, ".6f") for vi in values[:6])) + ")", False)
-        #err_flag |= ROBOT.Run("1;1;EDATA 2 Cnt 1", False)
-        err_flag |= ROBOT.Run('1;1;EDATA 2 SPD %.3f' % ROBOT.speed_mms , False)
-        err_flag |= ROBOT.Run('1;1;EDATA 3 ACCEL %.3f' % ROBOT.accel_percent_joints , False)
-        err_flag |= ROBOT.Run('1;1;EDATA 4 MOV J1', False)
-        #err_flag |= ROBOT.Run('1;1;EDATA 5 END', False)
-        err_flag |= ROBOT.Run("1;1;SAVE", False)
-        err_flag |= ROBOT.Run("1;1;RSTPRG", False)
-        err_flag |= ROBOT.Run("1;1;PRGLOAD=MRL", False)
-        err_flag |= ROBOT.Run("1;1;RSTPRG", False)
-        err_flag |= ROBOT.Run("1;1;RUNMRL;1")
-        #This will turn on the monitoring thread as such this needs to be after the command to make the robot moveROBOT_MOVING = True
-        ROBOT_MOVING = True
-        
-    elif nvalues >= (ROBOT_AXIS_COUNT+6) and linecmd.startswith("MOVL"):       
-        MOV_LAST_J = values[:ROBOT_AXIS_COUNT]
-        MOV_LAST_J_NOMINAL = values[:ROBOT_AXIS_COUNT]
-        
-        UpdateStatus(ROBOTCOM_WORKING)        
-        
-        # Execute a linear move. RoboDK provides j1,j2,...,j6,x,y,z,w,p,r
-        #ROBOT.Run('1;1;EXECMVS ' + '(' + (','.join(format(vi, ".6f") for vi in values[6:])) + ")(7,0)")
-        #Linear format for mitsubishi is xyz J4 J5 J6 and not xyzwpr
-        LinearValues = values[ROBOT_AXIS_COUNT:12]
-        if ROBOT_AXIS_COUNT == None:
-            ROBOT_AXIS_COUNT = 6
-        
-        #turns_flag = calc_turns_flag(values[0:ROBOT_AXIS_COUNT])
-        #config_flag = int(6) | (0 if values[4] >= 0 else 1)
-        if (ROBOT_AXIS_COUNT == 4):
-            # For SCARA robots
-            turns_flag = calc_turns_flag(values[0:ROBOT_AXIS_COUNT])
-            config_flag = 0 if values[1] < 0 else 4
-        else:            
-            turns_flag = calc_turns_flag(values[0:ROBOT_AXIS_COUNT])
-            config_flag = int(6) | (0 if values[4] > 0 else 1)
-        
-        #config_flag = 7 #0b110, not 0b111
-        #print("Mov Cartesian: " + str(LinearValues) + " Config flag: " + str(config_flag) + "," + str(turns_flag))
-        #The old code here didn't seem to work for sending linear moves so I just quickly implemented that
-        # Execute a linear move. RoboDK provides j1,j2,...,j6,x,y,z,w,p,r
-        err_flag = False
-        #err_flag |= ROBOT.Run("1;1;1;1;SLOTINIT", False)
-        err_flag |= ROBOT.Run("1;1;FDELMRL", False)
-        err_flag |= ROBOT.Run("1;1;NEW", False)
-        err_flag |= ROBOT.Run("1;1;LOAD=MRL", False)
-        err_flag |= ROBOT.Run("1;1;EDATA 1 Base (0.000,0.000,0.000,0.000,0.000,0.000)")
-        err_flag |= ROBOT.Run("1;1;EDATA 2 Tool (" + ROBOT_TOOL_STR + ")")
-        err_flag |= ROBOT.Run('1;1;EDATA 3 ACCEL %.3f' % ROBOT.accel_percent_joints , False)
-        err_flag |= ROBOT.Run('1;1;EDATA 4 SPD %.3f' % ROBOT.speed_mms , False)
-        #err_flag |= ROBOT.Run("1;1;EDATA 5 P1=(" + (','.join(format(vi, ".3f") for vi in LinearValues[0:6])) + ")" + "(" + str(config_flag) + "," + str(turns_flag) + ")") 
-        err_flag |= ROBOT.Run("1;1;EDATA 5 J1=(" + (','.join(format(vi, ".6f") for vi in values[:6])) + ")", False)
-        err_flag |= ROBOT.Run('1;1;EDATA 6 Mvs J1', False)
-        err_flag |= ROBOT.Run("1;1;SAVE", False)
-        err_flag |= ROBOT.Run("1;1;RSTPRG", False)
-        err_flag |= ROBOT.Run("1;1;PRGLOAD=MRL", False)
-        err_flag |= ROBOT.Run("1;1;RSTPRG", False)
-        err_flag |= ROBOT.Run("1;1;RUNMRL;1")
-
-        # Activate the monitor feedback
-        ROBOT_MOVING = True
-
-    elif nvalues >= (ROBOT_AXIS_COUNT+12) and linecmd.startswith("MOVC"):       
-        UpdateStatus(ROBOTCOM_WORKING)        
-        
-        # Execute a linear move. RoboDK provides j1,j2,...,j6,x,y,z,w,p,r
-        #ROBOT.Run('1;1;EXECMVS ' + '(' + (','.join(format(vi, ".6f") for vi in values[6:])) + ")(7,0)")
-        #Linear format for mitsubishi is xyz J4 J5 J6 and not xyzwpr
-        wayPoint0 = MOV_LAST_J_NOMINAL
-        wayPoint1 = values[:ROBOT_AXIS_COUNT]
-        wayPoint2 = values[ROBOT_AXIS_COUNT:ROBOT_AXIS_COUNT*2]
-
-        if ROBOT_AXIS_COUNT == None:
-            ROBOT_AXIS_COUNT = 6
-
-
-        MOV_LAST_J = values[ROBOT_AXIS_COUNT:ROBOT_AXIS_COUNT*2]
-        MOV_LAST_J_NOMINAL = values[ROBOT_AXIS_COUNT:ROBOT_AXIS_COUNT*2]
-
-        #config_flag = 7 #0b110, not 0b111
-        #print("Mov Cartesian: " + str(LinearValues) + " Config flag: " + str(config_flag) + "," + str(turns_flag))
-        #The old code here didn't seem to work for sending linear moves so I just quickly implemented that
-        # Execute a linear move. RoboDK provides j1,j2,...,j6,x,y,z,w,p,r
-        err_flag = False
-        #err_flag |= ROBOT.Run("1;1;1;1;SLOTINIT", False)
-        err_flag |= ROBOT.Run("1;1;FDELMRL", False)
-        err_flag |= ROBOT.Run("1;1;NEW", False)
-        err_flag |= ROBOT.Run("1;1;LOAD=MRL", False)
-        err_flag |= ROBOT.Run("1;1;EDATA 1 Base (0.000,0.000,0.000,0.000,0.000,0.000)")
-        err_flag |= ROBOT.Run("1;1;EDATA 2 Tool (" + ROBOT_TOOL_STR + ")")
-        err_flag |= ROBOT.Run('1;1;EDATA 3 ACCEL %.3f' % ROBOT.accel_percent_joints , False)
-        err_flag |= ROBOT.Run('1;1;EDATA 4 SPD %.3f' % ROBOT.speed_mms , False)
-        #err_flag |= ROBOT.Run("1;1;EDATA 5 P1=(" + (','.join(format(vi, ".3f") for vi in LinearValues[0:6])) + ")" + "(" + str(config_flag) + "," + str(turns_flag) + ")") 
-        err_flag |= ROBOT.Run("1;1;EDATA 5 J1=(" + (','.join(format(vi, ".6f") for vi in wayPoint0)) + ")", False)
-        err_flag |= ROBOT.Run("1;1;EDATA 6 J2=(" + (','.join(format(vi, ".6f") for vi in wayPoint1)) + ")", False)
-        err_flag |= ROBOT.Run("1;1;EDATA 7 J3=(" + (','.join(format(vi, ".6f") for vi in wayPoint2)) + ")", False)
-        
-        err_flag |= ROBOT.Run('1;1;EDATA 8 Mvr J1, J2, J3', False)
-        err_flag |= ROBOT.Run("1;1;SAVE", False)
-        err_flag |= ROBOT.Run("1;1;RSTPRG", False)
-        err_flag |= ROBOT.Run("1;1;PRGLOAD=MRL", False)
-        err_flag |= ROBOT.Run("1;1;RSTPRG", False)
-        err_flag |= ROBOT.Run("1;1;RUNMRL;1")
-
-        # Activate the monitor feedback
-        ROBOT_MOVING = True
-        
-    elif linecmd.startswith("CJNT"):
-        # Retrieve the current position of the robot
-        ROBOT.Run('1;1;JPOSF')    
-
-    elif nvalues >= 1 and linecmd.startswith("SPEED"):
-        UpdateStatus(ROBOTCOM_WORKING)     
-        # First value is linear speed in mm/s\
-        # IMPORTANT! We should only send one "Ready" per instruction
-        #Initial code, blindly uses override
-        #if values[0] > 0:            
-            # make sure we do not exceed maximum speed (robot turns into error mode)
-            #ROBOT.Run('1;1;EXECSPD (%.3f)' % min(10000.0, values[0]), False)
-            #speed_percent = min(values[0]*100/5000, 100)
-            #ROBOT.Run('1;1;OVRD=%.3f' % speed_percent, False)
-
-        if values[0] > 0:            
-            #Linear speed 
-            #mm/s
-            #Needs to be inside move program
-            #ROBOT.Run('1;1;SPD=%.3f' % values[0], False)
-            ROBOT.speed_mms = values[0]
-        #    pass
-        if values[1] > 0:            
-            #Joint speed
-            #mm/s
-            speed_percent = min(values[1]*100/5000, 100)
-            speed_percent = max(speed_percent,1)
-            ROBOT.Run('1;1;JOVRD %.3f' % speed_percent, False)
-        if values[2] > 0:    
-            #Linear Acceleration        
-            speed_percent = min(values[2]*100/5000, 100)
-            speed_percent = max(speed_percent,1)
-            #Needs to be inside move program
-            #ROBOT.Run('1;1;ACCEL=%.3f' % speed_percent, False)
-            ROBOT.accel_percent_linear = speed_percent
-        if values[3] > 0:            
-            #Joint Acceleration        
-            speed_percent = min(values[3]*100/5000, 100)
-            speed_percent = max(speed_percent,1)
-            #ROBOT.Run('1;1;ACCEL=%.3f' % speed_percent, False)
-            ROBOT.accel_percent_joints = speed_percent
-            pass
+    #config_flag = 7 #0b110, not 0b111
+    #print("Mov Cartesian: " + str(LinearValues) + " Config flag: " + str(config_flag) + "," + str(turns_flag))
+    #The old code here didn't seem to work for sending linear moves so I just quickly implemented that
+    # Execute a linear move. RoboDK provides j1,j2,...,j6,x,y,z,w,p,r
+    if robot.RESIDENT:
+        # The resident program uses the tool set with SETTOOL (EXECTOOL)
+        ok = yield from robot.move_resident(MOVE_LINEAR, [values[:6]])
+    else:
+        # Cartesian target (P1) if the arm model is set with KINEMATICS
+        pose, flags = cartesian_target(session, values[:session.axis_count], LinearValues)
+        ok = (yield from robot.upload_program(mrl_movl_lines(values[:6], robot.speed_mms, robot.accel_percent_joints, session.tool_str, pose, flags))) and (yield from robot.run("1;1;RUNMRL;1"))
 
-        # Provokes sending Ready:
-        UpdateStatus()
-    elif nvalues >= 1 and linecmd.startswith("SETROUNDING"):
-        # Set the rounding/smoothing value. Also known as ZoneData in ABB or CNT for Fanuc
-
-        #This is pointless as where feeding the moves one by one
-        #ROBOT.Run('SetCornering', [1] if values[0] > 0 else [0])
-        ROBOT.rounding = values[0]
-        #if values[0] > 0:
-        #    ROBOT.Run('1;1;CNT 1,%.0f,%.0f' % (values[0],values[0]), False)
-        #else:
-        #    ROBOT.Run('1;1;CNT 0', False)
-        UpdateStatus(ROBOTCOM_READY)
-        pass
-    
-    
+    # Activate the monitor feedback
+    move_started(session, ok, values[:session.axis_count])
+
+def cmd_movc(session, linecmd, words, values):
+    robot = session.robot
+    UpdateStatus(ROBOTCOM_WORKING)        
     
-    elif nvalues >= 1 and linecmd.startswith("PAUSE"):
-        UpdateStatus(ROBOTCOM_WAITING)
-        # Run a pause
-        if values[0] > 0:
-            import time
-            time.sleep(values[0] * 0.001)
-        UpdateStatus(ROBOTCOM_READY)
-        
-    elif nwords == 3 and linecmd.startswith("SETDO"):
+    # Execute a linear move. RoboDK provides j1,j2,...,j6,x,y,z,w,p,r
+    #robot.Run('1;1;EXECMVS ' + '(' + (','.join(format(vi, ".6f") for vi in values[6:])) + ")(7,0)")
+    #Linear format for mitsubishi is xyz J4 J5 J6 and not xyzwpr
+    wayPoint0 = session.last_j_nominal
+    wayPoint1 = values[:session.axis_count]
+    wayPoint2 = values[session.axis_count:session.axis_count*2]
+    session.plan_move(robot, MOVE_CIRCULAR, [wayPoint1, wayPoint2])
+
+    if session.axis_count == None:
+        session.axis_count = 6
+
+
+    #config_flag = 7 #0b110, not 0b111
+    #print("Mov Cartesian: " + str(LinearValues) + " Config flag: " + str(config_flag) + "," + str(turns_flag))
+    #The old code here didn't seem to work for sending linear moves so I just quickly implemented that
+    # Execute a linear move. RoboDK provides j1,j2,...,j6,x,y,z,w,p,r
+    if robot.RESIDENT:
+        ok = yield from robot.move_resident(MOVE_CIRCULAR, [wayPoint2, wayPoint1, wayPoint0])
+    else:
+        ok = (yield from robot.upload_program(mrl_movc_lines(wayPoint0, wayPoint1, wayPoint2, robot.speed_mms, robot.accel_percent_joints, session.tool_str))) and (yield from robot.run("1;1;RUNMRL;1"))
+
+    # Activate the monitor feedback
+    move_started(session, ok, wayPoint2)
+
+def cmd_cjnt(session, linecmd, words, values):
+    # Retrieve the current position of the robot
+    yield from session.robot.run('1;1;JPOSF')
+
+# Apply the speeds and accelerations of SPEED (values <= 0 keep the current setting), without status update
+def set_speed(robot, values):
+    # First value is linear speed in mm/s\
+    # IMPORTANT! We should only send one "Ready" per instruction
+    #Initial code, blindly uses override
+    #if values[0] > 0:            
+        # make sure we do not exceed maximum speed (robot turns into error mode)
+        #robot.Run('1;1;EXECSPD (%.3f)' % min(10000.0, values[0]), False)
+        #speed_percent = min(values[0]*100/5000, 100)
+        #robot.Run('1;1;OVRD=%.3f' % speed_percent, False)
+
+    if values[0] > 0:            
+        #Linear speed 
+        #mm/s
+        #Needs to be inside move program
+        #robot.Run('1;1;SPD=%.3f' % values[0], False)
+        robot.speed_mms = values[0]
+    #    pass
+    if values[1] > 0:            
+        #Joint speed
+        #mm/s
+        speed_percent = min(values[1]*100/5000, 100)
+        speed_percent = max(speed_percent,1)
+        if (yield from robot.run('1;1;JOVRD %.3f' % speed_percent)):
+            robot.jovrd = speed_percent
+    if values[2] > 0:    
+        #Linear Acceleration        
+        speed_percent = min(values[2]*100/5000, 100)
+        speed_percent = max(speed_percent,1)
+        #Needs to be inside move program
+        #robot.Run('1;1;ACCEL=%.3f' % speed_percent, False)
+        robot.accel_percent_linear = speed_percent
+    if values[3] > 0:            
+        #Joint Acceleration        
+        speed_percent = min(values[3]*100/5000, 100)
+        speed_percent = max(speed_percent,1)
+        #robot.Run('1;1;ACCEL=%.3f' % speed_percent, False)
+        robot.accel_percent_joints = speed_percent
+        pass
+
+def cmd_speed(session, linecmd, words, values):
+    UpdateStatus(ROBOTCOM_WORKING)     
+    yield from set_speed(session.robot, values)
+    # Provokes sending Ready:
+    UpdateStatus()
+
+# Set the rounding/smoothing value. Also known as ZoneData in ABB or CNT for Fanuc
+# With a rounding value the moves are queued and blended (Cnt) by MotionQueue
+def set_rounding(robot, values):
+    #robot.Run('SetCornering', [1] if values[0] > 0 else [0])
+    robot.rounding = values[0]
+    #if values[0] > 0:
+    #    robot.Run('1;1;CNT 1,%.0f,%.0f' % (values[0],values[0]), False)
+    #else:
+    #    robot.Run('1;1;CNT 0', False)
+
+def cmd_setrounding(session, linecmd, words, values):
+    set_rounding(session.robot, values)
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_resident(session, linecmd, words, values):
+    # Use a resident motion program: moves only write the targets and start the program
+    robot = session.robot
+    robot.RESIDENT = values[0] > 0
+    if robot.RESIDENT and robot.CONNECTED:
+        yield from robot.install_resident()
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_pollrate(session, linecmd, words, values):
+    # Set the monitor polling interval range in ms while the robot moves and report the end of move detection latency
+    robot = session.robot
+    if len(values) >= 2 and 0 < values[0] <= values[1]:
+        robot.POLL_MIN = values[0] * 0.001
+        robot.POLL_MAX = values[1] * 0.001
+    latency = list(robot.detect_latency)
+    if len(latency) > 0:
+        print_message("Polling %.0f-%.0f ms, end of move detected within %.1f ms (avg %.1f ms, max %.1f ms, %i moves)" % (robot.POLL_MIN*1000, robot.POLL_MAX*1000, latency[-1]*1000, 1000*sum(latency)/len(latency), 1000*max(latency), len(latency)))
+    else:
+        print_message("Polling %.0f-%.0f ms" % (robot.POLL_MIN*1000, robot.POLL_MAX*1000))
+    for line in session.estimator.summary():
+        print_message(line)
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_record(session, linecmd, words, values):
+    # Record the joint telemetry to a binary file (append), or stop recording without a file name
+    path = linecmd[7:].strip()
+    session.telemetry.record(path if path else None)
+    if path:
+        print_message("Recording the joint telemetry to " + path)
+    else:
+        print_message("Telemetry recording stopped")
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_trace(session, linecmd, words, values):
+    # Trace the driver activity: TRACE <file> starts tracing, TRACE SAVE saves the events so far, TRACE OFF stops and saves
+    arg = linecmd[6:].strip()
+    if arg.upper() in ("SAVE", "OFF", ""):
+        if arg.upper() != "SAVE":
+            TRACE.stop()
+        if TRACE.path is not None:
+            print_message("Trace saved to %s (%i events)" % (TRACE.path, TRACE.save()))
+    else:
+        TRACE.start(arg)
+        print_message("Tracing to " + arg)
+    UpdateStatus(ROBOTCOM_READY)
+
+# Save the trace when the driver stops
+def save_trace():
+    if TRACE.enabled:
+        TRACE.stop()
+        TRACE.save()
+
+def cmd_stats(session, linecmd, words, values):
+    # Display the metrics (STATS), reset them (STATS RESET) or serve them over HTTP (STATS <port>, 0 to stop)
+    if len(words) >= 2 and words[1].strip().upper() == "RESET":
+        METRICS.reset()
+        print_message("Metrics reset")
+    elif len(values) >= 1:
+        port = METRICS.serve(int(values[0]))
+        if port:
+            print_message("Metrics available on http://127.0.0.1:%i/metrics" % port)
+        else:
+            print_message("Metrics server stopped")
+    else:
+        for line in METRICS.summary():
+            print_message(line)
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_livefeed(session, linecmd, words, values):
+    # Publish the joints and state to a shared memory segment (see LiveFeed), or stop publishing without a name
+    name = linecmd[9:].strip()
+    session.feed.open(name if name else None)
+    if name:
+        print_message("Publishing the live feed to " + name)
+    else:
+        print_message("Live feed stopped")
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_pause(session, linecmd, words, values):
+    UpdateStatus(ROBOTCOM_WAITING)
+    # Run a pause
+    if values[0] > 0:
+        yield session.robot.sleep(values[0] * 0.001)
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_setdo(session, linecmd, words, values):
+    robot = session.robot
+    if len(words) == 3:
         #16 bit version
         UpdateStatus(ROBOTCOM_WORKING)
         dIO_id = words[1]
         dIO_value = words[2]
         codeStr = ""
         codeStr = str("OUT={0};{1}").format((dIO_id),(dIO_value))
-        ROBOT.Run('1;1;' + codeStr)
+        yield from robot.run('1;1;' + codeStr)
         print_message("16 + " + codeStr)
         UpdateStatus(ROBOTCOM_READY)
+        return
 
-    elif nvalues >= 2 and linecmd.startswith("SETDO"):
-        UpdateStatus(ROBOTCOM_WORKING)
-        dIO_id = values[0]
-        dIO_value = values[1]
-        codeStr = ""
-        #print_message("Warning: Setting DO[%i] = %.1f not implemented" % (dIO_id, dIO_value))
-        if not str(dIO_id).startswith('OUT'):
-            codeStr = str("OUT={0:d};{1:d}").format(int(dIO_id),int(dIO_value))
+    if len(values) < 2:
+        OUTPUT.write("Unknown command: " + linecmd.rstrip())
+        return
+
+    UpdateStatus(ROBOTCOM_WORKING)
+    dIO_id = values[0]
+    dIO_value = values[1]
+    codeStr = ""
+    #print_message("Warning: Setting DO[%i] = %.1f not implemented" % (dIO_id, dIO_value))
+    if not str(dIO_id).startswith('OUT'):
+        codeStr = str("OUT={0:d};{1:d}").format(int(dIO_id),int(dIO_value))
+    else:
+        codeStr = str("{0:d} = {1:d}").format(dIO_id,dIO_value)
+    print_message("1 + " + codeStr)
+    yield from robot.run('1;1;' + codeStr)
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_waitdi(session, linecmd, words, values):
+    # Wait for an input: WAITDI <input> <value> [timeout ms] [poll interval ms]
+    # The command runs on the motion queue (see queue_command) so that STOP and the feedback are handled while waiting
+    robot = session.robot
+    io = session.io
+    signal = int(values[0])
+    expected = 1 if values[1] > 0 else 0
+    timeout = values[2] * 0.001 if len(values) >= 3 and values[2] > 0 else None
+    if not robot.CONNECTED:
+        UpdateStatus(ROBOTCOM_NOT_CONNECTED)
+        return
+
+    UpdateStatus(ROBOTCOM_WAITING)
+    t_start = time.perf_counter()
+    io.add_wait(signal, values[3] * 0.001 if len(values) >= 4 and values[3] > 0 else None)
+    robot.wake() # the monitor may be waiting for a move
+    try:
+        yield robot.wait_for(io.cond, lambda: io.read(signal, 1) == expected or not robot.CONNECTED, timeout)
+        if not robot.CONNECTED:
+            result = 'stopped'
+        elif io.read(signal, 1) == expected:
+            result = 'ok'
         else:
-            codeStr = str("{0:d} = {1:d}").format(dIO_id,dIO_value)
-        print_message("1 + " + codeStr)
-        ROBOT.Run('1;1;' + codeStr)
-        UpdateStatus(ROBOTCOM_READY)
+            result = 'timeout'
+    finally:
+        io.remove_wait(signal)
+    t_end = time.perf_counter()
+    METRICS.observe('mitsubishi_input_wait_seconds', t_end - t_start, robot=session.id, result=result)
+    TRACE.complete('WAITDI', 'io', t_start, t_end, {'input': signal, 'value': expected, 'result': result})
+    if result == 'timeout':
+        print_message("Timeout waiting for DI[%i] = %i (%.0f ms)" % (signal, expected, 1000*(t_end - t_start)))
+    elif result == 'stopped':
+        return
+    UpdateStatus(ROBOTCOM_READY)
 
-    elif nvalues >= 2 and linecmd.startswith("WAITDI"):
-        UpdateStatus(ROBOTCOM_WORKING)
-        dIO_id = values[0]
-        dIO_value = values[1]
-        print_message("Warning: Waiting DI[%i] = %.1f not implemented" % (dIO_id, dIO_value))
+def cmd_settool(session, linecmd, words, values):
+    # Set the Tool reference frame provided the 6 XYZWPR values by RoboDK
+    #Z axis is reversed for scara robots
+    #if session.axis_count == 4:
+    #    values[2] = -values[2]
+    session.tool_str = ','.join(format(vi, ".6f") for vi in values)
+    session.tool = values[:6]
+    yield from session.robot.run('1;1;EXECTOOL (' + session.tool_str + ')')
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_kinematics(session, linecmd, words, values):
+    # Set the arm model (KINEMATICS RV-4F): linear moves are then sent as Cartesian targets. KINEMATICS OFF goes back to joint targets
+    if len(words) >= 2:
+        name = words[1].strip().upper()
+        if name == "OFF":
+            session.kinematics = None
+        elif mitsubishi_kinematics is None:
+            print_message("Kinematics require NumPy")
+        elif name in mitsubishi_kinematics.MODELS and mitsubishi_kinematics.MODELS[name].axes == session.axis_count:
+            session.kinematics = mitsubishi_kinematics.MODELS[name]
+        else:
+            print_message("Unknown %i axis arm: %s" % (session.axis_count, name))
+    print_message("Kinematics: %s" % (session.kinematics.name if session.kinematics is not None else "off (joint targets)"))
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_cpos(session, linecmd, words, values):
+    # Pose of the tool computed from the last joints of the monitor (or the last target), without asking the robot
+    model = session.kinematics
+    sample = session.telemetry.latest()
+    joints = sample[1][:session.axis_count] if sample is not None else session.last_j_nominal
+    if model is None or joints is None:
+        print_message("Pose not available (KINEMATICS not set or joints unknown)")
+    else:
+        pose = model.pose(joints, session.tool)[0]
+        print_message("Pose: %s (%i,%i)" % (' '.join(format(vi, ".3f") for vi in pose), model.config_flags(joints)[0], model.turns_flags(joints)[0]))
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_runprog(session, linecmd, words, values):
+    robot = session.robot
+    UpdateStatus(ROBOTCOM_WORKING)
+    prog_id = int(values[0])
+    prog_name = str(prog_id)
+    if len(words) >= 3:
+        prog_name = words[1].strip()
+
+    path = find_program_file(prog_name)
+    if path is not None:
+        started = yield from robot.run_library_program(prog_name, read_program_file(path))
+    else:
+        started = yield from robot.start_program(prog_name)
+    if not started:
+        print_message("Program %s could not be started" % prog_name)
         UpdateStatus(ROBOTCOM_READY)
-        
-    elif nvalues >= 6 and linecmd.startswith("SETTOOL"):
-        # Set the Tool reference frame provided the 6 XYZWPR values by RoboDK
-        #Z axis is reversed for scara robots
-        #if ROBOT_AXIS_COUNT == 4:
-        #    values[2] = -values[2]
-        ROBOT_TOOL_STR = ','.join(format(vi, ".6f") for vi in values)
-        ROBOT.Run('1;1;EXECTOOL (' + ROBOT_TOOL_STR + ')')
+        return
+    # The end position of a program is not known: the monitor takes it when the program stops
+    session.last_j = None
+    session.last_j_nominal = None
+    session.state.start_motion()
+
+# PROGLIB [CLEAR] lists (or deletes) the programs of the program library stored on the controller
+def cmd_proglib(session, linecmd, words, values):
+    robot = session.robot
+    UpdateStatus(ROBOTCOM_WORKING)
+    controller = "%s:%i" % (session.ip, session.port)
+    entries = PROGRAMS.entries(controller)
+    if len(words) >= 2 and words[1].strip().upper() == "CLEAR":
+        for slot, entry in entries:
+            yield from robot.delete_program(slot)
+            PROGRAMS.remove(controller, slot)
+        print_message("Program library cleared (%i programs)" % len(entries))
+    else:
+        lines = sum(entry['lines'] for slot, entry in entries)
+        print_message("Program library: %i/%i programs, %i/%i lines" % (len(entries), PROGRAMS.SLOTS, lines, PROGRAMS.LINES))
+        for slot, entry in entries:
+            print_message("%s: %s (%i lines, used %s)" % (slot, entry['name'], entry['lines'], time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['used']))))
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_popup(session, linecmd, words, values):
+    UpdateStatus(ROBOTCOM_WORKING)
+    message = linecmd[6:]            
+    print_message("Warning: Display message %s not implemented" % (message))
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_disconnect(session, linecmd, words, values):
+    # Disconnect from robot
+    yield session.robot.disconnect()
+    UpdateStatus(ROBOTCOM_DISCONNECTED)
+
+def cmd_test(session, linecmd, words, values):
+    # Call custom procedure for quick testing
+    yield from TestDriver()
+
+def cmd_bench(session, linecmd, words, values):
+    # Measure the time per move with and without the resident program
+    yield from BenchmarkMoves(int(values[0]) if len(values) >= 1 else 10)
+
+def cmd_quit(session, linecmd, words, values):
+    # Stop the driver (all the robots)
+    yield from SESSIONS.disconnect_all()
+    UpdateStatus(ROBOTCOM_DISCONNECTED)
+    SESSIONS.close_feeds()
+    save_trace()
+    quit(0) # Stop the driver
+
+def cmd_stop(session, linecmd, words, values):
+    robot = session.robot
+    session.queue.clear()
+    session.state.motion_done()
+    # Stop the robot right away
+    yield from robot.run('1;1;SRVOFF')
+
+    #Stop program running
+    yield from robot.run("1;1;RSTPRG")
+
+    yield robot.disconnect()
+    UpdateStatus(ROBOTCOM_DISCONNECTED)
+
+def cmd_raw(session, linecmd, words, values):
+    yield from session.robot.run(linecmd[2:].strip())
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_raw_reply(session, linecmd, words, values):
+    robot = session.robot
+    #UpdateStatus(ROBOTCOM_WORKING)
+    codeStr = linecmd[2:].strip()
+    yield from robot.run('1;1;' + codeStr)
+    retStr = robot.LAST_MSG
+    retStr = retStr.lstrip("QoK")
+    set_driver_status(retStr)
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_getdi(session, linecmd, words, values):
+    robot = session.robot
+    #UpdateStatus(ROBOTCOM_WORKING)
+    dIO_id = values[0]
+    # Watched inputs are read from the image kept by the monitor
+    value = session.io.read(int(dIO_id))
+    if value is not None:
+        METRICS.count('mitsubishi_input_reads_total', robot=session.id, result='hit')
+        set_driver_status("%04X" % value)
         UpdateStatus(ROBOTCOM_READY)
-        
-    elif nvalues >= 1 and nwords >= 2 and linecmd.startswith("RUNPROG"):
-        UpdateStatus(ROBOTCOM_WORKING)
-        prog_id = int(values[0])
-        prog_name = "Program %i" % prog_id
-        if nwords >= 3:
-            prog_name = words[1]
-            
-        print_message("Warning: Running program %s not implemented" % (prog_name))
+        return
+    METRICS.count('mitsubishi_input_reads_total', robot=session.id, result='miss')
+    codeStr = ""
+    if not str(dIO_id).startswith('IN'):
+        codeStr = str("IN{0:d}").format(int(dIO_id))
+    else:
+        codeStr = str("IN{0:d}").format(dIO_id)
+    yield from robot.run('1;1;' + codeStr)
+    retStr = robot.LAST_MSG
+    retStr = retStr.lstrip("QoK")
+    if robot.LAST_MSG.startswith("QoK"):
+        session.io.update({int(dIO_id): int(retStr[:4], 16)})
+    set_driver_status(retStr)
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_getdiw(session, linecmd, words, values):
+    # Read a range of inputs in one exchange: GETDIW <first input> <count>. The value is returned in hexadecimal
+    start = int(values[0])
+    count = int(values[1]) if len(values) >= 2 else IO_WORD
+    value = yield from session.robot.read_inputs(start, count)
+    if value is not None:
+        set_driver_status("%0*X" % ((count + 3) // 4, value))
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_setdow(session, linecmd, words, values):
+    # Write a range of outputs in one exchange: SETDOW <first output> <hex value> [count]
+    # The outputs are written by words of 16 signals: count must be a multiple of 16 (see write_outputs)
+    try:
+        start = int(words[1])
+        hex_value = words[2].strip()
+        value = int(hex_value, 16)
+        count = int(words[3]) if len(words) >= 4 else IO_WORD * max(1, (len(hex_value) + 3) // 4)
+    except ValueError:
+        OUTPUT.write("Unknown command: " + linecmd.rstrip())
+        return
+    if count % IO_WORD != 0:
+        print_message("SETDOW writes whole words of %i outputs, %i outputs rejected" % (IO_WORD, count))
         UpdateStatus(ROBOTCOM_READY)
-        
-    elif nwords >= 2 and linecmd.startswith("POPUP "):
+        return
+    UpdateStatus(ROBOTCOM_WORKING)
+    yield from session.robot.write_outputs(start, value, count)
+    UpdateStatus(ROBOTCOM_READY)
+
+def cmd_iowatch(session, linecmd, words, values):
+    # Keep an image of a range of inputs read by the monitor: IOWATCH <first input> <count> [interval ms], IOWATCH to stop
+    if len(values) >= 2 and values[1] > 0:
+        interval = values[2] * 0.001 if len(values) >= 3 else None
+        session.io.set_watch(int(values[0]), int(values[1]), interval)
+        print_message("Watching %i inputs from IN%i every %.0f ms" % (values[1], values[0], 1000*session.io.interval))
+    else:
+        session.io.set_watch(0, 0)
+        print_message("Inputs not watched")
+    # The monitor may be waiting for a move
+    session.robot.wake()
+    UpdateStatus(ROBOTCOM_READY)
+
+# Handler and minimum arguments of a command
+# A command needs at least nwords words (including the command) and nvalues + naxes*axis_count numeric values
+class CommandSpec:
+    __slots__ = ('handler', 'nwords', 'nvalues', 'naxes')
+
+    def __init__(self, handler, nwords=1, nvalues=0, naxes=0):
+        self.handler = handler
+        self.nwords = nwords
+        self.nvalues = nvalues
+        self.naxes = naxes
+
+    def accepts(self, session, words, values):
+        return len(words) >= self.nwords and len(values) >= self.nvalues + self.naxes*session.axis_count
+
+# Commands of the RoboDK protocol, by verb
+COMMANDS = {
+    "CONNECT":      CommandSpec(cmd_connect, nwords=2),
+    "MOVJ":         CommandSpec(cmd_movj, naxes=1),
+    "MOVL":         CommandSpec(cmd_movl, nvalues=6, naxes=1),
+    "MOVC":         CommandSpec(cmd_movc, naxes=2),
+    "CJNT":         CommandSpec(cmd_cjnt),
+    "SPEED":        CommandSpec(cmd_speed, nvalues=4),
+    "SETROUNDING":  CommandSpec(cmd_setrounding, nvalues=1),
+    "RESIDENT":     CommandSpec(cmd_resident, nvalues=1),
+    "POLLRATE":     CommandSpec(cmd_pollrate),
+    "RECORD":       CommandSpec(cmd_record),
+    "LIVEFEED":     CommandSpec(cmd_livefeed),
+    "STATS":        CommandSpec(cmd_stats),
+    "TRACE":        CommandSpec(cmd_trace),
+    "PAUSE":        CommandSpec(cmd_pause, nvalues=1),
+    "SETDO":        CommandSpec(cmd_setdo, nwords=3),
+    "WAITDI":       CommandSpec(cmd_waitdi, nvalues=2),
+    "SETTOOL":      CommandSpec(cmd_settool, nvalues=6),
+    "KINEMATICS":   CommandSpec(cmd_kinematics),
+    "CPOS":         CommandSpec(cmd_cpos),
+    "RUNPROG":      CommandSpec(cmd_runprog, nwords=2, nvalues=1),
+    "PROGLIB":      CommandSpec(cmd_proglib),
+    "POPUP":        CommandSpec(cmd_popup, nwords=2),
+    "DISCONNECT":   CommandSpec(cmd_disconnect),
+    "TEST":         CommandSpec(cmd_test),
+    "BENCH":        CommandSpec(cmd_bench),
+    "QUIT":         CommandSpec(cmd_quit),
+    "STOP":         CommandSpec(cmd_stop),
+    "c":            CommandSpec(cmd_raw, nwords=2),
+    "r":            CommandSpec(cmd_raw_reply, nwords=2),
+    "GETDI":        CommandSpec(cmd_getdi, nvalues=1),
+    "GETDIW":       CommandSpec(cmd_getdiw, nvalues=1),
+    "SETDOW":       CommandSpec(cmd_setdow, nwords=3),
+    "IOWATCH":      CommandSpec(cmd_iowatch),
+}
+
+# Moves can be queued and blended by MotionQueue
+MOVE_COMMANDS = ("MOVJ", "MOVL", "MOVC")
+
+# Commands that can take long run on the motion queue so that STOP is handled while they run
+QUEUE_COMMANDS = ("WAITDI",)
+
+# Settings of the following moves. While moves are queued they are queued too, and applied without a second acknowledge
+SETTING_COMMANDS = {"SPEED": set_speed, "SETROUNDING": set_rounding}
+
+# Operations of a handler (or setting) as a generator, also if it does not talk to the robot (plain function)
+def operations(result):
+    if inspect.isgenerator(result):
+        return (yield from result)
+    return result
+
+# Put the command on the motion queue of the session if it must run after the queued moves, if it is a move to blend
+# or if it can take long (QUEUE_COMMANDS). STOP is never queued. Returns True if the command was queued
+def queue_command(session, linecmd):
+    verb, words, values = tokenize(linecmd)
+    if verb == "STOP":
+        return False
+    # Keep the commands in order while blended moves are queued
+    is_move = verb in MOVE_COMMANDS and COMMANDS[verb].accepts(session, words, values)
+    is_wait = verb in QUEUE_COMMANDS and session.robot.CONNECTED
+    if session.queue.busy() or is_wait or (is_move and session.robot.rounding > 0 and session.robot.CONNECTED):
+        session.queue.put(linecmd, values if is_move else None)
+        return True
+    return False
+
+# Run a command of the RoboDK protocol with its handler (COMMANDS), as a generator of operations of the driver engine
+# (see RobotProtocol). The command line, the motion queue and the asyncio driver run the commands the same way
+def execute(session, linecmd):
+    verb, words, values = tokenize(linecmd)
+    spec = COMMANDS.get(verb)
+
+    if (session.moving == True) and (verb != "STOP"):
+        # Don't take commands while busy, unless it's to kill the robot
+        return    
+    
+    if linecmd == "":
+        # Skip if no command is provided
+        return
+
+    if spec is None or not spec.accepts(session, words, values):
+        OUTPUT.write("Unknown command: " + linecmd.rstrip())
+        return
+
+    t_start = time.perf_counter()
+    try:
+        yield from operations(spec.handler(session, linecmd, words, values))
+    finally:
+        t_end = time.perf_counter()
+        METRICS.observe('mitsubishi_driver_command_seconds', t_end - t_start, robot=session.id, verb=verb)
+        TRACE.complete(verb, 'command', t_start, t_end, {'robot': session.id, 'line': linecmd.rstrip()})
+
+# Each line provided through command line or STDIN will be processed by RunCommand    
+def RunCommand(linecmd, session=None):
+    if session is None:
+        session = current_session()
+    if queue_command(session, linecmd):
+        return
+    run_sync(execute(session, linecmd))
+
+
+#-------------------------- asyncio driver -----------------------------
+# Alternative driver engine based on asyncio (run the driver with --async)
+# Standard input, the command connection and the monitoring connection are asyncio streams served by one event loop.
+# STOP, joint feedback and status updates are handled while other commands are running, without threads or busy polling.
+# The RoboDK line protocol and the commands are the same as with RunDriver/RunCommand (COMMANDS, RobotProtocol): the
+# handlers and the motion queue run as asyncio tasks instead of threads.
+
+# Receive the next NUL terminated message from an asyncio stream (empty messages are skipped)
+# Raises OSError if the connection is closed or if no message arrives within timeout seconds, like read_line
+async def read_message(reader, timeout):
+    while True:
+        try:
+            data = await asyncio.wait_for(reader.readuntil(b'\0'), timeout)
+        except asyncio.TimeoutError:
+            raise socket.timeout("timed out")
+        except asyncio.IncompleteReadError:
+            raise ConnectionAbortedError("Connection closed")
+        if len(data) > 1:
+            return data[:-1].decode('ascii', 'replace')
+
+# Open asyncio streams to address with keepalive probes (see open_connection)
+async def open_streams(address, timeout, keepalive=(5, 1, 3)):
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(*address), timeout)
+    except asyncio.TimeoutError:
+        raise socket.timeout("timed out")
+    set_keepalive(writer.get_extra_info('socket'), keepalive)
+    return reader, writer
+
+# Open asyncio streams, retrying with an exponential backoff (see connect_backoff)
+async def open_streams_backoff(address, timeout, retry_time, keepalive=(5, 1, 3), delay_min=0.05, delay_max=2.0):
+    deadline = time.monotonic() + retry_time
+    delay = delay_min
+    while True:
+        try:
+            return await open_streams(address, timeout, keepalive)
+        except OSError:
+            if time.monotonic() + delay > deadline:
+                raise
+        await asyncio.sleep(delay)
+        delay = min(2 * delay, delay_max)
+
+# communication class for the Mitsubishi robot using asyncio streams
+# The controller commands are the same as with RobotCom (RobotProtocol), the engine calls return awaitables
+class AsyncRobotCom(RobotProtocol):
+    """asyncio version of RobotCom"""
+
+    def __init__(self, session):
+        RobotProtocol.__init__(self, session)
+        self.reader = None
+        self.writer = None
+        self.monreader = None
+        self.monwriter = None
+        self.lock = None        # asyncio locks and events are created inside the event loop (connect and wait_for)
+        self.monlock = None
+        self.changed = None     # Set by wake: the waits check their condition again
+        self.monitor_stop = None
+        self.monitor_task = None
+        # The monitor waits for the next move
+        session.state.add_callback(lambda old, new: self.wake())
+
+    async def connect(self, ip, port=10001, monitor_port=None):
+        self.connecting = True
+        try:
+            return await self.open(ip, port, monitor_port)
+        finally:
+            self.connecting = False
+
+    # Open the connection (see RobotCom.open)
+    async def open(self, ip, port, monitor_port):
+        target = (ip, port, monitor_port)
+        if self.CONNECTED and target == self.target and await self.alive():
+            print_message('Connected to robot %s:%i' % (ip, port))
+            self.start_monitor()
+            UpdateStatus(ROBOTCOM_READY)
+            return True
+
+        if self.CONNECTED and target != self.target:
+            await self.disconnect()
+        else:
+            self.drop()
+        print_message('Connecting to robot %s:%i' % (ip, port))
         UpdateStatus(ROBOTCOM_WORKING)
-        message = linecmd[6:]            
-        print_message("Warning: Display message %s not implemented" % (message))
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        try:
+            self.reader, self.writer = await open_streams_backoff((ip, port), self.CONNECT_TIMEOUT, self.CONNECT_RETRY_TIME, self.KEEPALIVE)
+        except OSError as e:
+            print_message(str(e))
+            print_message("Connection refused")
+            return False
+
+        self.CONNECTED = True
+        self.lost = False
+        self.target = target
+        self.session.state.motion_done()
+        await run_async(self.open_session())
+        if not self.CONNECTED:
+            # The connection broke while the session was started
+            return False
+        await self.connect_monitor(ip, port + 1 if monitor_port is None else monitor_port)
+        self.start_monitor()
         UpdateStatus(ROBOTCOM_READY)
-        
-    elif linecmd.startswith("DISCONNECT"):
-        # Disconnect from robot
-        ROBOT.disconnect()
-        UpdateStatus(ROBOTCOM_DISCONNECTED)
-        
-    elif linecmd.startswith("TEST"):
-        # Call custom procedure for quick testing
-        TestDriver()
+        return True
 
-        
-    elif linecmd.startswith("QUIT"):
-        # Stop the driver
-        ROBOT.disconnect()
-        UpdateStatus(ROBOTCOM_DISCONNECTED)
-        quit(0) # Stop the driver
-    elif linecmd.startswith("STOP"):
-        ROBOT_MOVING = False
-        # Stop the robot right away
-        ROBOT.Run('1;1;SRVOFF')
+    # Check that the command connection still works (STATE round trip)
+    async def alive(self):
+        try:
+            async with self.lock:
+                self.writer.write(b'1;1;STATE\0')
+                await self.writer.drain()
+                await read_message(self.reader, self.CONNECT_TIMEOUT)
+                return True
+        except (OSError, AttributeError):
+            return False
 
-        #Stop program running
-        ROBOT.Run("1;1;RSTPRG", False)
+    # Open a second session for position and state polling (shares the command connection if not available)
+    async def connect_monitor(self, ip, port):
+        self.monreader = self.reader
+        self.monwriter = self.writer
+        self.monlock = self.lock
+        if not port:
+            return False
 
-        ROBOT.disconnect()
+        try:
+            reader, writer = await open_streams((ip, port), self.MONITOR_TIMEOUT, self.KEEPALIVE)
+            writer.write(b'1;1;OPEN=ROBODKMON\0')
+            await read_message(reader, self.MONITOR_TIMEOUT)
+        except OSError as e:
+            print_message("Monitoring connection %s:%i not available (%s), using the command connection" % (ip, port, str(e)))
+            return False
+
+        self.monreader = reader
+        self.monwriter = writer
+        self.monlock = asyncio.Lock()
+        return True
+
+    # Start the monitor task of the session (a monitor still running is stopped first)
+    def start_monitor(self):
+        self.stop_monitor()
+        self.monitor_stop = asyncio.Event()
+        self.monitor_task = self.spawn(monitor_loop(self, self.monitor_stop), "monitor" + self.session.prefix.rstrip())
+
+    def stop_monitor(self):
+        if self.monitor_stop is not None:
+            self.monitor_stop.set()
+        task = self.monitor_task
+        self.monitor_task = None
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
+
+    async def disconnect(self):
+        self.CONNECTED = False
+        self.lost = False
+        self.stop_monitor()
+        self.wake()
+        self.session.telemetry.flush()
+        for writer in ([self.writer] if self.monwriter is self.writer else [self.monwriter, self.writer]):
+            try:
+                if writer is not None:
+                    writer.write(b'1;1;CLOSE\0')
+                    writer.close()
+            except Exception:
+                pass
+        self.writer = None
+        self.monwriter = None
         UpdateStatus(ROBOTCOM_DISCONNECTED)
-   
-    elif linecmd.startswith("c "):
-        ROBOT.Run(linecmd[2:].strip())
-        UpdateStatus(ROBOTCOM_READY)
-    elif linecmd.startswith("r "):
-        #UpdateStatus(ROBOTCOM_WORKING)
-        codeStr = linecmd[2:].strip()
-        ROBOT.Run('1;1;' + codeStr)
-        retStr = ROBOT.LAST_MSG
-        retStr = retStr.lstrip("QoK")
-        set_driver_status(retStr)
-        UpdateStatus(ROBOTCOM_READY)
-    elif linecmd.startswith("GETDI"):
-        #UpdateStatus(ROBOTCOM_WORKING)
-        dIO_id = values[0]
-        codeStr = ""
-        if not str(dIO_id).startswith('IN'):
-            codeStr = str("IN{0:d}").format(int(dIO_id))
-        else:
-            codeStr = str("IN{0:d}").format(dIO_id)
-        ROBOT.Run('1;1;' + codeStr)
-        retStr = ROBOT.LAST_MSG
-        retStr = retStr.lstrip("QoK")
-        set_driver_status(retStr)
-        UpdateStatus(ROBOTCOM_READY)
-    
-    else:
-        print("Unknown command: " + linecmd)
-    
-    # Stop monitoring feedback
-    #ROBOT_MOVING = False
+        return True
+
+    # Close the connections without notifying the robot (the link is broken)
+    def drop(self):
+        self.CONNECTED = False
+        self.stop_monitor()
+        for writer in (self.monwriter, self.writer):
+            try:
+                if writer is not None:
+                    writer.close()
+            except Exception:
+                pass
+
+    # Write all commands and read one reply per command. Returns the replies or None if the connection is broken
+    async def exchange(self, cmds):
+        async with self.lock:
+            t_send = time.perf_counter()
+            try:
+                self.writer.write(b''.join(bytes(cmd + '\0', 'ascii') for cmd in cmds))
+                await self.writer.drain()
+            except (OSError, AttributeError) as e:
+                self.CONNECTED = False
+                self.lost = True
+                print_message(str(e))
+                print_message("Robot connection broken")
+                UpdateStatus(ROBOTCOM_NOT_CONNECTED_BRS)
+                return None
+
+            replies = []
+            t_replies = []
+            try:
+                for cmd in cmds:
+                    replies.append(await read_message(self.reader, self.CONNECT_TIMEOUT))
+                    t_replies.append(time.perf_counter())
+            except OSError as e:
+                self.CONNECTED = False
+                self.lost = True
+                print_message(str(e))
+                print_message("Robot connection broken")
+                UpdateStatus(ROBOTCOM_NOT_CONNECTED_BRR)
+                return None
+            self.LAST_MSG = replies[-1]
+            METRICS.exchange(self.session.id, cmds, replies, t_send, t_replies)
+            trace_exchange(cmds, t_send, t_replies)
+            return replies
+
+    # Same as exchange through the monitoring connection. Raises OSError if the connection is broken
+    async def monitor_exchange(self, cmds):
+        async with self.monlock:
+            self.monwriter.write(b''.join(bytes(cmd + '\0', 'ascii') for cmd in cmds))
+            await self.monwriter.drain()
+            return [await read_message(self.monreader, self.MONITOR_TIMEOUT) for cmd in cmds]
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    # Sleep between two polls of the monitor (a disconnection cancels the monitor task)
+    async def monitor_sleep(self, seconds, stop):
+        await asyncio.sleep(seconds)
+
+    # Wait until predicate() is True, checked after each wake (cond is only used by the threaded engine: the changes of
+    # the state, the inputs and the motion queue call wake). Returns the last value of predicate()
+    async def wait_for(self, cond, predicate, timeout=None):
+        if self.changed is None:
+            self.changed = asyncio.Event()
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while not predicate():
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                break
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        return predicate()
+
+    def wake(self):
+        if self.changed is not None:
+            self.changed.set()
+
+    # Run a generator of operations in a task of the event loop
+    def spawn(self, ops, name):
+        return asyncio.ensure_future(run_async(ops))
+
+# Runs the RoboDK line protocol on an asyncio event loop
+class AsyncDriver:
+    def __init__(self):
+        SESSIONS.set_engine(AsyncRobotCom)
+        self.lines = None       # Commands waiting to be executed (asyncio.Queue)
+        self.current = None     # Task of the command being executed
+        self.current_session = None # Session of the command being executed
+        self.quit = False
+
+    # Read the standard input and queue the commands. STOP is executed right away
+    async def feed(self):
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader()
+        try:
+            await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+        except (NotImplementedError, ValueError, OSError):
+            # Pipes are not supported by this event loop (Windows console): read from a daemon thread
+            reader = asyncio.Queue()
+            def read_stdin():
+                for line in sys.stdin:
+                    loop.call_soon_threadsafe(reader.put_nowait, line.encode('ascii', 'replace'))
+                loop.call_soon_threadsafe(reader.put_nowait, b'')
+            t = threading.Thread(target=read_stdin)
+            t.daemon = True
+            t.start()
+
+        while True:
+            if isinstance(reader, asyncio.Queue):
+                data = await reader.get()
+            else:
+                data = await reader.readline()
+            if data == b'':
+                break
+            line = data.decode('ascii', 'replace')
+            session, linecmd = SESSIONS.route(line)
+            if linecmd.startswith("STOP"):
+                await self.stop(session, line)
+            else:
+                await self.lines.put(line)
+
+        await self.lines.put(None)
+
+    async def main(self):
+        self.lines = asyncio.Queue()
+        feeder = asyncio.ensure_future(self.feed())
+        await self.execute()
+        feeder.cancel()
+
+    # Execute the commands in order
+    async def execute(self):
+        while not self.quit:
+            line = await self.lines.get()
+            if line is None:
+                return
+            self.current_session = SESSIONS.route(line)[0]
+            self.current = asyncio.ensure_future(self.run_command(line))
+            try:
+                await self.current
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                print_error(str(e))
+            self.current = None
+            self.current_session = None
+
+    # STOP (line) cancels the command running for the robot and drops its pending commands, then stops the robot
+    async def stop(self, session, line):
+        if self.current is not None and self.current_session is session:
+            self.current.cancel()
+        pending = []
+        while not self.lines.empty():
+            pending.append(self.lines.get_nowait())
+        for other in pending:
+            if other is None or SESSIONS.route(other)[0] is not session:
+                self.lines.put_nowait(other)
+        await self.run_command(line)
+
+    # Run a command line (with an optional robot prefix) with the same commands as RunCommand (COMMANDS)
+    async def run_command(self, line):
+        session, linecmd = SESSIONS.route(line)
+        set_session(session)
+        if queue_command(session, linecmd):
+            return
+        try:
+            await run_async(execute(session, linecmd))
+        except SystemExit:
+            # QUIT
+            self.quit = True
+
+# Read STDIN and process each command with the asyncio engine
+def RunDriverAsync():
+    driver = AsyncDriver()
+    asyncio.run(driver.main())
 
 def RunMain():
     """Call Main procedure"""
@@ -875,17 +3640,30 @@ def RunMain():
     cmdlist +='c 1;1;SRVON|Servo ON|'    
     cmdlist +='c 1;1;CNTLON|Control On|'    
     cmdlist +='c 1;1;CNTLOFF|Control Off|'    
+    cmdlist +='RESIDENT 1|Resident program ON|'
+    cmdlist +='RESIDENT 0|Resident program OFF|'
 
     #1;1;CNTLOFF
     
-    print("CMDLIST:" + cmdlist)
-    sys.stdout.flush()
+    OUTPUT.write("CMDLIST:" + cmdlist)
     
     # Flush Disconnected message
     UpdateStatus()
+
+    # Optional metrics endpoint (Prometheus): --metrics <port>
+    if "--metrics" in sys.argv[:-1]:
+        METRICS.serve(int(sys.argv[sys.argv.index("--metrics") + 1]))
+
+    # Optional trace of the driver activity, saved when the driver stops: --trace <file>
+    if "--trace" in sys.argv[:-1]:
+        TRACE.start(sys.argv[sys.argv.index("--trace") + 1])
+        atexit.register(save_trace)
     
     # Run the driver from STDIN
-    RunDriver()
+    if "--async" in sys.argv:
+        RunDriverAsync()
+    else:
+        RunDriver()
     
     # Test the driver with a sample set of commands
     #TestDriver()
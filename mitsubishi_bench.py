@@ -0,0 +1,292 @@
+# Benchmark of the RoboDK driver for Mitsubishi robots (apimitsubishi.py)
+# The driver is run against the controller simulator (mitsubishi_sim.py) started in the same process, so that the
+# benchmark can compare the driver times with the simulated controller times (start and end of each motion).
+#
+# Measures:
+#   parse:   time to tokenize a command line and find its handler (RoboDK command streams), compared with the
+#            character by character parser and if/elif dispatch used before
+#   run:     commands per second with Run (one round trip per command) and RunBatch (pipelined commands)
+#   streams: RoboDK command streams replayed through RunCommand (TestDriver MOVJ sequence, linear moves, resident
+#            program, blended moves). For each move:
+#              upload_ms        time to write the motion program (UploadProgram)
+#              start_ms         time for RunCommand to return (the robot was asked to move)
+#              first_motion_ms  time from the command to the start of the robot motion
+#              end_detect_ms    time from the end of the motion to the driver reporting Ready
+#              move_ms          time from the command to Ready
+#            and the rate of the joint feedback (JNTS_MOVING) while the robot is moving.
+#
+# The results are printed as JSON (or saved with --output) to compare driver changes:
+#   python mitsubishi_bench.py --moves 20 --latency 2 --jitter 1 --output before.json
+#---------------------------------------------------------------------------------
+import sys
+import json
+import time
+import argparse
+import platform
+import threading
+
+import apimitsubishi as driver
+import mitsubishi_sim
+
+# TestDriver sequence
+MOVES_TESTDRIVER = [
+    "MOVJ -41.331827 37.725242 77.778252 -0.074857 64.571346 -41.303277 679.589111 -597.855225 499.146271 -179.998655 -0.100830 -179.996364",
+    "MOVJ -21.219167 56.087544 102.869740 -0.104701 21.136253 -21.125115 678.851196 -263.638880 91.766626 -179.998655 -0.100830 -179.996364",
+]
+MOVES_LINEAR = [
+    "MOVL 0 0 0 0 0 0 -41.331827 37.725242 77.778252 -0.074857 64.571346 -41.303277 679.589111 -597.855225 499.146271 -179.998655 -0.100830 -179.996364",
+    "MOVL 0 0 0 0 0 0 -35.0 45.0 85.0 -0.08 50.0 -35.0 679.0 -450.0 350.0 -179.998655 -0.100830 -179.996364",
+]
+
+# Lines RoboDK streams at a high rate, and less frequent ones
+PARSE_LINES = MOVES_TESTDRIVER + MOVES_LINEAR + ["CJNT", "SPEED 250 -1 -1 -1", "SETROUNDING 5", "SETDO 3 1", "GETDI 3", "PAUSE 100"]
+
+# Parser and dispatch of the driver before the command table (reference for the parse benchmark)
+def legacy_isHex(msg):
+    retVal = 0
+    for ch in msg:
+        if (ch == '.'):
+            return 0
+        if((ch >='A') and (ch<='F')):
+            retVal = 1
+        elif ((ch >='a') and (ch<='f')):
+            retVal = 1
+    return retVal
+
+def legacy_line_2_values(words):
+    values = []
+    for word in words[1:]:
+        try:
+            number = float(word)
+            if(legacy_isHex(word)!=0):
+                tmp = int(word, 16)
+                values.append(float(tmp))
+            else:
+                values.append(number)
+        except:
+            pass
+    return values
+
+LEGACY_PREFIXES = ["CONNECT", "MOVJ", "MOVL", "MOVC", "CJNT", "SPEED", "SETROUNDING", "RESIDENT", "POLLRATE", "PAUSE", "SETDO",
+                   "WAITDI", "SETTOOL", "RUNPROG", "POPUP ", "DISCONNECT", "TEST", "BENCH", "QUIT", "STOP", "c ", "r ", "GETDI"]
+
+def legacy_parse(linecmd):
+    words = linecmd.split(' ')
+    values = legacy_line_2_values(words)
+    for prefix in LEGACY_PREFIXES:
+        if linecmd.startswith(prefix):
+            return prefix, values
+    return None, values
+
+def parse(linecmd, session):
+    verb, words, values = driver.tokenize(linecmd)
+    spec = driver.COMMANDS.get(verb)
+    return spec is not None and spec.accepts(session, words, values)
+
+# Microseconds per line to parse and dispatch the command lines
+def bench_parse(count):
+    session = driver.SESSIONS.default
+    lines = PARSE_LINES
+    results = {'lines': count * len(lines)}
+    for name, function in (('legacy_us', lambda line: legacy_parse(line)), ('table_us', lambda line: parse(line, session))):
+        t0 = time.perf_counter()
+        for i in range(count):
+            for line in lines:
+                function(line)
+        results[name] = 1e6 * (time.perf_counter() - t0) / (count * len(lines))
+    results['speedup'] = results['legacy_us'] / results['table_us']
+    return results
+
+# Collects the driver output (stdout) with the time each line was completed
+class OutputRecorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.partial = ''
+        self.lines = []         # (time, line)
+
+    def write(self, text):
+        t = time.perf_counter()
+        with self.lock:
+            self.partial += text
+            while '\n' in self.partial:
+                line, self.partial = self.partial.split('\n', 1)
+                self.lines.append((t, line))
+
+    def flush(self):
+        pass
+
+    def since(self, t0, prefix):
+        with self.lock:
+            return [(t, line) for t, line in self.lines if t >= t0 and line.startswith(prefix)]
+
+# Summary of a list of samples (seconds, reported in ms)
+def stats_ms(samples):
+    samples = sorted(x for x in samples if x is not None)
+    if not samples:
+        return None
+    n = len(samples)
+    return {
+        'n': n,
+        'mean': 1000.0 * sum(samples) / n,
+        'median': 1000.0 * samples[n // 2],
+        'p95': 1000.0 * samples[min(n - 1, int(0.95 * n))],
+        'max': 1000.0 * samples[-1],
+    }
+
+# Wait until the robot stopped and the motion queue is empty. Returns the time the driver reported it
+def wait_idle(session, timeout=30.0):
+    t_end = time.perf_counter() + timeout
+    idle = lambda: not (session.moving or session.queue.busy()) or not session.robot.CONNECTED
+    while not session.state.wait_for(idle, 0.05) and time.perf_counter() < t_end:
+        pass
+    return time.perf_counter()
+
+# Commands per second with Run and RunBatch
+def bench_run(robot, count):
+    t0 = time.perf_counter()
+    for i in range(count):
+        robot.Run('1;1;STATE', False)
+    t_run = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    robot.RunBatch(['1;1;STATE'] * count)
+    t_batch = time.perf_counter() - t0
+    return {
+        'commands': count,
+        'run_per_s': count / t_run,
+        'batch_per_s': count / t_batch,
+    }
+
+# Replay a list of moves one by one, waiting for the end of each move
+def bench_moves(session, sim, recorder, lines, count, resident=False):
+    robot = session.robot
+    robot.RESIDENT = resident
+    upload = []
+    real_upload = robot.upload_program
+    def timed_upload(*args, **kwargs):
+        t = time.perf_counter()
+        result = yield from real_upload(*args, **kwargs)
+        upload.append(time.perf_counter() - t)
+        return result
+    robot.upload_program = timed_upload
+
+    start, first_motion, end_detect, move, feedback = [], [], [], [], []
+    try:
+        for i in range(count):
+            t0 = time.perf_counter()
+            driver.RunCommand(lines[i % len(lines)], session)
+            t1 = time.perf_counter()
+            t2 = wait_idle(session)
+            start.append(t1 - t0)
+            move.append(t2 - t0)
+            if sim.t_motion is not None:
+                first_motion.append(sim.t_motion - t0)
+            if sim.t_done is not None:
+                end_detect.append(t2 - sim.t_done)
+            if sim.t_motion is not None and sim.t_done is not None and sim.t_done > sim.t_motion:
+                feedback.append(len(recorder.since(t0, 'JNTS_MOVING')) / (sim.t_done - sim.t_motion))
+    finally:
+        del robot.upload_program
+        robot.RESIDENT = False
+
+    return {
+        'moves': count,
+        'upload_ms': stats_ms(upload),
+        'start_ms': stats_ms(start),
+        'first_motion_ms': stats_ms(first_motion),
+        'end_detect_ms': stats_ms(end_detect),
+        'move_ms': stats_ms(move),
+        'feedback_hz': sum(feedback) / len(feedback) if feedback else None,
+    }
+
+# Blended moves: all the moves are sent at once and run by the motion queue
+def bench_blend(session, sim, lines, count, rounding):
+    driver.RunCommand("SETROUNDING %.3f" % rounding, session)
+    t0 = time.perf_counter()
+    for i in range(count):
+        driver.RunCommand(lines[i % len(lines)], session)
+    t1 = time.perf_counter()
+    t2 = wait_idle(session)
+    driver.RunCommand("SETROUNDING -1", session)
+    return {
+        'moves': count,
+        'rounding': rounding,
+        'send_ms': 1000.0 * (t1 - t0),
+        'total_ms': 1000.0 * (t2 - t0),
+        'moves_per_s': count / (t2 - t0),
+        'end_detect_ms': 1000.0 * (t2 - sim.t_done) if sim.t_done is not None else None,
+    }
+
+def RunMain():
+    parser = argparse.ArgumentParser(description="Benchmark of the Mitsubishi RoboDK driver against the controller simulator")
+    parser.add_argument('--port', type=int, default=10101, help="port of the simulated controller (and port+1)")
+    parser.add_argument('--moves', type=int, default=10, help="moves per stream")
+    parser.add_argument('--commands', type=int, default=200, help="commands for the Run/RunBatch throughput")
+    parser.add_argument('--latency', type=float, default=1.0, help="simulated network latency (ms)")
+    parser.add_argument('--jitter', type=float, default=0.5, help="simulated network jitter (ms)")
+    parser.add_argument('--process-time', type=float, default=0.1, help="simulated controller time per command (ms)")
+    parser.add_argument('--joint-speed', type=float, default=360.0, help="simulated joint speed (deg/s)")
+    parser.add_argument('--rounding', type=float, default=5.0, help="rounding of the blended moves stream (mm)")
+    parser.add_argument('--streams', default='testdriver,linear,resident,blend', help="streams to run (comma separated)")
+    parser.add_argument('--parse-count', type=int, default=20000, help="repetitions of the parse benchmark")
+    parser.add_argument('--parse-only', action='store_true', help="only run the parse benchmark (no simulated controller)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default=None, help="save the results to this JSON file")
+    args = parser.parse_args()
+
+    if args.parse_only:
+        print(json.dumps({'parse': bench_parse(args.parse_count)}, indent=2))
+        return
+
+    sim, servers = mitsubishi_sim.start_sim('127.0.0.1', args.port, None, args.latency * 0.001, args.jitter * 0.001,
+                                            args.process_time * 0.001, joint_speed=args.joint_speed, seed=args.seed)
+    session = driver.SESSIONS.default
+    streams = args.streams.split(',')
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'sim': {'latency_ms': args.latency, 'jitter_ms': args.jitter, 'process_time_ms': args.process_time, 'joint_speed': args.joint_speed},
+        'driver': {'pipeline': session.robot.PIPELINE, 'poll_min_ms': 1000.0 * session.robot.POLL_MIN, 'poll_max_ms': 1000.0 * session.robot.POLL_MAX},
+        'streams': {},
+        'parse': bench_parse(args.parse_count),
+    }
+
+    # The driver output is recorded, not displayed
+    recorder = OutputRecorder()
+    stdout = sys.stdout
+    sys.stdout = recorder
+    try:
+        driver.set_session(session)
+        driver.RunCommand("CONNECT 127.0.0.1 %i 6" % args.port, session)
+        driver.RunCommand("SPEED 1000 -1 -1 -1", session)
+        if not session.robot.CONNECTED:
+            raise ConnectionError("Can't connect to the simulated controller")
+
+        results['run'] = bench_run(session.robot, args.commands)
+        if 'testdriver' in streams:
+            results['streams']['testdriver'] = bench_moves(session, sim, recorder, MOVES_TESTDRIVER, args.moves)
+        if 'linear' in streams:
+            results['streams']['linear'] = bench_moves(session, sim, recorder, MOVES_LINEAR, args.moves)
+        if 'resident' in streams:
+            results['streams']['resident'] = bench_moves(session, sim, recorder, MOVES_TESTDRIVER, args.moves, True)
+        if 'blend' in streams:
+            results['streams']['blend'] = bench_blend(session, sim, MOVES_TESTDRIVER, args.moves, args.rounding)
+        results['sim']['commands'] = sim.commands
+        session.robot.disconnect()
+        driver.OUTPUT.flush()
+        # Lines written to RoboDK and number of writes (flushes) needed
+        results['output'] = {'lines': driver.OUTPUT.written, 'writes': driver.OUTPUT.batches}
+    finally:
+        sys.stdout = stdout
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    print(text)
+
+if __name__ == "__main__":
+    RunMain()
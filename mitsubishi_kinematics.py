@@ -0,0 +1,205 @@
+# Forward kinematics of Mitsubishi arms for the RoboDK driver (apimitsubishi.py), based on NumPy
+# The arms are described by their Denavit-Hartenberg parameters (standard convention) with the joint zero of the
+# controller: RV 6 axis arms (vertical at J2=J3=0, home at 0,0,90,0,90,0 with the flange pointing down) and RH 4 axis
+# SCARA arms (J3 is the Z stroke in mm). All the functions take one row of joints per sample (deg, mm for prismatic
+# joints) and work on whole arrays:
+#   ArmModel.fk             flange (or TCP) frames as 4x4 matrices
+#   ArmModel.pose           TCP poses (X,Y,Z,A,B,C) as reported by the controller
+#   ArmModel.config_flags   configuration flag (FL1) of each target
+#   ArmModel.turns_flags    multiple rotation flag (FL2) of each target
+#   ArmModel.check_pose     distance between the poses given for the joints and the poses of the model
+#   ArmModel.ik             joints of a pose, closest to a seed (numerical, for the controller simulator)
+# Poses are (X,Y,Z,A,B,C) in mm and deg, with the rotation Rz(C)*Ry(B)*Rx(A) (same as the RoboDK xyzwpr).
+#
+# The dimensions of MODELS are the nominal ones of the catalog. Check them against the data sheet of the robot
+# (the driver only uses the model when the poses of RoboDK agree with it, see check_pose).
+#
+# Example:
+#   import mitsubishi_kinematics
+#   arm = mitsubishi_kinematics.MODELS['RV-4F']
+#   arm.pose([[0, 0, 90, 0, 90, 0]])      -> [[275, 0, 500, 180, 0, 180]]
+#---------------------------------------------------------------------------------
+import numpy
+
+# Configuration flag (FL1) bits of vertical arms
+FLAG_RIGHT = 4
+FLAG_ABOVE = 2
+FLAG_NONFLIP = 1
+
+# Homogeneous transforms of poses (n x 6) as n x 4 x 4 matrices
+def pose_matrix(poses):
+    poses = numpy.atleast_2d(numpy.asarray(poses, dtype=numpy.float64))
+    a, b, c = numpy.radians(poses[:, 3]), numpy.radians(poses[:, 4]), numpy.radians(poses[:, 5])
+    ca, sa, cb, sb, cc, sc = numpy.cos(a), numpy.sin(a), numpy.cos(b), numpy.sin(b), numpy.cos(c), numpy.sin(c)
+    m = numpy.zeros((len(poses), 4, 4))
+    m[:, 0, 0] = cb*cc
+    m[:, 0, 1] = sa*sb*cc - ca*sc
+    m[:, 0, 2] = ca*sb*cc + sa*sc
+    m[:, 1, 0] = cb*sc
+    m[:, 1, 1] = sa*sb*sc + ca*cc
+    m[:, 1, 2] = ca*sb*sc - sa*cc
+    m[:, 2, 0] = -sb
+    m[:, 2, 1] = sa*cb
+    m[:, 2, 2] = ca*cb
+    m[:, :3, 3] = poses[:, :3]
+    m[:, 3, 3] = 1.0
+    return m
+
+# Poses (n x 6) of n x 4 x 4 matrices. At B=+-90 deg (gimbal lock) A is 0
+def matrix_pose(m):
+    m = numpy.asarray(m, dtype=numpy.float64).reshape(-1, 4, 4)
+    cb = numpy.hypot(m[:, 0, 0], m[:, 1, 0])
+    locked = cb < 1e-9
+    b = numpy.arctan2(-m[:, 2, 0], cb)
+    a = numpy.where(locked, 0.0, numpy.arctan2(m[:, 2, 1], m[:, 2, 2]))
+    c = numpy.where(locked, numpy.arctan2(-m[:, 0, 1], m[:, 1, 1]), numpy.arctan2(m[:, 1, 0], m[:, 0, 0]))
+    angles = numpy.degrees(numpy.column_stack((a, b, c))) + 0.0
+    # -180 is reported as 180
+    angles = numpy.where(angles <= -180.0 + 1e-9, angles + 360.0, angles)
+    return numpy.column_stack((m[:, :3, 3], angles))
+
+# Joints as a 2D float array (one row per sample)
+def as_joints(joints, naxes):
+    return numpy.atleast_2d(numpy.asarray(joints, dtype=numpy.float64))[:, :naxes]
+
+# Multiple rotation flag (FL2): 4 bits per joint with the number of turns of the joint (-180 < angle <= 180 is turn 0),
+# negative turns in two's complement (-1 is F)
+def turns_flags(joints):
+    joints = numpy.atleast_2d(numpy.asarray(joints, dtype=numpy.float64))
+    turns = numpy.ceil((joints - 180.0) / 360.0).astype(numpy.int64) & 0xF
+    weights = numpy.int64(16) ** numpy.arange(joints.shape[1], dtype=numpy.int64)
+    return (turns * weights).sum(axis=1)
+
+class ArmModel:
+    # dh is the list of (type, a, alpha, d, offset) of each joint: type 'R' (revolute: theta = joint + offset) or
+    # 'P' (prismatic: d = d + joint, theta = offset), lengths in mm and angles in deg
+    def __init__(self, name, dh):
+        self.name = name
+        self.axes = len(dh)
+        self.prismatic = numpy.array([link[0] == 'P' for link in dh])
+        self.a = numpy.array([link[1] for link in dh], dtype=numpy.float64)
+        self.alpha = numpy.radians([link[2] for link in dh])
+        self.d = numpy.array([link[3] for link in dh], dtype=numpy.float64)
+        self.offset = numpy.array([link[4] for link in dh], dtype=numpy.float64)
+
+    # Frames of all the joints (n x axes x 4 x 4): frame i is the frame of the link moved by joint i
+    def frames(self, joints):
+        joints = as_joints(joints, self.axes)
+        theta = numpy.radians(numpy.where(self.prismatic, 0.0, joints) + self.offset)
+        d = self.d + numpy.where(self.prismatic, joints, 0.0)
+        ct, st = numpy.cos(theta), numpy.sin(theta)
+        ca, sa = numpy.cos(self.alpha), numpy.sin(self.alpha)
+        # Link transforms Rz(theta)*Tz(d)*Tx(a)*Rx(alpha), for all the samples and links at once
+        links = numpy.zeros(joints.shape + (4, 4))
+        links[..., 0, 0] = ct
+        links[..., 0, 1] = -st*ca
+        links[..., 0, 2] = st*sa
+        links[..., 0, 3] = self.a*ct
+        links[..., 1, 0] = st
+        links[..., 1, 1] = ct*ca
+        links[..., 1, 2] = -ct*sa
+        links[..., 1, 3] = self.a*st
+        links[..., 2, 1] = sa
+        links[..., 2, 2] = ca
+        links[..., 2, 3] = d
+        links[..., 3, 3] = 1.0
+        frames = numpy.empty_like(links)
+        frames[:, 0] = links[:, 0]
+        for i in range(1, self.axes):
+            frames[:, i] = frames[:, i - 1] @ links[:, i]
+        return frames
+
+    # Flange frames (n x 4 x 4), or TCP frames if a tool pose (X,Y,Z,A,B,C) is provided
+    def fk(self, joints, tool=None):
+        flange = self.frames(joints)[:, -1]
+        if tool is None:
+            return flange
+        return flange @ pose_matrix(tool)[0]
+
+    def pose(self, joints, tool=None):
+        return matrix_pose(self.fk(joints, tool))
+
+    # Vertical arms: RIGHT if the wrist center is in front of the J1 axis, ABOVE if the elbow is above the line from the
+    # shoulder to the wrist center, NONFLIP if J5 is positive
+    def config_flags(self, joints):
+        joints = as_joints(joints, self.axes)
+        frames = self.frames(joints)
+        forward = numpy.stack((numpy.cos(numpy.radians(joints[:, 0])), numpy.sin(numpy.radians(joints[:, 0]))), axis=1)
+        shoulder, elbow, wrist = frames[:, 0, :3, 3], frames[:, 1, :3, 3], frames[:, 3, :3, 3]
+        # Positions in the plane of the arm: distance to the J1 axis along the arm and height
+        def plane(p):
+            return numpy.einsum('ij,ij->i', p[:, :2], forward), p[:, 2]
+        r_wrist, z_wrist = plane(wrist)
+        r_shoulder, z_shoulder = plane(shoulder)
+        r_elbow, z_elbow = plane(elbow)
+        side = numpy.where(r_wrist >= 0, 1.0, -1.0)
+        above = side*((r_wrist - r_shoulder)*(z_elbow - z_shoulder) - (z_wrist - z_shoulder)*(r_elbow - r_shoulder)) > 0
+        return numpy.where(r_wrist >= 0, FLAG_RIGHT, 0) | numpy.where(above, FLAG_ABOVE, 0) | numpy.where(joints[:, 4] >= 0, FLAG_NONFLIP, 0)
+
+    def turns_flags(self, joints):
+        return turns_flags(as_joints(joints, self.axes))
+
+    # Joints that reach a pose, from the seed joints (Gauss-Newton iterations with a numerical Jacobian), or None if the
+    # pose is not reached. The solution is the one closest to the seed: the configuration flags are not used
+    def ik(self, pose, seed, tool=None, tolerance=1e-4, iterations=50):
+        target = pose_matrix(pose)[0]
+        q = as_joints(seed, self.axes)[0].copy()
+        h = 1e-3
+        for i in range(iterations):
+            # Pose errors (position in mm, rotation in deg) at q and at q + h for each joint
+            frames = self.fk(numpy.vstack((q, q + h*numpy.eye(self.axes))), tool)
+            dp = target[:3, 3] - frames[:, :3, 3]
+            dr = numpy.degrees(0.5*numpy.cross(frames[:, :3, :3], target[:3, :3], axisa=1, axisb=0, axisc=1).sum(axis=2))
+            error = numpy.hstack((dp, dr))
+            if numpy.abs(error[0]).max() < tolerance:
+                return q
+            jacobian = (error[1:] - error[0]).T / h
+            dq = numpy.linalg.lstsq(jacobian, error[0], rcond=None)[0]
+            # Steps of at most 10 deg (mm) keep the linearization valid far from the solution
+            q -= dq*min(1.0, 10.0/numpy.abs(dq).max())
+        return None
+
+    # Position (mm) and orientation (deg) differences between the given poses and the poses of the joints
+    def check_pose(self, joints, poses, tool=None):
+        expected = self.fk(joints, tool)
+        given = pose_matrix(numpy.atleast_2d(numpy.asarray(poses, dtype=numpy.float64))[:, :6])
+        distance = numpy.linalg.norm(expected[:, :3, 3] - given[:, :3, 3], axis=1)
+        # Angle of the rotation between both orientations
+        cos_angle = (numpy.einsum('nij,nij->n', expected[:, :3, :3], given[:, :3, :3]) - 1.0) / 2.0
+        angle = numpy.degrees(numpy.arccos(numpy.clip(cos_angle, -1.0, 1.0)))
+        return distance, angle
+
+class ScaraModel(ArmModel):
+    # SCARA arms: RIGHT (right handed arm) if J2 is positive. The other bits are not used
+    def config_flags(self, joints):
+        joints = as_joints(joints, self.axes)
+        return numpy.where(joints[:, 1] < 0, 0, FLAG_RIGHT)
+
+# Vertical 6 axis arm: J2 height d1, shoulder offset a1, upper arm a2, elbow offset a3, forearm d4 (J3 to the wrist
+# center) and flange d6 (wrist center to the flange)
+def rv_model(name, d1, a1, a2, a3, d4, d6):
+    return ArmModel(name, [
+        ('R', a1, -90.0, d1, 0.0),
+        ('R', a2, 0.0, 0.0, -90.0),
+        ('R', a3, -90.0, 0.0, -90.0),
+        ('R', 0.0, 90.0, d4, 0.0),
+        ('R', 0.0, -90.0, 0.0, 0.0),
+        ('R', 0.0, 0.0, d6, 180.0),
+    ])
+
+# SCARA 4 axis arm: J1 arm a1, J2 arm a2, Z of the flange at J3=0 d1 and J3 in mm
+def rh_model(name, a1, a2, d1=0.0):
+    return ScaraModel(name, [
+        ('R', a1, 0.0, d1, 0.0),
+        ('R', a2, 0.0, 0.0, 0.0),
+        ('P', 0.0, 0.0, 0.0, 0.0),
+        ('R', 0.0, 0.0, 0.0, 0.0),
+    ])
+
+# Arm models by name (nominal dimensions, see above)
+MODELS = {
+    'RV-2F':    rv_model('RV-2F', 295.0, 0.0, 230.0, 0.0, 270.0, 70.0),
+    'RV-4F':    rv_model('RV-4F', 350.0, 0.0, 235.0, 0.0, 275.0, 85.0),
+    'RV-7F':    rv_model('RV-7F', 400.0, 0.0, 340.0, 0.0, 370.0, 85.0),
+    'RH-6FH55': rh_model('RH-6FH55', 325.0, 225.0),
+}
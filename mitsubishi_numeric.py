@@ -0,0 +1,77 @@
+# Vectorized joint calculations for the Mitsubishi RoboDK driver (apimitsubishi.py), based on NumPy
+# The driver works with one sample at a time (tuples of floats). This module does the same calculations on whole
+# arrays (one row of joints per sample or per program target) for offline analysis of long runs and whole programs:
+#   joint_errors        error of each sample against a target (same as joints_error)
+#   segment_deviation   distance of each sample to the joint space path of a move
+#   move_summary        duration, samples and final error of each move of a telemetry recording (read_telemetry)
+#   turns_flags         calc_turns_flag for many targets
+# The configuration flags depend on the arm geometry: see config_flags of the mitsubishi_kinematics arm models
+#
+# Example:
+#   import apimitsubishi, mitsubishi_numeric
+#   rec = apimitsubishi.read_telemetry('cycle.bin')
+#   summary = mitsubishi_numeric.move_summary(rec)
+#---------------------------------------------------------------------------------
+import numpy
+import mitsubishi_kinematics
+
+# Joints as a 2D float array (one row per sample). A single set of joints becomes one row
+def as_joints(joints, naxes=None):
+    joints = numpy.atleast_2d(numpy.asarray(joints, dtype=numpy.float64))
+    if naxes is not None:
+        joints = joints[:, :naxes]
+    return joints
+
+# Largest joint difference (deg) of each sample against target. NaN joints (missing axes) are ignored
+def joint_errors(joints, target):
+    target = numpy.asarray(target, dtype=numpy.float64)
+    joints = as_joints(joints, len(target))
+    return numpy.nanmax(numpy.abs(joints - target[:joints.shape[1]]), axis=1)
+
+# Largest error of a trajectory against target
+def max_joint_error(joints, target):
+    errors = joint_errors(joints, target)
+    return float(errors.max()) if len(errors) else -1.0
+
+# Distance (deg, largest joint difference) of each sample to the joint space segment from start to end
+# A joint move (MOV) is interpolated along this segment: the deviation is the tracking error of the move
+def segment_deviation(joints, start, end):
+    start = numpy.asarray(start, dtype=numpy.float64)
+    end = numpy.asarray(end, dtype=numpy.float64)
+    joints = as_joints(joints, len(start))
+    direction = end - start
+    length2 = float(numpy.dot(direction, direction))
+    if length2 <= 0.0:
+        return numpy.abs(joints - start).max(axis=1)
+    u = numpy.clip((joints - start) @ direction / length2, 0.0, 1.0)
+    nearest = start + u[:, None] * direction
+    return numpy.abs(joints - nearest).max(axis=1)
+
+# Duration, number of samples and final error of each move of a telemetry recording
+# The final error is measured against the last sample of the move (or against targets[move id] if provided)
+# Returns a structured array with the fields move, start, duration, samples and error
+def move_summary(recording, naxes=6, targets=None):
+    moves = recording['move']
+    if len(moves) == 0:
+        return numpy.zeros(0, dtype=[('move', 'u4'), ('start', 'f8'), ('duration', 'f8'), ('samples', 'i8'), ('error', 'f8')])
+    # Samples of a move are consecutive: find where the move id changes
+    bounds = numpy.flatnonzero(numpy.diff(moves)) + 1
+    first = numpy.concatenate(([0], bounds))
+    last = numpy.concatenate((bounds, [len(moves)])) - 1
+    t = recording['t']
+    joints = recording['joints'][:, :naxes]
+
+    summary = numpy.zeros(len(first), dtype=[('move', 'u4'), ('start', 'f8'), ('duration', 'f8'), ('samples', 'i8'), ('error', 'f8')])
+    summary['move'] = moves[first]
+    summary['start'] = t[first]
+    summary['duration'] = t[last] - t[first]
+    summary['samples'] = last - first + 1
+    if targets is not None:
+        final = numpy.asarray([targets[m] for m in summary['move']], dtype=numpy.float64)[:, :naxes]
+        summary['error'] = numpy.nanmax(numpy.abs(joints[last] - final), axis=1)
+    return summary
+
+# calc_turns_flag of each row: 4 bits per joint with the number of turns of the joint (-1 is F), as defined by
+# mitsubishi_kinematics (-180 < angle <= 180 is turn 0)
+def turns_flags(joints):
+    return mitsubishi_kinematics.turns_flags(as_joints(joints))
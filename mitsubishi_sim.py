@@ -0,0 +1,493 @@
+# Mitsubishi robot controller simulator
+# This script is a TCP/IP stand-in for a Mitsubishi controller (R3 protocol, NUL terminated messages).
+# It understands the subset of commands used by the RoboDK driver (apimitsubishi.py) so that the driver can be tested
+# and benchmarked without a real robot:
+#   OPEN, CLOSE, RSTALRM, CNTLON, CNTLOFF, SRVON, SRVOFF, JPOSF, STATE, JOVRD, EXECTOOL
+#   FDEL<prog>, NEW, LOAD=<prog>, EDATA, SAVE, RSTPRG, PRGLOAD=<prog>, RUN<prog>;1, VAL<var>=<value>
+#   OUT=<port>;<value>, IN<port>, ERROR, ERRORMES<errno>
+#
+# Programs are executed: joint targets, SPD/ACCEL/Cnt, MOV/Mvs/Mvr and "If <var>=<value> Then <statement>" lines
+# are interpreted and the joints are interpolated over time, so JPOSF and STATE report the motion as a real controller would.
+# Network latency, jitter and errors can be injected to measure the driver under realistic conditions.
+#
+# The controller listens on the command port and on port+1 (second session used by the driver to monitor the robot).
+#
+# Example:
+#   python mitsubishi_sim.py --port 10001 --latency 2 --jitter 1
+#   python apimitsubishi.py
+#   User entry: CONNECT 127.0.0.1 10001
+#   User entry: MOVJ 10 20 30 40 50 60
+#
+# Inputs read the value of the outputs (loopback) unless they are set with --input.
+# Cartesian targets (P variables) need the model of the arm: --arm RV-4F (see mitsubishi_kinematics, requires NumPy).
+#---------------------------------------------------------------------------------
+import sys
+import math
+import time
+import random
+import socket
+import argparse
+import threading
+import socketserver
+
+# Error numbers reported by ERROR (and their ERRORMES text)
+ERR_UNKNOWN_CMD = 7800
+ERR_PROGRAM = 7810
+ERR_SERVO_OFF = 7820
+ERR_INJECTED = 7999
+ERROR_MESSAGES = {
+    0:               "No error",
+    ERR_UNKNOWN_CMD: "Unknown command",
+    ERR_PROGRAM:     "Program error",
+    ERR_SERVO_OFF:   "Servo is off",
+    ERR_INJECTED:    "Simulated communication error",
+}
+
+# Status bits reported by STATE (first hexadecimal digit of the 5th field)
+STATE_TEACH = 0b0001
+STATE_SERVO = 0b0010
+STATE_RUN   = 0b0100
+STATE_ENABLED = 0b1000
+
+# A motion segment: the joints go from start to end in duration seconds, starting at t0 (time.perf_counter)
+class Segment:
+    def __init__(self, t0, start, end, duration):
+        self.t0 = t0
+        self.start = start
+        self.end = end
+        self.duration = duration
+
+    # Joints at time t. The speed profile is smooth (zero speed at both ends of the segment)
+    def joints(self, t):
+        if self.duration <= 0 or t >= self.t0 + self.duration:
+            return list(self.end)
+        u = max(0.0, (t - self.t0) / self.duration)
+        s = 0.5 - 0.5 * math.cos(math.pi * u)
+        return [a + (b - a) * s for a, b in zip(self.start, self.end)]
+
+# Cartesian position (P variable): X,Y,Z,A,B,C. The configuration flags are ignored, the joints closest to the current
+# joints are used
+class Pose(list):
+    pass
+
+# Simulated controller: programs, variables, I/O, error state and robot motion
+# The same controller is shared by all the sessions (command and monitoring connections)
+class ControllerSim:
+    def __init__(self, axis_count=6, joint_speed=180.0, mm_per_deg=10.0, accel_time=0.05, error_rate=0.0, seed=None):
+        self.axis_count = axis_count
+        self.joint_speed = joint_speed      # deg/s at 100% override
+        self.mm_per_deg = mm_per_deg        # to convert SPD (mm/s) of linear moves to a joint speed
+        self.accel_time = accel_time        # s, added to each move at 100% acceleration
+        self.error_rate = error_rate        # probability of a failed reply (Qer)
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.joints = [0.0] * axis_count
+        self.arm = None                     # arm model (mitsubishi_kinematics) for Cartesian targets
+        self.tool = [0.0] * 6               # tool pose (EXECTOOL, Tool)
+        self.segment = None
+        self.servo = False
+        self.control = False
+        self.override = 100.0
+        self.programs = {}                  # saved programs: name -> list of lines
+        self.editing = None                 # name and lines of the program being edited (NEW, LOAD=, EDATA, SAVE)
+        self.edit_lines = {}
+        self.loaded = None                  # program selected by PRGLOAD
+        self.variables = {}                 # external variables (VAL)
+        self.outputs = 0                    # output signals (bit n is signal n)
+        self.inputs = 0                     # input signals set with set_input
+        self.input_mask = 0                 # inputs set with set_input (the other inputs read the outputs)
+        self.errno = 0
+        self.thread = None                  # thread running the current program
+        self.abort = threading.Event()
+        self.commands = 0                   # number of commands processed
+        self.t_motion = None                # time.perf_counter when the last program started moving the robot
+        self.t_done = None                  # and when it ended (benchmarks)
+
+    #------------ robot motion -----------------
+    def current_joints(self, t=None):
+        with self.lock:
+            if self.segment is None:
+                return list(self.joints)
+            return self.segment.joints(time.perf_counter() if t is None else t)
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    # Move the joints to target with the given speed (deg/s) and acceleration (%). Returns False if the move was aborted
+    def move(self, target, speed, accel):
+        target = (list(target) + [0.0] * self.axis_count)[:self.axis_count]
+        with self.lock:
+            start = self.current_joints()
+            distance = max(abs(b - a) for a, b in zip(start, target))
+            duration = distance / max(speed, 1e-3) + self.accel_time * 100.0 / max(accel, 1.0)
+            self.segment = Segment(time.perf_counter(), start, target, duration)
+            if self.t_motion is None:
+                self.t_motion = self.segment.t0
+        aborted = self.abort.wait(duration)
+        with self.lock:
+            self.joints = self.current_joints()
+            self.segment = None
+        return not aborted
+
+    # Stop the running program right away
+    def stop_program(self):
+        self.abort.set()
+        thread = self.thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.thread = None
+        self.abort.clear()
+
+    def set_error(self, errno):
+        self.errno = errno
+        return 'Qer%04i' % errno
+
+    #------------ program interpreter -----------------
+    # Numeric value of a program expression: number or variable
+    def value(self, expr, local):
+        expr = expr.strip()
+        key = expr.upper()
+        if key in local:
+            return local[key]
+        if key in self.variables:
+            return self.variables[key]
+        return float(expr)
+
+    # Parse a position "(j1,j2,...)" (the configuration flags of "(...)(7,0)" are ignored)
+    def position(self, text):
+        text = text.strip()
+        return [float(x) for x in text[text.index('(') + 1:text.index(')')].split(',')]
+
+    # Run a program line by line. Raises ValueError if a line can't be interpreted
+    def execute(self, lines):
+        local = {'#SPD': 50.0, '#ACCEL': 100.0}    # position variables and current speed (mm/s) and acceleration (%)
+        for line in lines:
+            if self.abort.is_set() or not self.statement(line.strip(), local):
+                return
+
+    # Interpret one statement. Returns False if the program must stop
+    def statement(self, line, local):
+        if not line:
+            return True
+        word, _, args = line.partition(' ')
+        key = word.upper()
+        accel = local['#ACCEL']
+        joint_speed = self.joint_speed * self.override / 100.0
+        linear_speed = min(joint_speed, local['#SPD'] / self.mm_per_deg)
+
+        if key == 'IF':
+            cond, _, then = args.partition(' ')
+            if not then.upper().startswith('THEN '):
+                raise ValueError("Invalid If statement: " + line)
+            var, _, expected = cond.partition('=')
+            if abs(self.value(var, local) - self.value(expected, local)) < 1e-6:
+                return self.statement(then[5:].strip(), local)
+            return True
+
+        if '=' in word:
+            # Position variable: J1=(...) or P1=(...)(flags)
+            var, _, text = line.partition('=')
+            var = var.strip().upper()
+            local[var] = Pose(self.position(text)) if var.startswith('P') else self.position(text)
+            return True
+
+        if key in ('BASE', 'CNT', 'END'):
+            return True
+        elif key == 'TOOL':
+            self.tool = self.position(args)
+            return True
+        elif key == 'SPD':
+            local['#SPD'] = self.value(args, local)
+            return True
+        elif key == 'ACCEL':
+            local['#ACCEL'] = self.value(args.split(',')[0], local)
+            return True
+        elif key == 'MOV':
+            return self.move(self.value_position(args, local), joint_speed, accel)
+        elif key == 'MVS':
+            return self.move(self.value_position(args, local), linear_speed, accel)
+        elif key == 'MVR':
+            # Circular move through the via point (the start point is the current position)
+            points = [self.value_position(p, local) for p in args.split(',')]
+            if len(points) != 3:
+                raise ValueError("Invalid Mvr statement: " + line)
+            return self.move(points[1], linear_speed, accel) and self.move(points[2], linear_speed, accel)
+        raise ValueError("Unknown statement: " + line)
+
+    def value_position(self, expr, local):
+        key = expr.strip().upper()
+        if key in local:
+            return self.pose_joints(local[key])
+        if key in self.variables:
+            return self.variables[key]
+        raise ValueError("Unknown position: " + expr.strip())
+
+    # Joints of a position: the joints of a Cartesian position are solved from the current joints
+    def pose_joints(self, position):
+        if not isinstance(position, Pose):
+            return position
+        if self.arm is None:
+            raise ValueError("Cartesian target without an arm model (--arm)")
+        joints = self.arm.ik(position[:6], self.current_joints(), self.tool)
+        if joints is None:
+            raise ValueError("Position out of reach: " + str(position))
+        return list(joints)
+
+    def run_program(self, name):
+        lines = self.programs.get(name)
+        if lines is None:
+            return self.set_error(ERR_PROGRAM)
+        if not self.servo:
+            return self.set_error(ERR_SERVO_OFF)
+        self.stop_program()
+        self.t_motion = None
+        self.t_done = None
+
+        def run():
+            try:
+                self.execute(lines)
+            except (ValueError, IndexError) as e:
+                sys.stderr.write("Program %s: %s\n" % (name, str(e)))
+                self.errno = ERR_PROGRAM
+            self.t_done = time.perf_counter()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+        return 'QoK'
+
+    # Set the inputs from port to port+width-1
+    def set_input(self, port, value, width=16):
+        mask = ((1 << width) - 1) << port
+        with self.lock:
+            self.inputs = (self.inputs & ~mask) | ((value << port) & mask)
+            self.input_mask |= mask
+
+    # 16 inputs from port
+    def input_word(self, port):
+        with self.lock:
+            bits = (self.inputs & self.input_mask) | (self.outputs & ~self.input_mask)
+        return (bits >> port) & 0xFFFF
+
+    #------------ R3 protocol -----------------
+    def state_str(self):
+        status = STATE_ENABLED if self.control else 0
+        if self.servo:
+            status |= STATE_SERVO
+        if self.running():
+            status |= STATE_RUN
+        return 'QoK%s;1;%.0f;%i;%X000;0' % (self.loaded or '', self.override, 1 if self.control else 0, status)
+
+    def joints_str(self):
+        joints = self.current_joints()
+        fields = []
+        for i in range(8):
+            fields.append('J%i' % (i + 1))
+            fields.append('%.2f' % joints[i] if i < len(joints) else '****')
+        return 'QoK' + ';'.join(fields) + ';;0;0'
+
+    # Process one command ("<robot>;<slot>;<command>") and return the reply
+    def process(self, msg):
+        with self.lock:
+            self.commands += 1
+        cmd = msg.split(';', 2)[-1]
+        key = cmd.upper()
+
+        # Error injection (never on the requests used to read the error)
+        if self.error_rate > 0 and not key.startswith(('ERROR', 'OPEN', 'CLOSE')) and self.random.random() < self.error_rate:
+            return self.set_error(ERR_INJECTED)
+
+        if key.startswith('OPEN=') or key == 'CLOSE':
+            return 'QoK'
+        elif key.startswith('EXECTOOL'):
+            self.tool = self.position(cmd)
+            return 'QoK'
+        elif key == 'JPOSF':
+            return self.joints_str()
+        elif key == 'STATE':
+            return self.state_str()
+        elif key == 'RSTALRM':
+            self.errno = 0
+            return 'QoK'
+        elif key == 'CNTLON':
+            self.control = True
+            return 'QoK'
+        elif key == 'CNTLOFF':
+            self.control = False
+            return 'QoK'
+        elif key == 'SRVON':
+            self.servo = True
+            return 'QoK'
+        elif key == 'SRVOFF':
+            self.stop_program()
+            self.servo = False
+            return 'QoK'
+        elif key.startswith('JOVRD'):
+            self.override = max(1.0, min(100.0, float(cmd[5:])))
+            return 'QoK'
+        elif key.startswith('FDEL'):
+            self.programs.pop(cmd[4:].strip(), None)
+            return 'QoK'
+        elif key == 'NEW':
+            self.editing = None
+            self.edit_lines = {}
+            return 'QoK'
+        elif key.startswith('LOAD='):
+            self.editing = cmd[5:].strip()
+            self.edit_lines = {}
+            return 'QoK'
+        elif key.startswith('EDATA'):
+            if self.editing is None:
+                return self.set_error(ERR_PROGRAM)
+            _, number, text = cmd.split(' ', 2)
+            self.edit_lines[int(number)] = text
+            return 'QoK'
+        elif key == 'SAVE':
+            if self.editing is None:
+                return self.set_error(ERR_PROGRAM)
+            self.programs[self.editing] = [self.edit_lines[n] for n in sorted(self.edit_lines)]
+            return 'QoK'
+        elif key == 'RSTPRG':
+            self.stop_program()
+            return 'QoK'
+        elif key.startswith('PRGLOAD='):
+            name = cmd[8:].strip()
+            if name not in self.programs:
+                return self.set_error(ERR_PROGRAM)
+            self.stop_program()
+            self.loaded = name
+            return 'QoK'
+        elif key.startswith('RUN'):
+            name = cmd[3:].split(';')[0].strip() or self.loaded
+            return self.run_program(name)
+        elif key.startswith('VAL'):
+            var, _, text = cmd[3:].partition('=')
+            if text.strip().startswith('('):
+                self.variables[var.strip().upper()] = self.position(text)
+            else:
+                self.variables[var.strip().upper()] = float(text)
+            return 'QoK'
+        elif key.startswith('OUT='):
+            # 16 signals from port
+            port, _, value = cmd[4:].partition(';')
+            port = int(port)
+            with self.lock:
+                self.outputs = (self.outputs & ~(0xFFFF << port)) | ((int(value, 16) & 0xFFFF) << port)
+            return 'QoK'
+        elif key.startswith('IN'):
+            return 'QoK%04X' % self.input_word(int(cmd[2:]))
+        elif key.startswith('ERRORMES'):
+            return 'QoK' + ERROR_MESSAGES.get(int(cmd[8:] or 0), "Error %s" % cmd[8:])
+        elif key == 'ERROR':
+            return 'QoK%04i;0;0' % self.errno
+        return self.set_error(ERR_UNKNOWN_CMD)
+
+#------------ TCP/IP server -----------------
+# One session (connection) of the controller. Replies are sent latency+jitter after the command was received,
+# in order and at most one command per process_time, so pipelined commands share the network latency as on a real network
+class SessionHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        controller = server.controller
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        buffer = b''
+        t_free = 0.0
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except OSError:
+                return
+            if data == b'':
+                return
+            t_recv = time.perf_counter()
+            buffer += data
+            while b'\0' in buffer:
+                msg, buffer = buffer.split(b'\0', 1)
+                msg = msg.decode('ascii', 'replace')
+                try:
+                    reply = controller.process(msg)
+                except (ValueError, IndexError):
+                    reply = controller.set_error(ERR_UNKNOWN_CMD)
+                if server.verbose:
+                    sys.stderr.write("%i< %s -> %s\n" % (server.server_address[1], msg, reply))
+
+                # Reply when the network and the controller allow it
+                t_free = max(t_free, t_recv) + server.process_time
+                t_reply = max(t_free, t_recv + server.latency + controller.random.uniform(0, server.jitter))
+                wait = t_reply - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                try:
+                    self.request.sendall(reply.encode('ascii') + b'\0')
+                except OSError:
+                    return
+
+class SimServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, controller, host='127.0.0.1', port=10001, latency=0.0, jitter=0.0, process_time=0.0, verbose=False):
+        self.controller = controller
+        self.latency = latency              # seconds
+        self.jitter = jitter                # seconds (uniform, added to the latency)
+        self.process_time = process_time    # seconds per command
+        self.verbose = verbose
+        socketserver.TCPServer.__init__(self, (host, port), SessionHandler)
+
+# Start a simulated controller in background threads (command port and monitoring port, 0 to skip it)
+# Returns the controller and the list of servers (call shutdown and server_close to stop them)
+def start_sim(host='127.0.0.1', port=10001, monitor_port=None, latency=0.0, jitter=0.0, process_time=0.0, verbose=False, **kwargs):
+    controller = ControllerSim(**kwargs)
+    if monitor_port is None:
+        monitor_port = port + 1
+    servers = []
+    for p in (port, monitor_port):
+        if not p:
+            continue
+        server = SimServer(controller, host, p, latency, jitter, process_time, verbose)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    return controller, servers
+
+def RunMain():
+    parser = argparse.ArgumentParser(description="Mitsubishi robot controller simulator (R3 protocol subset used by the RoboDK driver)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=10001, help="command port (default 10001)")
+    parser.add_argument('--monitor-port', type=int, default=None, help="monitoring port (default port+1, 0 to disable)")
+    parser.add_argument('--axes', type=int, default=6, help="number of axes")
+    parser.add_argument('--latency', type=float, default=0.0, help="network latency per reply (ms)")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra latency, up to this value (ms)")
+    parser.add_argument('--process-time', type=float, default=0.0, help="controller time per command (ms)")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="probability of a failed reply (0-1)")
+    parser.add_argument('--joint-speed', type=float, default=180.0, help="joint speed at 100%% override (deg/s)")
+    parser.add_argument('--mm-per-deg', type=float, default=10.0, help="conversion of the linear speed (mm/s) to a joint speed")
+    parser.add_argument('--accel-time', type=float, default=50.0, help="acceleration time added to each move (ms)")
+    parser.add_argument('--input', action='append', default=[], metavar='PORT=HEX', help="fixed value of the 16 inputs from PORT")
+    parser.add_argument('--arm', default=None, help="arm model for Cartesian targets (mitsubishi_kinematics.MODELS, requires NumPy)")
+    parser.add_argument('--seed', type=int, default=None, help="seed for the jitter and error injection")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log commands and replies to stderr")
+    args = parser.parse_args()
+
+    controller, servers = start_sim(args.host, args.port, args.monitor_port,
+                                    args.latency * 0.001, args.jitter * 0.001, args.process_time * 0.001, args.verbose,
+                                    axis_count=args.axes, joint_speed=args.joint_speed, mm_per_deg=args.mm_per_deg,
+                                    accel_time=args.accel_time * 0.001, error_rate=args.error_rate, seed=args.seed)
+    if args.arm:
+        import mitsubishi_kinematics
+        controller.arm = mitsubishi_kinematics.MODELS[args.arm.upper()]
+    for item in args.input:
+        port, _, value = item.partition('=')
+        controller.set_input(int(port), int(value, 16))
+
+    print("Simulated Mitsubishi controller listening on %s" % ', '.join('%s:%i' % s.server_address for s in servers))
+    sys.stdout.flush()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+if __name__ == "__main__":
+    RunMain()